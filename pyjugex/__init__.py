@@ -1,3 +1,3 @@
 from .pyjugex import PyjugexAnalysis
 from .anova import PyjugexAnova
-from .error import ValueMissingError, NotYetImplementedError 
\ No newline at end of file
+from .error import ValueMissingError, NotYetImplementedError, OfflineError 
\ No newline at end of file
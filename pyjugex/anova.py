@@ -15,21 +15,15 @@
 from statsmodels.formula.api import ols
 import statsmodels.api as sm
 import numpy as np
-import multiprocessing
+import logging
 from .util import get_mean_zscores
 from .error import ValueMissingError
+from .design import AnovaDesign
+from .permutation import PermutationPlan, count_distinct_labelings
+from .fwe import MaxFAccumulator, sequential_decision, gpd_tail_p
+from .pool import get_worker_pool, shared_memory
 
-def unwrap_self_do_anova_with_permutation_rep(*args, **kwargs):
-  """
-  Helper function to enable usage of the multiprocessing module inside a class.
-  Args:
-  *args: Variable length argument list.
-  **kwargs: Arbitrary keyword arguments.
-  Returns:
-  do_anova_with_permutation_rep()
-  """
-  return PyjugexAnova.do_anova_with_permutation_rep(*args, **kwargs)
-
+ENGINES = ('numpy', 'statsmodels')
 
 class PyjugexAnova:
   """
@@ -39,15 +33,44 @@ class PyjugexAnova:
   - factors
   - n_genes
   - n_rep
+
+  engine selects how the F value of Area is computed:
+  - 'numpy' (default): closed form least squares, see AnovaDesign
+  - 'statsmodels': ols + anova_lm for every gene, kept as reference
+
+  With the numpy engine, permutations are evaluated block_size at a time, for all genes at once. Larger blocks use more memory (block_size x (n_samples + n_genes) floats) and fewer Python iterations.
+
+  The relabellings of Area are taken from a PermutationPlan created from seed, the same relabelling is applied to every gene within a repetition. Results are reproducible for a given seed, irrespective of engine, block_size or number of workers.
+
+  By default, permutations are computed in the calling process. With n_workers > 1 (or an explicit worker_pool), they are split across a persistent WorkerPool, which is reused by subsequent analyses instead of starting a new pool every time.
+
+  The F values of the permutations are reduced block by block by a MaxFAccumulator, which keeps the maximum F of each permutation and the per gene exceedance counts (uncorrected_p). The full n_rep x n_genes matrix F_mat_perm_anovan is only kept with keep_f_matrix=True.
+
+  If alpha is set, the permutations are run in rounds and stop as soon as the FWE corrected p value of every gene is decided to be below or above alpha (Clopper-Pearson interval, see sequential_decision). The decision is re-tested after every round, so sequential_error is spent evenly over the rounds: each look uses sequential_error / n_rounds, which bounds the probability of a wrong decision by sequential_error per gene. n_rep is then the maximum number of permutations. self.decisions records, per gene, whether it is significant and after how many permutations it was decided.
+
+  With tail_approximation=True, FWE corrected p values smaller than about 10 / n_rep are extrapolated from a generalized Pareto fit to the upper tail of the max-F null (see gpd_tail_p). self.tail_diagnostics holds the fit parameters and goodness of fit. All other genes, and all genes if the fit is rejected, keep the permutation p value of the MaxFAccumulator, which counts F_ref as one of the permutations and is never 0.
+
+  Instead of combined_zscores (samples x probes), the winsorized means per gene can be passed as mean_zscores (samples x genes), e.g. from the gene matrix of a MicroarrayStore. gene_symbols then names the columns of mean_zscores.
+
+  If the number of distinct relabellings of Area is at most max_exact (default: n_rep), every relabelling is evaluated once instead of drawing random permutations, and the p values are exact (self.exact is True). Sequential stopping and the tail approximation are not used in that case. Set max_exact=0 to always use random permutations.
   """
-  def __init__(self, z_scores=None, area=None, specimen=None, age=None, race=None, combined_zscores=None, gene_symbols=None, n_rep=1000, verbose=True):
+  def __init__(self, z_scores=None, area=None, specimen=None, age=None, race=None, combined_zscores=None, gene_symbols=None, n_rep=1000, verbose=True, engine='numpy', block_size=256, seed=None, n_workers=1, worker_pool=None, keep_f_matrix=False, alpha=None, sequential_error=1e-3, tail_approximation=False, max_exact=None, mean_zscores=None):
 
-    if combined_zscores is None:
+    if combined_zscores is None and mean_zscores is None:
       raise ValueMissingError('combined_zscores is required')
 
     if gene_symbols is None:
       raise ValueMissingError('gene_symbols is required')
 
+    if engine not in ENGINES:
+      raise ValueError('engine needs to be one of {}'.format(', '.join(ENGINES)))
+
+    if block_size < 1:
+      raise ValueError('block_size needs to be a positive integer')
+
+    if alpha is not None and not 0 < alpha < 1:
+      raise ValueError('alpha needs to be between 0 and 1')
+
     self.factors = {
       "Area": area,
       "Specimen": specimen,
@@ -56,14 +79,41 @@ class PyjugexAnova:
       "Zscores": z_scores
     }
 
-    self.genesymbol_and_mean_zscores = get_mean_zscores(gene_symbols, combined_zscores)
+    if mean_zscores is not None:
+      mean_zscores = np.asarray(mean_zscores, dtype=np.float64)
+      if mean_zscores.ndim != 2 or mean_zscores.shape[1] != len(gene_symbols):
+        raise ValueError('mean_zscores needs to be a samples x genes matrix, with one column per gene symbol')
+      self.genesymbol_and_mean_zscores = {
+        "uniqueId": np.asarray(gene_symbols),
+        "combined_zscores": mean_zscores
+      }
+    else:
+      self.genesymbol_and_mean_zscores = get_mean_zscores(gene_symbols, combined_zscores)
     self.n_genes = len(self.genesymbol_and_mean_zscores['combined_zscores'][0])
 
     self.F_vec_ref_anovan = None
     self.n_rep = n_rep
+    self.keep_f_matrix = keep_f_matrix
     self.F_mat_perm_anovan = None
+    self.max_F_accumulator = None
+    self.uncorrected_p = None
+    self.alpha = alpha
+    self.sequential_error = sequential_error
+    self.decisions = None
+    self.tail_approximation = tail_approximation
+    self.tail_diagnostics = None
+    self.max_exact = max_exact
+    self.exact = False
 
     self.verbose = verbose
+    self.engine = engine
+    self.block_size = block_size
+    self.seed = seed
+    self.n_workers = n_workers
+    self.worker_pool = worker_pool
+    self.permutation_plan = None
+    self.design = None
+    self.projected_zscores = None
     self.result = None
 
   def run(self):
@@ -71,17 +121,38 @@ class PyjugexAnova:
     self._fwe_correction()
     self._collate_result()
 
-  def _collate_result(self):
-    def div_func(arr):
-      return np.count_nonzero(arr)/self.n_rep
+  def _collate_result(self, tail_approximation=None):
+    """
+    Populate self.result with the FWE corrected p value of every gene
+    Args:
+    tail_approximation (bool): optional, overrides self.tail_approximation
+    """
+    if tail_approximation is None:
+      tail_approximation = self.tail_approximation
 
-    FWE_corrected_p = np.apply_along_axis(div_func, 0, self.F_mat_perm_anovan.max(1)[:, np.newaxis] >= np.array(self.F_vec_ref_anovan))
+    FWE_corrected_p = self.max_F_accumulator.fwe_corrected_p()
+    if tail_approximation and not self.exact:
+      # the null excludes row 0, the unpermuted F values. Only the extrapolated p values replace the permutation p values
+      null = self.max_F_accumulator.max_F[1:self.max_F_accumulator.n_done+1]
+      tail_p, self.tail_diagnostics = gpd_tail_p(null, self.F_vec_ref_anovan)
+      use_tail = self.tail_diagnostics['method'] == 'gpd'
+      FWE_corrected_p[use_tail] = tail_p[use_tail]
+      if self.verbose:
+        logging.getLogger(__name__).info('tail approximation: {}'.format(self.tail_diagnostics))
+    self.uncorrected_p = dict(zip(self.genesymbol_and_mean_zscores['uniqueId'], self.max_F_accumulator.uncorrected_p()))
     self.result = dict(zip(self.genesymbol_and_mean_zscores['uniqueId'], FWE_corrected_p))
 
   def _first_iteration(self):
     """
     Perform one iteration of ANOVA. Use output of this to populate F_vec_ref_anovan which becomes initial estimate of n_rep passes of FWE.
     """
+    if self.engine == 'numpy':
+      # the design is the same for every gene, only the response changes. Project all genes at once
+      self.design = AnovaDesign(area=self.factors['Area'], specimen=self.factors['Specimen'], age=self.factors['Age'], race=self.factors['Race'])
+      self.projected_zscores = self.design.project(self.genesymbol_and_mean_zscores['combined_zscores'])
+      self.F_vec_ref_anovan = self.design.area_f_projected(self.projected_zscores)
+      return
+
     self.F_vec_ref_anovan = np.zeros(self.n_genes)
     for i in range(self.n_genes):
       self.factors['Zscores'] = self.genesymbol_and_mean_zscores['combined_zscores'][:,i]
@@ -90,38 +161,145 @@ class PyjugexAnova:
       aov_table = sm.stats.anova_lm(mod, typ=1)
 
       #F_vec_ref_anovan is used as an initial condition to F_mat_perm_anovan in _fwe_correction
-      self.F_vec_ref_anovan[i] = aov_table['F'][0]
+      self.F_vec_ref_anovan[i] = aov_table['F'].iloc[0]
+
+  def _get_worker_pool(self):
+    """
+    Returns:
+    WorkerPool: the pool to distribute the permutations to, or None to compute them in this process
+    """
+    if self.worker_pool is not None:
+      return self.worker_pool
+    if self.n_workers is not None and self.n_workers <= 1:
+      return None
+    return get_worker_pool(self.n_workers)
 
   def _fwe_correction(self):
     """
     Perform n_rep passes of FWE using gene_id_and_pvalues of _first_iteration() as an initial guess
     """
-    initial_guess_F_vec = self.F_vec_ref_anovan
-    pool = multiprocessing.Pool()
+    max_exact = self.n_rep if self.max_exact is None else self.max_exact
+    self.exact = count_distinct_labelings(self.factors['Area']) <= max_exact
+    if self.exact:
+      self.permutation_plan = PermutationPlan.exhaustive(self.factors['Area'])
+      if self.verbose:
+        logging.getLogger(__name__).info('exact permutation test over all {} distinct labelings of Area'.format(len(self.permutation_plan) + 1))
+    else:
+      self.permutation_plan = PermutationPlan(n_samples=len(self.factors['Area']), n_perm=self.n_rep-1, seed=self.seed)
+    n_perm = len(self.permutation_plan)
+    self.max_F_accumulator = MaxFAccumulator(self.F_vec_ref_anovan, n_perm=n_perm, keep_f_matrix=self.keep_f_matrix)
+    worker_pool = self._get_worker_pool()
+    if self.engine == 'numpy' and worker_pool is not None and shared_memory is None:
+      logging.getLogger(__name__).warning('multiprocessing.shared_memory is not available, permutations are computed in this process')
+      worker_pool = None
+
+    # the inputs of the workers are shared once, for all rounds
+    shared = worker_pool.share(self.design, self.projected_zscores, self.permutation_plan.permutations, self.max_F_accumulator) if self.engine == 'numpy' and worker_pool is not None else None
+    try:
+      if self.alpha is None or self.exact:
+        self._run_permutations(0, n_perm, worker_pool, shared)
+      else:
+        self._run_sequential_permutations(worker_pool, shared)
+    finally:
+      if shared is not None:
+        shared.close()
 
-    # double check math here
-    self.F_mat_perm_anovan = np.array(pool.map(unwrap_self_do_anova_with_permutation_rep, [self]*(self.n_rep-1)))
-    self.F_mat_perm_anovan = np.insert(self.F_mat_perm_anovan, 0, initial_guess_F_vec, axis=0)
+    F_mat = self.max_F_accumulator.F_mat
+    self.F_mat_perm_anovan = None if F_mat is None else F_mat[:self.max_F_accumulator.n_done+1]
 
-  def do_anova_with_permutation_gene(self, index_to_gene_list):
+  def _run_sequential_permutations(self, worker_pool, shared=None):
+    """
+    Run the permutations in rounds, until the FWE corrected p value of every gene is decided relative to alpha, or n_rep is reached. Populates self.decisions.
+    """
+    round_size = self.block_size * (1 if worker_pool is None else worker_pool.n_workers)
+    decision = np.zeros(self.n_genes, dtype=int)
+    decided_at = np.zeros(self.n_genes, dtype=int)
+
+    n_perm = len(self.permutation_plan)
+    # Bonferroni over the looks at the data
+    look_error = self.sequential_error / max(-(-n_perm // round_size), 1)
+    for start in range(0, n_perm, round_size):
+      self._run_permutations(start, min(start + round_size, n_perm), worker_pool, shared)
+      n = self.max_F_accumulator.n_done + 1
+      new_decision = sequential_decision(self.max_F_accumulator.fwe_counts(), n, self.alpha, look_error)
+      newly_decided = (decision == 0) & (new_decision != 0)
+      decision[newly_decided] = new_decision[newly_decided]
+      decided_at[newly_decided] = n
+      if np.all(decision != 0):
+        break
+
+    if self.verbose:
+      logging.getLogger(__name__).info('sequential FWE correction stopped after {} of {} permutations'.format(self.max_F_accumulator.n_done + 1, self.n_rep))
+
+    self.decisions = {
+      gene: {
+        'significant': None if d == 0 else bool(d > 0),
+        'n_perm': int(n_perm) if d != 0 else None
+      } for gene, d, n_perm in zip(self.genesymbol_and_mean_zscores['uniqueId'], decision, decided_at)
+    }
+
+  def _run_permutations(self, start, stop, worker_pool=None, shared=None):
+    """
+    Compute permutations start to stop of the permutation plan and add them to max_F_accumulator
+    Args:
+    shared (SharedAnalysis): for the numpy engine with a worker_pool, the inputs of the workers, see WorkerPool.share
+    """
+    if self.engine == 'numpy':
+      if worker_pool is not None:
+        worker_pool.accumulate(shared, self.max_F_accumulator, start, stop, block_size=self.block_size)
+        return
+      for block_start in range(start, stop, self.block_size):
+        block_stop = min(block_start + self.block_size, stop)
+        self.max_F_accumulator.add(block_start, self.design.area_f_block(self.projected_zscores, self.permutation_plan.block(block_start, block_stop)))
+      return
+
+    if worker_pool is None:
+      chunks = ((block_start, self.do_anova_with_permutation_reps(block_start, min(block_start + self.block_size, stop))) for block_start in range(start, stop, self.block_size))
+    else:
+      chunks = worker_pool.imap_chunks(self, 'do_anova_with_permutation_reps', stop - start, offset=start)
+    for block_start, F_chunk in chunks:
+      self.max_F_accumulator.add(block_start, F_chunk)
+
+  def do_anova_with_permutation_reps(self, start, stop):
+    """
+    Perform repetitions start to stop of anova for all genes
+    Returns:
+    list: a list of lists of F_values, one list per repetition
+    """
+    return [self.do_anova_with_permutation_rep(rep) for rep in range(start, stop)]
+
+  def do_anova_with_permutation_gene(self, index_to_gene_list, permutation=None):
     """
     Perform one repetition of anova for each gene
     Args:
     index_to_gene_list (int) : Index into the genesymbol_and_mean_zscores['combined_zscores'] array, representing mean zscore of a gene.
+    permutation (numpy.ndarray) : optional, index array relabelling Area. A random permutation is drawn if not provided.
     Returns:
     float: F value extracted from the anova table
     """
-    self.factors['Area'] = np.random.permutation(self.factors['Area'])
-    self.factors['Zscores'] = self.genesymbol_and_mean_zscores['combined_zscores'][:,index_to_gene_list]
+    if permutation is None:
+      permutation = np.random.permutation(len(self.factors['Area']))
+    zscores = self.genesymbol_and_mean_zscores['combined_zscores'][:,index_to_gene_list]
 
-    mod = ols('Zscores ~ Area + Specimen + Age + Race', data=self.factors).fit()
+    if self.engine == 'numpy':
+      return self.design.area_f(zscores, permutation=permutation)
+
+    factors = dict(self.factors)
+    factors['Area'] = np.asarray(self.factors['Area'])[permutation]
+    factors['Zscores'] = zscores
+    mod = ols('Zscores ~ Area + Specimen + Age + Race', data=factors).fit()
     aov_table = sm.stats.anova_lm(mod, typ=1)
-    return aov_table['F'][0]
+    return aov_table['F'].iloc[0]
 
-  def do_anova_with_permutation_rep(self):
+  def do_anova_with_permutation_rep(self, rep=None):
     """
-    Perform one repetition of anova for all genes
+    Perform one repetition of anova for all genes. The same relabelling of Area is used for every gene.
+    Args:
+    rep (int) : optional, row of permutation_plan to use. A random permutation is drawn if not provided.
     Returns:
     list: a list of F_values, one for each gene.
     """
-    return list(map(self.do_anova_with_permutation_gene, range(0,self.n_genes)))
+    permutation = np.random.permutation(len(self.factors['Area'])) if rep is None else self.permutation_plan.block(rep, rep+1)[0]
+    if self.engine == 'numpy':
+      return list(self.design.area_f_projected(self.projected_zscores, permutation=permutation))
+    return [self.do_anova_with_permutation_gene(index, permutation=permutation) for index in range(0,self.n_genes)]
@@ -12,18 +12,207 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from .error import ValueMissingError
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
 
-class MemoryCache():
+from .error import ValueMissingError, NotYetImplementedError
+
+class CacheBackend():
+  """
+  Interface of the caches used by pyjugex.util. Values are looked up by string keys, None means not cached. Every backend counts its hits and misses. Caches are used from the concurrent requests of pyjugex.util, so shared bookkeeping is updated under self._lock.
+  """
   def __init__(self):
-    self.store = dict()
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
 
   def get_from_key(self, key=None):
     if key is None:
       raise ValueMissingError('key is required')
-    return self.store.get(key, None)
+    value = self._get(key)
+    with self._lock:
+      if value is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+    return value
 
   def store_key_value(self, key=None, value=None):
     if key is None:
       raise ValueMissingError('key is required')
+    self._store(key, value)
+
+  def stats(self):
+    """
+    Returns:
+    dict: number of hits and misses since the cache was created
+    """
+    return {'hits': self.hits, 'misses': self.misses}
+
+  def _get(self, key):
+    raise NotYetImplementedError('_get needs to be implemented by the cache backend')
+
+  def _store(self, key, value):
+    raise NotYetImplementedError('_store needs to be implemented by the cache backend')
+
+class MemoryCache(CacheBackend):
+  def __init__(self):
+    super().__init__()
+    self.store = dict()
+
+  def _get(self, key):
+    return self.store.get(key, None)
+
+  def _store(self, key, value):
     self.store[key] = value
+
+class DiskCache(CacheBackend):
+  """
+  Persistent cache in a directory, which can be shared by several processes.
+
+  Every value is pickled into its own file, named by the sha256 of its key. Files are written to a temporary file in the same directory and moved into place with os.replace, so readers never see a partially written value. The modification time of a file is its last use: once the directory holds more than max_bytes, the least recently used files are removed, down to low_water * max_bytes. Values older than ttl seconds are treated as missing.
+
+  The size of the directory is scanned once, on the first store, and then kept as a running total of the values stored and removed by this process. The directory is only scanned again when that total passes max_bytes, so a store costs a constant number of filesystem calls. Values written by other processes sharing the directory are accounted for at the next scan.
+
+  Usage:
+
+  util.set_cache(DiskCache('~/.pyjugex/cache', max_bytes=2 * 1024 ** 3, ttl=30 * 24 * 3600))
+  """
+  suffix = '.pkl'
+
+  def __init__(self, path, max_bytes=None, ttl=None, low_water=0.9):
+    super().__init__()
+    self.path = os.path.abspath(os.path.expanduser(path))
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self.low_water = low_water
+    # running total of the size of the directory, None until it has been scanned
+    self._size = None
+    os.makedirs(self.path, exist_ok=True)
+
+  def key_path(self, key):
+    digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    return os.path.join(self.path, digest[:2], digest + self.suffix)
+
+  def _get(self, key):
+    filename = self.key_path(key)
+    try:
+      with open(filename, 'rb') as f:
+        stored_key, created, value = pickle.load(f)
+    except FileNotFoundError:
+      return None
+    except (EOFError, pickle.UnpicklingError, ValueError):
+      # e.g. written by an incompatible version, drop it
+      self._discard(filename)
+      return None
+
+    if stored_key != key:
+      return None
+    if self.ttl is not None and time.time() - created > self.ttl:
+      self._discard(filename)
+      return None
+
+    try:
+      os.utime(filename)
+    except FileNotFoundError:
+      # evicted by another process in the meantime
+      pass
+    return value
+
+  def _store(self, key, value):
+    filename = self.key_path(key)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        pickle.dump((key, time.time(), value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        size = f.tell()
+      with self._lock:
+        previous_size = self._size_of(filename)
+        os.replace(tmp_name, filename)
+        self._track(size - previous_size)
+    except BaseException:
+      self._remove(tmp_name)
+      raise
+
+  def _track(self, change):
+    # called with self._lock held
+    if self.max_bytes is None:
+      return
+    if self._size is None:
+      self._size = self.size_bytes()
+    else:
+      self._size += change
+    if self._size > self.max_bytes:
+      self._evict(self.low_water * self.max_bytes)
+
+  def _size_of(self, filename):
+    try:
+      return os.stat(filename).st_size
+    except FileNotFoundError:
+      return 0
+
+  def _remove(self, filename):
+    """
+    Returns:
+    int: size of the removed file, 0 if it did not exist
+    """
+    size = self._size_of(filename)
+    try:
+      os.remove(filename)
+    except FileNotFoundError:
+      return 0
+    return size
+
+  def _discard(self, filename):
+    with self._lock:
+      size = self._remove(filename)
+      if self._size is not None:
+        self._size = max(self._size - size, 0)
+
+  def entries(self):
+    """
+    Returns:
+    list: (last use, size in bytes, filename) of every cached value
+    """
+    entries = []
+    for dirpath, _, filenames in os.walk(self.path):
+      for name in filenames:
+        if not name.endswith(self.suffix):
+          continue
+        filename = os.path.join(dirpath, name)
+        try:
+          stat = os.stat(filename)
+        except FileNotFoundError:
+          continue
+        entries.append((stat.st_mtime, stat.st_size, filename))
+    return entries
+
+  def size_bytes(self):
+    return sum(size for _, size, _ in self.entries())
+
+  def evict(self, max_bytes=None):
+    """
+    Remove the least recently used values until the cache holds at most max_bytes (default: self.max_bytes). Rescans the directory and resets the running total.
+    """
+    max_bytes = self.max_bytes if max_bytes is None else max_bytes
+    with self._lock:
+      self._evict(max_bytes)
+
+  def _evict(self, max_bytes):
+    # called with self._lock held
+    entries = sorted(self.entries())
+    total = sum(size for _, size, _ in entries)
+    for _, size, filename in entries:
+      if total <= max_bytes:
+        break
+      self._remove(filename)
+      total -= size
+    self._size = total
+
+  def clear(self):
+    self.evict(max_bytes=0)
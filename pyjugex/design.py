@@ -0,0 +1,177 @@
+# Copyright 2020 Forschungszentrum Jülich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+from .error import ValueMissingError
+
+def encode_categorical(values):
+  """
+  Treatment (dummy) coding of a categorical factor, as done by patsy for the ols formula. The first level (in sorted order) is used as reference and dropped.
+  Args:
+  values (list): factor level of each sample
+  Returns:
+  numpy.ndarray: n_samples x (n_levels - 1) array of 0/1 indicator columns
+  """
+  _, codes = np.unique(np.asarray(values), return_inverse=True)
+  codes = codes.reshape(-1)
+  return (codes[:, np.newaxis] == np.arange(1, codes.max(initial=0) + 1)).astype(np.float64)
+
+def orthonormal_basis(mat):
+  """
+  Orthonormal basis of the column space of mat. Columns which are linearly dependent on others are dropped, using the same tolerance as numpy.linalg.matrix_rank.
+  Args:
+  mat (numpy.ndarray): n x k matrix
+  Returns:
+  numpy.ndarray: n x rank(mat) matrix with orthonormal columns
+  """
+  u, s, _ = np.linalg.svd(mat, full_matrices=False)
+  if s.size == 0:
+    return u
+  tol = s.max() * max(mat.shape) * np.finfo(s.dtype).eps
+  return u[:, s > tol]
+
+class AnovaDesign:
+  """
+  Closed form least squares equivalent of
+
+  mod = ols('Zscores ~ Area + Specimen + Age + Race', data=factors).fit()
+  sm.stats.anova_lm(mod, typ=1)['F'][0]
+
+  The design is encoded once. Specimen, Age and Race are nuisance factors, their column space is kept as an orthonormal basis, so that the sequential (type I) F value of Area only requires a few dot products per response.
+  """
+  def __init__(self, area=None, specimen=None, age=None, race=None):
+    if area is None or specimen is None or age is None or race is None:
+      raise ValueMissingError('area, specimen, age and race are required')
+
+    self.n_samples = len(area)
+    self.area = encode_categorical(area)
+    self.df_area = self.area.shape[1]
+    if self.df_area == 0:
+      # pyjugex names the regions of interest img1 and img2
+      levels = list(np.unique(np.asarray(area)))
+      empty = [name for name in ['img1', 'img2'] if name not in levels]
+      raise ValueMissingError('Area needs samples in at least two regions of interest, found {}{}'.format(levels, ', no samples in ' + ' and '.join(empty) if empty else ''))
+
+    nuisance = np.hstack([
+      np.ones((self.n_samples, 1)),
+      encode_categorical(specimen),
+      np.asarray(age, dtype=np.float64).reshape(self.n_samples, 1),
+      encode_categorical(race)
+    ])
+    self.nuisance_basis = orthonormal_basis(nuisance)
+    self.nuisance_rank = self.nuisance_basis.shape[1]
+
+  @classmethod
+  def from_encoded(cls, area, nuisance_basis):
+    """
+    Recreate a design from its encoded arrays, e.g. inside a worker process
+    Args:
+    area (numpy.ndarray): n_samples x n_columns treatment coded Area, see AnovaDesign.area
+    nuisance_basis (numpy.ndarray): see AnovaDesign.nuisance_basis
+    """
+    design = cls.__new__(cls)
+    design.area = area
+    design.n_samples, design.df_area = area.shape
+    design.nuisance_basis = nuisance_basis
+    design.nuisance_rank = nuisance_basis.shape[1]
+    return design
+
+  def residualize(self, mat):
+    """
+    Remove the part of mat explained by the nuisance factors (including the intercept)
+    """
+    return mat - np.dot(self.nuisance_basis, np.dot(self.nuisance_basis.T, mat))
+
+  def project(self, zscores):
+    """
+    Precompute the parts of the responses which do not change when Area is relabelled. This only needs to be done once per analysis.
+    Args:
+    zscores (numpy.ndarray): n_samples x n_genes matrix of responses, e.g. genesymbol_and_mean_zscores['combined_zscores']
+    Returns:
+    dict: with keys -
+      centered - responses with the mean removed
+      resid - responses with the nuisance factors removed
+      ss_resid - residual sum of squares of the nuisance only model, one per gene
+    """
+    y = np.asarray(zscores, dtype=np.float64)
+    y_resid = self.residualize(y)
+    return {
+      'centered': y - y.mean(axis=0),
+      'resid': y_resid,
+      'ss_resid': np.einsum('ij,ij->j', y_resid, y_resid)
+    }
+
+  def area_f_projected(self, projected, permutation=None):
+    """
+    Sequential (type I) F value of Area for all genes at once
+    Args:
+    projected (dict): output of project()
+    permutation (numpy.ndarray): optional, index array of length n_samples. If provided, Area labels are relabelled as area[permutation]
+    Returns:
+    numpy.ndarray: F value of the Area term, one per gene
+    """
+    permutation = np.arange(self.n_samples) if permutation is None else np.asarray(permutation)
+    return self.area_f_block(projected, permutation[np.newaxis, :])[0]
+
+  def area_f_block(self, projected, permutations):
+    """
+    Sequential (type I) F value of Area for a block of relabellings of Area and all genes at once. Memory use is proportional to n_permutations x (n_samples + n_genes).
+    Args:
+    projected (dict): output of project()
+    permutations (numpy.ndarray): n_permutations x n_samples array, each row is an index array relabelling Area as area[row]
+    Returns:
+    numpy.ndarray: n_permutations x n_genes array of F values
+    """
+    n_perm = len(permutations)
+    area = self.area[permutations]
+
+    # Area is the first term after the intercept, its sum of squares does not depend on the nuisance factors
+    area_centered = area - area.mean(axis=1, keepdims=True)
+    ss_area = _projected_sum_of_squares(area_centered, projected['centered'])
+
+    # residual sum of squares of the full model
+    stacked = area.transpose(1, 0, 2).reshape(self.n_samples, -1)
+    area_resid = self.residualize(stacked).reshape(self.n_samples, n_perm, self.df_area).transpose(1, 0, 2)
+    ssr = projected['ss_resid'] - _projected_sum_of_squares(area_resid, projected['resid'])
+    df_resid = self.n_samples - self.nuisance_rank - np.linalg.matrix_rank(area_resid)
+
+    return (ss_area / self.df_area) / (ssr / df_resid[:, np.newaxis])
+
+  def area_f(self, zscores, permutation=None):
+    """
+    Sequential (type I) F value of Area
+    Args:
+    zscores (numpy.ndarray): response of length n_samples, or n_samples x n_genes matrix of responses
+    permutation (numpy.ndarray): optional, index array of length n_samples. If provided, Area labels are relabelled as area[permutation]
+    Returns:
+    float or numpy.ndarray: F value of the Area term, one per gene if zscores is a matrix
+    """
+    y = np.asarray(zscores, dtype=np.float64)
+    f = self.area_f_projected(self.project(y.reshape(self.n_samples, -1)), permutation=permutation)
+    return f[0] if y.ndim == 1 else f
+
+def _projected_sum_of_squares(area, y):
+  """
+  Sum of squares of the projection of every column of y onto the column space of area, for a stack of area matrices
+  Args:
+  area (numpy.ndarray): n_permutations x n_samples x n_columns
+  y (numpy.ndarray): n_samples x n_genes
+  Returns:
+  numpy.ndarray: n_permutations x n_genes
+  """
+  n_perm, n_samples, n_columns = area.shape
+  # a single matrix product over the whole block
+  b = np.dot(area.transpose(0, 2, 1).reshape(-1, n_samples), y).reshape(n_perm, n_columns, -1)
+  gram_inv = np.linalg.pinv(np.matmul(area.transpose(0, 2, 1), area))
+  return np.einsum('pcg,pcg->pg', b, np.matmul(gram_inv, b))
@@ -19,3 +19,7 @@ class NotYetImplementedError(Exception):
 class ValueMissingError(Exception):
   def __init__(self, message):
     super().__init__(message)
+
+class OfflineError(Exception):
+  def __init__(self, message):
+    super().__init__(message)
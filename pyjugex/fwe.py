@@ -0,0 +1,179 @@
+# Copyright 2020 Forschungszentrum Jülich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+from scipy import stats
+
+class MaxFAccumulator:
+  """
+  Streaming reduction of the permutations x genes F matrix of the FWE correction.
+
+  Row 0 is the unpermuted F_ref, as in F_mat_perm_anovan. Only the maximum F over all genes is kept for every permutation, and optionally the number of permutations in which each gene exceeds its own F_ref, so memory use is O(n_perm + n_genes). The full matrix is only kept with keep_f_matrix=True.
+
+  F values are compared with F_threshold, F_ref lowered by the relative tolerance rtol, so that relabellings which reproduce F_ref up to rounding (e.g. those symmetric to the observed labelling) count as exceedances.
+  """
+  rtol = 1e-10
+
+  def __init__(self, F_ref, n_perm, count_exceedances=True, keep_f_matrix=False):
+    self.F_ref = np.asarray(F_ref, dtype=np.float64)
+    self.F_threshold = self.F_ref - np.abs(self.F_ref) * self.rtol
+    self.n_perm = n_perm
+    self.n_done = 0
+
+    self.max_F = np.zeros(n_perm + 1)
+    self.max_F[0] = self.F_ref.max(initial=-np.inf)
+    self.exceedances = np.ones(len(self.F_ref), dtype=np.int64) if count_exceedances else None
+    self.F_mat = np.zeros((n_perm + 1, len(self.F_ref))) if keep_f_matrix else None
+    if keep_f_matrix:
+      self.F_mat[0] = self.F_ref
+
+  def add(self, start, F_block):
+    """
+    Reduce the F values of permutations start to start + len(F_block)
+    Args:
+    start (int): index of the first permutation of the block, 0 based, not counting F_ref
+    F_block (numpy.ndarray): n_block x n_genes F values
+    """
+    F_block = np.asarray(F_block, dtype=np.float64).reshape(-1, len(self.F_ref))
+    exceedances = np.count_nonzero(F_block >= self.F_threshold, axis=0) if self.exceedances is not None else None
+    self.update(start, F_block.max(axis=1, initial=-np.inf), exceedances=exceedances, F_mat=F_block if self.F_mat is not None else None)
+
+  def update(self, start, max_F, exceedances=None, F_mat=None):
+    """
+    Merge a block which has already been reduced, e.g. by a worker process
+    """
+    stop = start + len(max_F)
+    self.max_F[start + 1:stop + 1] = max_F
+    if self.exceedances is not None and exceedances is not None:
+      self.exceedances += exceedances
+    if self.F_mat is not None and F_mat is not None:
+      self.F_mat[start + 1:stop + 1] = F_mat
+    self.n_done += len(max_F)
+
+  def fwe_counts(self):
+    """
+    Number of permutations (including F_ref) whose maximum F over all genes is at least F_ref of the gene
+    Returns:
+    numpy.ndarray: one count per gene
+    """
+    n = self.n_done + 1
+    sorted_max_F = np.sort(self.max_F[:n])
+    return n - np.searchsorted(sorted_max_F, self.F_threshold, side='left')
+
+  def fwe_corrected_p(self):
+    """
+    Fraction of permutations (including F_ref) whose maximum F over all genes is at least F_ref of the gene
+    Returns:
+    numpy.ndarray: one p value per gene
+    """
+    return self.fwe_counts() / (self.n_done + 1)
+
+  def uncorrected_p(self):
+    """
+    Fraction of permutations (including F_ref) in which the F of the gene is at least its F_ref
+    Returns:
+    numpy.ndarray: one p value per gene, or None if exceedances are not counted
+    """
+    if self.exceedances is None:
+      return None
+    return self.exceedances / (self.n_done + 1)
+
+def sequential_decision(counts, n, alpha, error=1e-3):
+  """
+  Decide whether permutation p values are below or above alpha, given the permutations run so far, in the spirit of Besag and Clifford's sequential Monte Carlo p values. A p value is decided once the two sided Clopper-Pearson interval with coverage 1 - error, for the exceedance probability estimated by counts / n, excludes alpha.
+  Args:
+  counts (numpy.ndarray): number of permutations with a statistic at least as large as the observed one, per gene
+  n (int): number of permutations (including the unpermuted one)
+  alpha (float): significance level
+  error (float): probability of a wrong decision for a single look at the data. When the decision is re-tested after every round of permutations, divide the overall error by the number of rounds
+  Returns:
+  numpy.ndarray: per gene, 1 if p < alpha, -1 if p > alpha, 0 if still undecided
+  """
+  counts = np.asarray(counts, dtype=np.float64)
+  with np.errstate(invalid='ignore'):
+    lower = np.where(counts > 0, stats.beta.ppf(error / 2, counts, n - counts + 1), 0.)
+    upper = np.where(counts < n, stats.beta.ppf(1 - error / 2, counts + 1, n - counts), 1.)
+  return np.where(upper < alpha, 1, np.where(lower > alpha, -1, 0))
+
+def gpd_tail_p(null, observed, n_exceedances=250, min_count=10, gof_alpha=0.05, min_exceedances=30, min_p=None):
+  """
+  Permutation p values with a generalized Pareto approximation of the upper tail of the null distribution (Knijnenburg et al. 2009, Fewer permutations, more accurate P-values). This resolves p values below 1 / len(null).
+
+  The empirical p value (count + 1) / (len(null) + 1), which counts the observed value as one of the permutations and is never 0, is used for observed values exceeded at least min_count times in the null. For the others, a generalized Pareto distribution is fitted to the n_exceedances largest values of the null. If a Kolmogorov-Smirnov test rejects the fit at gof_alpha, the number of exceedances is reduced by 10 and the fit repeated, down to min_exceedances. If no fit is accepted, the empirical p values are kept.
+
+  A fit with negative shape has a finite upper endpoint, beyond which its tail probability is 0. Observed values beyond the endpoint keep their empirical p value. Extrapolated p values are clamped to min_p, by default 1 / (len(null) + 1)**2, i.e. at most len(null) + 1 times below the smallest empirical p value, since the tail fit says little about values much further out.
+  Args:
+  null (numpy.ndarray): null distribution, e.g. the maximum F of every permutation
+  observed (numpy.ndarray): observed statistics, e.g. F_ref
+  min_p (float): optional, lower bound of the extrapolated p values
+  Returns:
+  tuple: (p values, dict of diagnostics) with keys -
+    fitted - True if a tail fit was accepted
+    method - per observed value, 'gpd' or 'empirical'
+    beyond_endpoint - per observed value, True if it is beyond the upper endpoint of the fit, and keeps its empirical p value
+    clamped - per observed value, True if its extrapolated p value was raised to min_p
+    min_p - lower bound of the extrapolated p values
+    shape, scale, threshold, n_exceedances, gof_pvalue - parameters and goodness of fit p value of the last fit tried, None if no fit was tried
+  """
+  null = np.sort(np.asarray(null, dtype=np.float64))
+  observed = np.asarray(observed, dtype=np.float64)
+  n = len(null)
+  counts = n - np.searchsorted(null, observed, side='left')
+  p = (counts + 1) / (n + 1)
+  use_tail = counts < min_count
+  if min_p is None:
+    min_p = 1 / (n + 1)**2
+
+  diagnostics = {
+    'fitted': False,
+    'method': np.where(use_tail, 'gpd', 'empirical'),
+    'beyond_endpoint': np.zeros(len(observed), dtype=bool),
+    'clamped': np.zeros(len(observed), dtype=bool),
+    'min_p': min_p,
+    'shape': None,
+    'scale': None,
+    'threshold': None,
+    'n_exceedances': None,
+    'gof_pvalue': None
+  }
+  if not np.any(use_tail):
+    diagnostics['method'][:] = 'empirical'
+    return p, diagnostics
+
+  n_exc = min(n_exceedances, n // 4)
+  while n_exc >= min_exceedances:
+    # threshold halfway between the largest value not in the tail and the smallest exceedance
+    threshold = (null[n - n_exc - 1] + null[n - n_exc]) / 2
+    exceedances = null[n - n_exc:] - threshold
+    shape, _, scale = stats.genpareto.fit(exceedances, floc=0)
+    gof_pvalue = stats.kstest(exceedances, 'genpareto', args=(shape, 0, scale)).pvalue
+    diagnostics.update(shape=shape, scale=scale, threshold=threshold, n_exceedances=n_exc, gof_pvalue=gof_pvalue)
+    if gof_pvalue >= gof_alpha:
+      diagnostics['fitted'] = True
+      break
+    n_exc -= 10
+
+  if not diagnostics['fitted']:
+    diagnostics['method'][:] = 'empirical'
+    return p, diagnostics
+
+  # observed values below the threshold are exceeded by at least n_exceedances permutations
+  use_tail = use_tail & (observed > threshold)
+  tail_p = n_exc / n * stats.genpareto.sf(observed - threshold, shape, loc=0, scale=scale)
+  diagnostics['beyond_endpoint'] = use_tail & (tail_p <= 0)
+  use_tail = use_tail & (tail_p > 0)
+  diagnostics['clamped'] = use_tail & (tail_p < min_p)
+  diagnostics['method'] = np.where(use_tail, 'gpd', 'empirical')
+  p[use_tail] = np.maximum(tail_p[use_tail], min_p)
+  return p, diagnostics
@@ -0,0 +1,156 @@
+# Copyright 2020 Forschungszentrum Jülich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import abc
+import weakref
+import numpy as np
+from scipy.spatial import cKDTree
+
+class GeometricRoi(abc.ABC):
+  """
+  Region of interest given by its shape in MNI152 space (mm), instead of a probability map.
+
+  Samples inside the shape have probability 1, all others 0, so any filter_threshold below 1 selects the samples inside. Samples of a SampleTable are looked up in the k-d tree over the MNI152 coordinates of all its samples (see SampleTable.kdtree), which is built once and shared by all regions. Nothing is rasterized.
+
+  The voxel space of a geometric region is MNI152 itself (affine is the identity), so the coords of filter_coordinates_and_zscores are rounded MNI152 coordinates.
+
+  Usage:
+
+  PyjugexAnalysis(roi1=SphereRoi([-36, 24, 38], radius=10), roi2=BoxRoi([10, -20, 0], [30, 0, 20]), ...)
+  """
+  affine = np.eye(4)
+  inverse_affine = np.eye(4)
+
+  def __init__(self):
+    # rows per SampleTable
+    self._rows = weakref.WeakKeyDictionary()
+
+  @abc.abstractmethod
+  def contains(self, mni):
+    """
+    Args:
+    mni (numpy.ndarray): n x 3 coordinates in MNI152 space
+    Returns:
+    numpy.ndarray: mask of the coordinates inside the region
+    """
+
+  @abc.abstractmethod
+  def _query(self, kdtree):
+    """
+    Returns:
+    numpy.ndarray: indices of the points of kdtree which are inside the region, possibly with duplicates
+    """
+
+  def rows(self, sample_table):
+    """
+    Returns:
+    numpy.ndarray: sorted rows of the samples of sample_table inside the region
+    """
+    if sample_table not in self._rows:
+      self._rows[sample_table] = np.unique(np.asarray(self._query(sample_table.kdtree()), dtype=np.int64))
+    return self._rows[sample_table]
+
+  def probabilities(self, mni, sample_table=None, rows=None):
+    """
+    Args:
+    mni (numpy.ndarray): n x 3 coordinates of the samples in MNI152 space
+    sample_table (SampleTable): optional, table which contains the samples, at rows
+    rows (slice): rows of the samples in sample_table
+    Returns:
+    numpy.ndarray: 1 for the samples inside the region, 0 for the others
+    """
+    if sample_table is None:
+      return self.contains(np.asarray(mni, dtype=np.float64).reshape(-1, 3)).astype(np.float64)
+    inside = np.zeros(len(sample_table), dtype=np.float64)
+    inside[self.rows(sample_table)] = 1
+    return inside[rows]
+
+  def probabilities_at(self, voxel_coords, specimen_name=None, wells=None, sample_table=None, rows=None):
+    """
+    Same interface as RoiSampler.probabilities_at. The voxel space is MNI152, so voxel_coords are the MNI152 coordinates of the samples.
+    Returns:
+    tuple: n x 3 rounded MNI152 coordinates, and 1 for the samples inside the region, 0 for the others
+    """
+    return np.rint(voxel_coords).astype(int).reshape(-1, 3), self.probabilities(voxel_coords, sample_table, rows)
+
+class SphereRoi(GeometricRoi):
+  """
+  Samples within radius mm of center
+  """
+  def __init__(self, center, radius):
+    super().__init__()
+    self.center = np.asarray(center, dtype=np.float64).reshape(3)
+    self.radius = float(radius)
+
+  def contains(self, mni):
+    return np.linalg.norm(mni - self.center, axis=1) <= self.radius
+
+  def _query(self, kdtree):
+    return kdtree.query_ball_point(self.center, self.radius)
+
+class BoxRoi(GeometricRoi):
+  """
+  Samples inside the axis aligned box from lower to upper corner (inclusive)
+  """
+  def __init__(self, lower, upper):
+    super().__init__()
+    self.lower = np.asarray(lower, dtype=np.float64).reshape(3)
+    self.upper = np.asarray(upper, dtype=np.float64).reshape(3)
+    if np.any(self.upper < self.lower):
+      raise ValueError('upper corner of the box needs to be above the lower corner')
+
+  def contains(self, mni):
+    return np.all((mni >= self.lower) & (mni <= self.upper), axis=1)
+
+  def _query(self, kdtree):
+    # the cube around the center which contains the box, then the box itself
+    center = (self.lower + self.upper) / 2
+    candidates = np.asarray(kdtree.query_ball_point(center, np.max(self.upper - center), p=np.inf), dtype=np.int64)
+    return candidates[self.contains(kdtree.data[candidates].reshape(-1, 3))]
+
+class CoordinateRoi(GeometricRoi):
+  """
+  Samples within radius mm of any of the coordinates, e.g. the peak coordinates of a meta analysis
+  """
+  def __init__(self, coordinates, radius):
+    super().__init__()
+    self.coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 3)
+    self.radius = float(radius)
+
+  def contains(self, mni):
+    if len(self.coordinates) == 0:
+      return np.zeros(len(mni), dtype=bool)
+    # distance_upper_bound is exclusive, radius is inclusive as in query_ball_point
+    distances, _ = cKDTree(self.coordinates).query(mni, distance_upper_bound=np.nextafter(self.radius, np.inf))
+    return np.isfinite(distances)
+
+  def _query(self, kdtree):
+    if len(self.coordinates) == 0:
+      return []
+    return [row for rows in kdtree.query_ball_point(self.coordinates, self.radius) for row in rows]
+
+def geometric_roi(spec):
+  """
+  Args:
+  spec (dict): {'center': [x, y, z], 'radius': r}, {'lower': [x, y, z], 'upper': [x, y, z]} or {'coordinates': [[x, y, z], ...], 'radius': r}, in MNI152 mm
+  Returns:
+  GeometricRoi: sphere, box or coordinate list
+  """
+  if 'center' in spec:
+    return SphereRoi(spec['center'], spec['radius'])
+  if 'lower' in spec and 'upper' in spec:
+    return BoxRoi(spec['lower'], spec['upper'])
+  if 'coordinates' in spec:
+    return CoordinateRoi(spec['coordinates'], spec['radius'])
+  raise ValueError('a geometric region of interest needs center and radius, lower and upper, or coordinates and radius')
@@ -0,0 +1,126 @@
+# Copyright 2020 Forschungszentrum Jülich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import numpy as np
+from scipy.special import comb
+
+def count_distinct_labelings(labels):
+  """
+  Number of distinct relabellings of labels, i.e. the multinomial coefficient n! / (n_1! ... n_k!)
+  Returns:
+  int: number of distinct labelings, including labels itself
+  """
+  _, counts = np.unique(np.asarray(labels), return_counts=True)
+  n_labelings, remaining = 1, int(counts.sum())
+  for count in counts:
+    n_labelings *= comb(remaining, int(count), exact=True)
+    remaining -= int(count)
+  return n_labelings
+
+def _distinct_labelings(codes):
+  """
+  Yield every distinct arrangement of the integer codes 0 ... k-1, each with the same count as in codes
+  """
+  counts = np.bincount(codes)
+  n = len(codes)
+
+  def assign(level, free, labeling):
+    if level == len(counts) - 1:
+      labeling[free] = level
+      yield labeling.copy()
+      return
+    for chosen in itertools.combinations(free, counts[level]):
+      labeling[list(chosen)] = level
+      yield from assign(level + 1, [position for position in free if position not in chosen], labeling)
+
+  yield from assign(0, list(range(n)), np.zeros(n, dtype=codes.dtype))
+
+class PermutationPlan:
+  """
+  Reproducible relabellings of Area used by the FWE correction.
+
+  Row r of permutations is the index array used in permutation r, for every gene. The rows are generated in fixed size chunks, each from its own child of a numpy.random.SeedSequence, so that the plan only depends on seed, n_samples and n_perm, never on how the work is split between blocks or workers.
+
+  Usage:
+
+  plan = PermutationPlan(n_samples=23, n_perm=999, seed=42)
+  plan.block(0, 256) # first 256 permutations
+  plan.seed # entropy to pass as seed to reproduce a plan created with seed=None
+
+  PermutationPlan.exhaustive(labels) instead enumerates every distinct relabelling once, for exact permutation tests.
+  """
+  chunk_size = 1024
+
+  def __init__(self, n_samples, n_perm, seed=None):
+    if n_samples < 1 or n_perm < 0:
+      raise ValueError('n_samples needs to be positive and n_perm non negative')
+
+    self.n_samples = n_samples
+    self.n_perm = n_perm
+    self.exact = False
+    self.seed_sequence = np.random.SeedSequence(seed)
+    self.seed = self.seed_sequence.entropy
+    self.dtype = np.uint16 if n_samples <= np.iinfo(np.uint16).max + 1 else np.uint32
+
+    self.permutations = np.empty((n_perm, n_samples), dtype=self.dtype)
+    n_chunks = -(-n_perm // self.chunk_size)
+    for index, child in enumerate(self.seed_sequence.spawn(n_chunks)):
+      start = index * self.chunk_size
+      stop = min(start + self.chunk_size, n_perm)
+      rng = np.random.default_rng(child)
+      self.permutations[start:stop] = np.argsort(rng.random((stop - start, n_samples)), axis=1)
+
+    # shared with workers, never modified
+    self.permutations.setflags(write=False)
+
+  @classmethod
+  def exhaustive(cls, labels):
+    """
+    Plan with one permutation for every distinct relabelling of labels, except labels itself (which is the unpermuted row 0 of the FWE correction). Relabellings which only swap samples with the same label are not repeated.
+    Args:
+    labels (list): e.g. the Area factor
+    Returns:
+    PermutationPlan: plan with count_distinct_labelings(labels) - 1 permutations
+    """
+    _, codes = np.unique(np.asarray(labels), return_inverse=True)
+    codes = codes.reshape(-1)
+    n_samples = len(codes)
+
+    plan = cls.__new__(cls)
+    plan.n_samples = n_samples
+    plan.exact = True
+    plan.seed_sequence = None
+    plan.seed = None
+    plan.dtype = np.uint16 if n_samples <= np.iinfo(np.uint16).max + 1 else np.uint32
+
+    labelings = np.array([labeling for labeling in _distinct_labelings(codes) if not np.array_equal(labeling, codes)], dtype=codes.dtype).reshape(-1, n_samples)
+    plan.n_perm = len(labelings)
+
+    # permutation p with codes[p] == labeling: the samples of each label, in order, go to the positions of that label in the labeling
+    plan.permutations = np.empty((plan.n_perm, n_samples), dtype=plan.dtype)
+    np.put_along_axis(plan.permutations, np.argsort(labelings, axis=1, kind='stable'), np.argsort(codes, kind='stable')[np.newaxis, :], axis=1)
+    plan.permutations.setflags(write=False)
+    return plan
+
+  def __len__(self):
+    return self.n_perm
+
+  def block(self, start, stop):
+    """
+    Permutations start (inclusive) to stop (exclusive)
+    Returns:
+    numpy.ndarray: (stop - start) x n_samples read only array of index arrays
+    """
+    return self.permutations[start:stop]
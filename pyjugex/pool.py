@@ -0,0 +1,241 @@
+# Copyright 2020 Forschungszentrum Jülich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import atexit
+import multiprocessing
+import os
+import numpy as np
+
+try:
+  from multiprocessing import shared_memory
+except ImportError:
+  # python < 3.8
+  shared_memory = None
+
+from .design import AnovaDesign
+from .error import NotYetImplementedError
+
+def _share(arr):
+  """
+  Copy arr into a new shared memory block
+  Returns:
+  tuple: (SharedMemory, dict describing the block, to be passed to _attach)
+  """
+  arr = np.ascontiguousarray(arr)
+  shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+  np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+  return shm, {'name': shm.name, 'shape': arr.shape, 'dtype': arr.dtype.str}
+
+def _attach(spec):
+  """
+  Attach to a shared memory block created by _share
+  Returns:
+  tuple: (SharedMemory, numpy.ndarray view of the block)
+  """
+  shm = shared_memory.SharedMemory(name=spec['name'])
+  return shm, np.ndarray(spec['shape'], dtype=np.dtype(spec['dtype']), buffer=shm.buf)
+
+def _area_f_chunk(specs, block_size, chunk_index, start, stop):
+  """
+  Runs in a worker. Compute permutations start to stop of the plan shared in specs and write the reduced F values into the shared output buffers: the maximum over genes per permutation, the exceedance counts of this chunk and, if shared, the full F matrix.
+  """
+  shms, arrays = {}, {}
+  design = projected = None
+  try:
+    for key, spec in specs.items():
+      shms[key], arrays[key] = _attach(spec)
+    design = AnovaDesign.from_encoded(arrays['area'], arrays['nuisance_basis'])
+    projected = {key: arrays[key] for key in ('centered', 'resid', 'ss_resid')}
+    for block_start in range(start, stop, block_size):
+      block_stop = min(block_start + block_size, stop)
+      F_block = design.area_f_block(projected, arrays['permutations'][block_start:block_stop])
+      arrays['max_F'][block_start:block_stop] = F_block.max(axis=1, initial=-np.inf)
+      arrays['exceedances'][chunk_index] += np.count_nonzero(F_block >= arrays['F_threshold'], axis=0)
+      if 'F_mat' in arrays:
+        arrays['F_mat'][block_start:block_stop] = F_block
+  finally:
+    # views need to be released before the blocks can be closed
+    del design, projected
+    arrays.clear()
+    for shm in shms.values():
+      shm.close()
+
+class SharedAnalysis:
+  """
+  The design, projected zscores and permutation plan of one analysis, and the output buffers of its permutations, in shared memory. Created with WorkerPool.share, once per analysis, and passed to WorkerPool.accumulate for every round of permutations. The blocks are released by close().
+  """
+  def __init__(self, design, projected, permutations, accumulator, n_chunks):
+    n_perm, n_genes = len(permutations), len(projected['ss_resid'])
+    arrays = {
+      'area': design.area,
+      'nuisance_basis': design.nuisance_basis,
+      'centered': projected['centered'],
+      'resid': projected['resid'],
+      'ss_resid': projected['ss_resid'],
+      'permutations': permutations,
+      'F_threshold': accumulator.F_threshold,
+      'max_F': np.zeros(n_perm),
+      'exceedances': np.zeros((n_chunks, n_genes), dtype=np.int64)
+    }
+    if accumulator.F_mat is not None:
+      arrays['F_mat'] = np.zeros((n_perm, n_genes))
+
+    self.n_perm = n_perm
+    self.n_chunks = n_chunks
+    self.shms, self.specs = {}, {}
+    try:
+      for key, arr in arrays.items():
+        self.shms[key], self.specs[key] = _share(arr)
+    except BaseException:
+      self.close()
+      raise
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def output(self, key):
+    """
+    Returns:
+    numpy.ndarray: view of the output buffer max_F, exceedances or F_mat
+    """
+    spec = self.specs[key]
+    return np.ndarray(spec['shape'], dtype=np.dtype(spec['dtype']), buffer=self.shms[key].buf)
+
+  def close(self):
+    for shm in self.shms.values():
+      shm.close()
+      shm.unlink()
+    self.shms.clear()
+
+def _call_chunk(obj, method, start, stop):
+  return start, getattr(obj, method)(start, stop)
+
+def _star_call_chunk(args):
+  return _call_chunk(*args)
+
+class WorkerPool:
+  """
+  Persistent pool of worker processes for the FWE correction, which can be reused by many analyses.
+
+  For the numpy engine, the design, the projected zscores and the permutation plan are placed in shared memory once per analysis (see share), also when the permutations are run in several rounds. Workers only receive the names of the shared blocks and a range of permutation indices, and write the reduced F values into shared output buffers.
+
+  Usage:
+
+  with WorkerPool(n_workers=4) as pool:
+    anova = PyjugexAnova(..., worker_pool=pool)
+    anova.run()
+  """
+  def __init__(self, n_workers=None):
+    self.n_workers = n_workers or os.cpu_count()
+    self._pool = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __getstate__(self):
+    # the processes stay with the parent, e.g. when an analysis holding the pool is sent to a worker
+    return {'n_workers': self.n_workers, '_pool': None}
+
+  @property
+  def pool(self):
+    if self._pool is None:
+      self._pool = multiprocessing.Pool(self.n_workers)
+    return self._pool
+
+  def chunks(self, n):
+    """
+    Split range(n) into a few contiguous chunks per worker
+    Returns:
+    list: list of (start, stop) tuples
+    """
+    bounds = np.linspace(0, n, min(n, 4 * self.n_workers) + 1).astype(int)
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+  def share(self, design, projected, permutations, accumulator):
+    """
+    Place the inputs of the permutations of one analysis in shared memory, see SharedAnalysis
+    Args:
+    design (AnovaDesign): encoded design
+    projected (dict): output of design.project()
+    permutations (numpy.ndarray): n_permutations x n_samples array of index arrays, e.g. PermutationPlan.permutations
+    accumulator (MaxFAccumulator): accumulator of the analysis, for its F_threshold and whether it keeps the full F matrix
+    Returns:
+    SharedAnalysis: to be passed to accumulate, and closed after the last round
+    """
+    if shared_memory is None:
+      raise NotYetImplementedError('WorkerPool.share requires multiprocessing.shared_memory (python 3.8 or later)')
+    return SharedAnalysis(design, projected, permutations, accumulator, n_chunks=4 * self.n_workers)
+
+  def accumulate(self, shared, accumulator, start=0, stop=None, block_size=256):
+    """
+    Compute AnovaDesign.area_f_block for permutations start to stop of a shared analysis, split across the workers, and merge the result into accumulator. Only the names of the shared blocks and the permutation ranges are sent to the workers.
+    Args:
+    shared (SharedAnalysis): output of share()
+    accumulator (MaxFAccumulator): receives the maximum F per permutation, the exceedance counts and, if it keeps it, the full F matrix
+    start (int): first permutation, also its index in the accumulator
+    stop (int): optional, end of the permutations, by default all permutations of the plan
+    block_size (int): number of permutations per matrix product inside a worker
+    """
+    stop = shared.n_perm if stop is None else stop
+    chunks = [(start + chunk_start, start + chunk_stop) for chunk_start, chunk_stop in self.chunks(stop - start)]
+    exceedances = shared.output('exceedances')
+    exceedances[...] = 0
+    self.pool.starmap(_area_f_chunk, [(shared.specs, block_size, chunk_index, chunk_start, chunk_stop) for chunk_index, (chunk_start, chunk_stop) in enumerate(chunks)])
+    F_mat = shared.output('F_mat')[start:stop].copy() if 'F_mat' in shared.specs else None
+    accumulator.update(start, shared.output('max_F')[start:stop].copy(), exceedances=exceedances.sum(axis=0), F_mat=F_mat)
+
+  def imap_chunks(self, obj, method, n, offset=0):
+    """
+    Call obj.method(start, stop) for chunks of range(offset, offset + n) in the workers. obj is pickled once per chunk, not once per item.
+    Returns:
+    iterator: (start, result) for every chunk, in order
+    """
+    return self.pool.imap(_star_call_chunk, [(obj, method, offset + start, offset + stop) for start, stop in self.chunks(n)])
+
+  def map_chunks(self, obj, method, n):
+    """
+    Same as imap_chunks, but waits for all chunks
+    Returns:
+    list: concatenated results of all chunks
+    """
+    return [item for start, result in self.imap_chunks(obj, method, n) for item in result]
+
+  def close(self):
+    if self._pool is not None:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+
+_worker_pools = {}
+
+def get_worker_pool(n_workers=None):
+  """
+  Worker pool shared by all analyses of this process with the same number of workers. It is created on first use and closed at exit.
+  """
+  n_workers = n_workers or os.cpu_count()
+  if n_workers not in _worker_pools:
+    _worker_pools[n_workers] = WorkerPool(n_workers)
+  return _worker_pools[n_workers]
+
+@atexit.register
+def close_worker_pools():
+  for worker_pool in _worker_pools.values():
+    worker_pool.close()
+  _worker_pools.clear()
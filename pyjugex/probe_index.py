@@ -0,0 +1,129 @@
+# Copyright 2020 Forschungszentrum Jülich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import csv
+import datetime
+import os
+import numpy as np
+
+INDEX_FORMAT_VERSION = 2
+INDEX_PATH = os.path.join(os.path.dirname(__file__), 'data', 'gene_probe_index.npz')
+
+class ProbeIndex:
+  """
+  Gene symbol to probe id index of the HumanMA DNA probes of Allen Brain API.
+
+  The index is stored as flat arrays: the sorted ascii gene symbols, the probe ids of all genes one after the other, and per gene the offset of its first probe id. A gene is looked up with a binary search. pyjugex does not ship an index. Build it from Probes.csv of the Allen Human Brain Atlas microarray download, which lists the same DNA probes of the HumanMA platform as the probe query of util.from_brainmap_retrieve_gene:
+
+  python -m pyjugex.probe_index normalized_microarray_donor9861/Probes.csv
+
+  Usage:
+
+  index = get_probe_index()
+  'MAOA' in index # gene symbol in the index
+  index.get_probe_ids('MAOA') # list of probe ids, None if the gene is not in the index (retrieve them from Allen Brain API then)
+  """
+  def __init__(self, genes, offsets, probe_ids, version=INDEX_FORMAT_VERSION, source='', created=''):
+    if int(version) != INDEX_FORMAT_VERSION:
+      raise ValueError('probe index format {} is not supported, expected {}. Rebuild it with python -m pyjugex.probe_index'.format(version, INDEX_FORMAT_VERSION))
+    self.genes = np.asarray(genes).astype(np.bytes_)
+    self.offsets = np.asarray(offsets, dtype=np.int64)
+    self.probe_ids = np.asarray(probe_ids, dtype=np.int64)
+    self.version = int(version)
+    self.source = str(source)
+    self.created = str(created)
+
+  @classmethod
+  def from_mapping(cls, gene_to_probe_ids, source=''):
+    """
+    Args:
+    gene_to_probe_ids (dict): probe ids per gene symbol
+    Returns:
+    ProbeIndex: index of gene_to_probe_ids
+    """
+    genes = np.unique(list(gene_to_probe_ids.keys()))
+    probe_lists = [[int(probe_id) for probe_id in gene_to_probe_ids[gene]] for gene in genes]
+    offsets = np.concatenate([[0], np.cumsum([len(probe_list) for probe_list in probe_lists])])
+    probe_ids = np.array([probe_id for probe_list in probe_lists for probe_id in probe_list], dtype=np.int64)
+    return cls(genes, offsets, probe_ids, source=source, created=datetime.datetime.utcnow().isoformat())
+
+  @classmethod
+  def load(cls, path):
+    with np.load(path, allow_pickle=False) as f:
+      return cls(f['genes'], f['offsets'], f['probe_ids'], version=f['version'], source=f['source'], created=f['created'])
+
+  def save(self, path):
+    np.savez_compressed(path, genes=self.genes, offsets=self.offsets, probe_ids=self.probe_ids, version=self.version, source=self.source, created=self.created)
+
+  def _find(self, gene):
+    gene = gene.encode('ascii', errors='replace') if isinstance(gene, str) else gene
+    position = np.searchsorted(self.genes, gene)
+    if position < len(self.genes) and self.genes[position] == gene:
+      return position
+    return None
+
+  def __contains__(self, gene):
+    return self._find(gene) is not None
+
+  def __len__(self):
+    return len(self.genes)
+
+  def get_probe_ids(self, gene):
+    """
+    Returns:
+    list: probe ids of gene as strings, None if gene is not in the index
+    """
+    position = self._find(gene)
+    if position is None:
+      return None
+    return [str(probe_id) for probe_id in self.probe_ids[self.offsets[position]:self.offsets[position + 1]]]
+
+def read_probes_csv(path):
+  """
+  Read gene symbols and probe ids from Probes.csv of the Allen Human Brain Atlas microarray download, with columns probe_id and gene_symbol
+  Returns:
+  dict: probe ids per gene symbol
+  """
+  gene_to_probe_ids = {}
+  with open(path, newline='') as f:
+    for row in csv.DictReader(f):
+      gene_to_probe_ids.setdefault(row['gene_symbol'], []).append(row['probe_id'])
+  return gene_to_probe_ids
+
+_probe_index = None
+
+def get_probe_index():
+  """
+  Index built with python -m pyjugex.probe_index, loaded on first use
+  Returns:
+  ProbeIndex: index, None if it has not been built
+  """
+  global _probe_index
+  if _probe_index is None and os.path.exists(INDEX_PATH):
+    _probe_index = ProbeIndex.load(INDEX_PATH)
+  return _probe_index
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Build the gene symbol to probe id index from Probes.csv of the Allen Human Brain Atlas microarray download')
+  parser.add_argument('probes', help='Probes.csv')
+  parser.add_argument('-o', '--output', default=INDEX_PATH)
+  args = parser.parse_args(argv)
+
+  index = ProbeIndex.from_mapping(read_probes_csv(args.probes), source=os.path.basename(args.probes))
+  index.save(args.output)
+  print('{} genes ({} probes) written to {}'.format(len(index), len(index.probe_ids), args.output))
+
+if __name__ == '__main__':
+  main()
@@ -15,11 +15,13 @@
 from .util import (
   get_mean_zscores,
   filter_coordinates_and_zscores,
-  from_brainmap_retrieve_gene,
+  get_probe_ids,
   from_brainmap_retrieve_specimen,
   from_brainmap_on_genes_retrieve_data,
   from_brainmap_retrieve_specimen_factors,
-  from_brainmap_retrieve_microarray_filterby_donorids_probeids
+  from_brainmap_retrieve_microarray_filterby_donorids_probeids,
+  gene_matrix_available,
+  get_region
 )
 
 from .error import (
@@ -27,7 +29,8 @@ from .error import (
   ValueMissingError
 )
 from .anova import PyjugexAnova
-import json
+from .roi import RoiSampler
+from .geometry import geometric_roi
 import numpy as np
 
 class PyjugexAnalysis:
@@ -45,17 +48,30 @@ class PyjugexAnalysis:
 
   # or set them after init
   new_analysis.roi2 = nii2
+
+  # with a RegionIndex (see util.set_region_index), regions can be given by name instead of their probability maps
+  new_analysis.roi2 = 'Area Fp1 (FPole)'
+
+  # or by their shape in MNI152 space, see geometry.GeometricRoi
+  new_analysis.roi2 = {'center': [-36, 24, 38], 'radius': 10}
   new_analysis.single_proble.mode = True
 
   # carry out analysis, this may take awhile
   result = new_analysis.differential_analysis()
 
   # the result is also stored in the analysis instance, but will be overwritten if a new differential_analysis is called
+  # it is keyed by threshold, also for a single filter_threshold:
+  # {0.2: {'result': {gene: FWE corrected p}, 'uncorrected_p': {gene: p}, 'n_samples': {'img1': n, 'img2': n}}}
   print(new_analysis.result)
+
+  # several thresholds at once, sampling and aggregating the zscores only once. The permutations are still run once per threshold
+  new_analysis.filter_threshold = [0.2, 0.3, 0.5]
+  result = new_analysis.differential_analysis() # one result per threshold
   """
 
-  def __init__(self, n_rep=1000, filter_threshold=0.2, single_probe_mode=False, roi1=None, roi2=None, gene_list=[], verbose=False):
+  def __init__(self, n_rep=1000, filter_threshold=0.2, single_probe_mode=False, roi1=None, roi2=None, gene_list=[], verbose=False, seed=None):
     self.n_rep=n_rep
+    self.seed=seed
     self.filter_threshold=filter_threshold
     self.single_probe_mode=single_probe_mode
     self.verbose=verbose
@@ -64,6 +80,25 @@ class PyjugexAnalysis:
     self.roi2=roi2
 
     self.anova = None
+    self.anovas = None
+    self.result = None
+
+  @property
+  def roi1(self):
+    return self._roi1
+
+  @roi1.setter
+  def roi1(self, roi):
+    # resolved once, so that the samples found in a geometric region are reused by every analysis
+    self._roi1 = geometric_roi(roi) if isinstance(roi, dict) else roi
+
+  @property
+  def roi2(self):
+    return self._roi2
+
+  @roi2.setter
+  def roi2(self, roi):
+    self._roi2 = geometric_roi(roi) if isinstance(roi, dict) else roi
 
   @staticmethod
   def get_gene_list():
@@ -87,19 +122,34 @@ class PyjugexAnalysis:
       raise ValueMissingError(','.join(error_message))
     return True
 
+  @staticmethod
+  def _roi_sampler(roi):
+    """
+    Returns:
+    RoiSampler, IndexedRegion or GeometricRoi: region of interest given as probability map, RoiSampler, IndexedRegion, GeometricRoi or name of a region of the RegionIndex. Dicts describing a GeometricRoi are resolved when they are assigned to roi1 or roi2.
+    """
+    if isinstance(roi, str):
+      return get_region(roi)
+    return RoiSampler.of(roi)
+
   def get_filtered_coord(self):
     """
     TODO write doc
     """
 
-    gene_symbols = get_gene_symbols(self.gene_list)
-    samples_zscores_and_specimen_dict = from_brainmap_on_genes_retrieve_data(genes=self.gene_list)
+    gene_level = gene_matrix_available()
+    samples_zscores_and_specimen_dict = from_brainmap_on_genes_retrieve_data(genes=self.gene_list, gene_level=gene_level)
 
     filtered_coords_and_zscores = self.get_filtered_coords_and_zscores(samples_zscores_and_specimen_dict)
     combined_zscores = [roi_coord_and_zscore['zscores'][i] for roi_coord_and_zscore in filtered_coords_and_zscores for i in range(len(roi_coord_and_zscore['zscores']))]
-    genesymbol_and_mean_zscores = get_mean_zscores(gene_symbols, combined_zscores)
+    if gene_level:
+      # already winsorized means per gene
+      genesymbol_and_mean_zscores = {'uniqueId': np.unique(self.gene_list), 'combined_zscores': np.array(combined_zscores)}
+    else:
+      genesymbol_and_mean_zscores = get_mean_zscores(get_gene_symbols(self.gene_list), combined_zscores)
 
     areainfo = {}
+    roi1_affine = self._roi_sampler(self.roi1).affine if isinstance(self.roi1, str) else self.roi1.affine
 
     for roi_coord_zscore in filtered_coords_and_zscores:
       key = roi_coord_zscore['realname']
@@ -107,18 +157,37 @@ class PyjugexAnalysis:
         areainfo[key] = []
       i = 0
       for c in roi_coord_zscore['coords']:
-        areainfo[key].append({'xyz' : np.transpose(np.matmul(self.roi1.affine,np.transpose(np.append(c,1))))[0:3].tolist(), 'winsorzed_mean' : genesymbol_and_mean_zscores['combined_zscores'][i].tolist()})
+        areainfo[key].append({'xyz' : np.transpose(np.matmul(roi1_affine,np.transpose(np.append(c,1))))[0:3].tolist(), 'winsorzed_mean' : genesymbol_and_mean_zscores['combined_zscores'][i].tolist()})
         #areainfo[key].append({'xyz' : c.tolist(), 'winsorzed_mean' : self.genesymbol_and_mean_zscores['combined_zscores'][i].tolist()})
         i = i+1
 
     return areainfo
 
-  def get_filtered_coords_and_zscores(self, samples_zscores_and_specimen_dict):
+  def _get_thresholds(self):
+    """
+    Returns:
+    list: filter_threshold as a list of float thresholds
+    """
+    if isinstance(self.filter_threshold, (list, tuple, np.ndarray)):
+      if len(self.filter_threshold) == 0:
+        raise ValueMissingError('filter_threshold is empty')
+      return [float(threshold) for threshold in self.filter_threshold]
+    return [float(self.filter_threshold)]
+
+  def get_filtered_coords_and_zscores(self, samples_zscores_and_specimen_dict, filter_threshold=None):
+    """
+    Args:
+    filter_threshold (float): optional, by default the lowest of filter_threshold
+    """
+    if filter_threshold is None:
+      filter_threshold = min(self._get_thresholds())
 
     filtered_coords_and_zscores = []
+    # each map is loaded once, not once per donor
+    roi_samplers = [self._roi_sampler(self.roi1), self._roi_sampler(self.roi2)]
 
     for o_index, specimen_info in enumerate(samples_zscores_and_specimen_dict['specimen_info']):
-      for index, roi in enumerate([self.roi1, self.roi2]):
+      for index, roi in enumerate(roi_samplers):
         filtered_coords_and_zscores.append(
           filter_coordinates_and_zscores(
             roi_nii=roi,
@@ -126,7 +195,7 @@ class PyjugexAnalysis:
             index=index,
             index_to_samples_zscores_and_specimen_dict=samples_zscores_and_specimen_dict['samples_and_zscores'][o_index],
             specimen=specimen_info,
-            filter_threshold=self.filter_threshold
+            filter_threshold=filter_threshold
           )
         )
     return filtered_coords_and_zscores
@@ -134,38 +203,89 @@ class PyjugexAnalysis:
   def differential_analysis(self):
     """
     Start differential analysis
+
+    filter_threshold can be a list of thresholds. The regions of interest are then sampled and the zscores aggregated only once, for the samples above the lowest threshold; the samples of every other threshold are a subset of these. Only the sampling and winsorizing are shared: every threshold has its own samples, so its ANOVA runs all n_rep permutations, and k thresholds cost k permutation runs. All thresholds use the same seed, so thresholds which select the same number of samples are tested with the same relabellings, and a threshold which selects the same samples as an earlier one reuses its result. A threshold which leaves img1 or img2 without samples is not tested, its p values are NaN.
+    Returns:
+    dict: per threshold (as float), also for a single filter_threshold, the FWE corrected p values (result), the uncorrected p values and the number of samples in each region of interest. self.anovas holds the PyjugexAnova of every threshold (None if it was not tested), self.anova the one of the first threshold.
     """
     self._check_prereq()
+    thresholds = self._get_thresholds()
 
-    samples_zscores_and_specimen_dict = from_brainmap_on_genes_retrieve_data(genes=self.gene_list)
+    # with a precomputed gene matrix, zscores are already aggregated per gene
+    gene_level = gene_matrix_available()
+    samples_zscores_and_specimen_dict = from_brainmap_on_genes_retrieve_data(genes=self.gene_list, gene_level=gene_level)
 
-    filtered_coords_and_zscores = self.get_filtered_coords_and_zscores(samples_zscores_and_specimen_dict)
+    filtered_coords_and_zscores = self.get_filtered_coords_and_zscores(samples_zscores_and_specimen_dict, filter_threshold=min(thresholds))
 
     specimen_factors = from_brainmap_retrieve_specimen_factors()
     specimen=[roi_coord_and_zscore['specimen'] for roi_coord_and_zscore in filtered_coords_and_zscores for i in range(len(roi_coord_and_zscore['zscores']))]
 
     # Both Age and Race should have len(self.filtered_coords_and_zscores) entries. The following three lines are used to get the correct values from specimenFactors['Age'] and specimenFactors['Race'] using specimenFactors['name'] and repeat them the required number of times as given by self.anova_factors['Specimen']
     combined_zscores = [roi_coord_and_zscore['zscores'][i] for roi_coord_and_zscore in filtered_coords_and_zscores for i in range(len(roi_coord_and_zscore['zscores']))]
-
-    gene_symbols = get_gene_symbols(self.gene_list)
-
-    self.anova = PyjugexAnova(
-      area=[roi_coord_and_zscore['name'] for roi_coord_and_zscore in filtered_coords_and_zscores for i in range(len(roi_coord_and_zscore['zscores']))],
-      specimen=specimen,
-      age=[specimen_factors['age'][specimen_factors['name'].index(specimen_name)] for ind, specimen_name in enumerate(specimen)],
-      race=[specimen_factors['race'][specimen_factors['name'].index(specimen_name)] for ind, specimen_name in enumerate(specimen)],
-      gene_symbols=gene_symbols,
-      combined_zscores=combined_zscores,
-      n_rep=self.n_rep
-      )
-
-    # in webjugex, accumulate_roicoords_and_name gets called to return the relevant coord
-    self.anova.run()
+    area = np.array([roi_coord_and_zscore['name'] for roi_coord_and_zscore in filtered_coords_and_zscores for i in range(len(roi_coord_and_zscore['zscores']))], dtype=str)
+    age = np.array([specimen_factors['age'][specimen_factors['name'].index(specimen_name)] for specimen_name in specimen])
+    race = np.array([specimen_factors['race'][specimen_factors['name'].index(specimen_name)] for specimen_name in specimen])
+    specimen = np.array(specimen)
+    probabilities = np.concatenate([roi_coord_and_zscore['probabilities'] for roi_coord_and_zscore in filtered_coords_and_zscores])
+
+    # winsorized once, for the samples of all thresholds
+    if gene_level:
+      gene_symbols = list(np.unique(self.gene_list))
+      mean_zscores = np.array(combined_zscores, dtype=np.float64).reshape(len(combined_zscores), len(gene_symbols))
+    else:
+      genesymbol_and_mean_zscores = get_mean_zscores(get_gene_symbols(self.gene_list), combined_zscores)
+      gene_symbols, mean_zscores = list(genesymbol_and_mean_zscores['uniqueId']), np.asarray(genesymbol_and_mean_zscores['combined_zscores'])
+
+    # the same seed for all thresholds
+    seed = self.seed if self.seed is not None or len(thresholds) == 1 else np.random.SeedSequence().entropy
+
+    self.anovas = {}
+    self.result = {}
+    # threshold which was run first for a selection of rows
+    run_for_rows = {}
+    for threshold in thresholds:
+      rows = probabilities > threshold
+      n_samples = {name: int(np.sum(area[rows] == name)) for name in ['img1', 'img2']}
+      if min(n_samples.values()) == 0:
+        # no permutations for a threshold which leaves a region of interest without samples
+        self.anovas[threshold] = None
+        self.result[threshold] = {
+          'result': {gene: np.nan for gene in gene_symbols},
+          'uncorrected_p': {gene: np.nan for gene in gene_symbols},
+          'n_samples': n_samples
+        }
+        continue
+      key = rows.tobytes()
+      if key in run_for_rows:
+        # same samples and seed, so the same permutations and result
+        self.anovas[threshold] = self.anovas[run_for_rows[key]]
+        self.result[threshold] = dict(self.result[run_for_rows[key]])
+        continue
+      run_for_rows[key] = threshold
+      anova = PyjugexAnova(
+        area=area[rows].tolist(),
+        specimen=specimen[rows].tolist(),
+        age=age[rows].tolist(),
+        race=race[rows].tolist(),
+        n_rep=self.n_rep,
+        seed=seed,
+        gene_symbols=gene_symbols,
+        mean_zscores=mean_zscores[rows]
+        )
+      # in webjugex, accumulate_roicoords_and_name gets called to return the relevant coord
+      anova.run()
+      self.anovas[threshold] = anova
+      self.result[threshold] = {
+        'result': anova.result,
+        'uncorrected_p': anova.uncorrected_p,
+        'n_samples': n_samples
+      }
+    self.anova = self.anovas[thresholds[0]]
+    return self.result
 
 
 def get_gene_symbols(genes=[]):
   gene_symbols = []
   for gene in genes:
-    data=from_brainmap_retrieve_gene(gene=gene)
-    gene_symbols = gene_symbols + [gene for donor in data['Response']['probes']['probe']]
+    gene_symbols = gene_symbols + [gene for probe_id in get_probe_ids(gene)]
   return gene_symbols
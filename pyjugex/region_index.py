@@ -0,0 +1,215 @@
+# Copyright 2020 Forschungszentrum Jülich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import datetime
+import json
+import os
+import numpy as np
+from scipy import sparse
+
+from .roi import RoiSampler
+from .samples import mri_to_mni
+from .error import ValueMissingError
+
+INDEX_FORMAT_VERSION = 1
+
+class RegionIndex:
+  """
+  Probability of every atlas region at every Allen Brain sample, as a sparse samples x regions matrix.
+
+  Every probability map is sampled once, at the MNI152 coordinates of all samples of a SampleTable. Samples are identified by their donor and well id, so the index can be used with samples in any order, from Allen Brain API or from a MicroarrayStore. Resolving which samples of a donor are in a region, for any threshold, is then a lookup in one sparse column instead of downloading and sampling the map.
+
+  Usage:
+
+  index = RegionIndex.build(sample_table, {'Area Fp1 (FPole)': nib.load('fp1.nii.gz'), ...})
+  index.save('regions.npz')
+  region = RegionIndex.load('regions.npz').region('Area Fp1 (FPole)')
+  region.sample('H0351.1015', wells, filter_threshold=0.2) # mask of the samples in the region
+  """
+  def __init__(self, regions, probabilities, donor_names, donor, well, affines, version=INDEX_FORMAT_VERSION, source='', created=''):
+    if int(version) != INDEX_FORMAT_VERSION:
+      raise ValueError('region index format {} is not supported, expected {}. Rebuild it with python -m pyjugex.region_index'.format(version, INDEX_FORMAT_VERSION))
+    self.regions = [str(region) for region in regions]
+    self.probabilities = sparse.csc_matrix(probabilities, dtype=np.float32)
+    self.probabilities.eliminate_zeros()
+    self.probabilities.sort_indices()
+    self.donor_names = [str(donor_name) for donor_name in donor_names]
+    self.donor = np.asarray(donor, dtype=np.int64)
+    self.well = np.asarray(well, dtype=np.int64)
+    self.affines = np.asarray(affines, dtype=np.float64).reshape(-1, 4, 4)
+    self.version = int(version)
+    self.source = str(source)
+    self.created = str(created)
+
+    self._columns = {region: column for column, region in enumerate(self.regions)}
+    # samples sorted by (donor, well), for the lookup of rows
+    self._sample_keys = self.donor * (np.int64(1) << 32) + self.well
+    self._sample_order = np.argsort(self._sample_keys, kind='stable')
+    self._sorted_sample_keys = self._sample_keys[self._sample_order]
+
+  @classmethod
+  def build(cls, sample_table, probability_maps, source=''):
+    """
+    Args:
+    sample_table (SampleTable): samples of all donors
+    probability_maps (dict): nib.nifti1.Nifti1Image or RoiSampler per region name, or a list of (name, map) pairs. Maps are only loaded one at a time if the values are callables returning the map.
+    Returns:
+    RegionIndex: index of the maps at the samples of sample_table
+    """
+    items = probability_maps.items() if isinstance(probability_maps, dict) else probability_maps
+    regions, columns, affines = [], [], []
+    for region, probability_map in items:
+      roi_sampler = RoiSampler.of(probability_map() if callable(probability_map) else probability_map)
+      _, probabilities = roi_sampler.probabilities_at(mri_to_mni(sample_table.mni, roi_sampler.inverse_affine))
+      columns.append(sparse.csc_matrix(probabilities.astype(np.float32).reshape(-1, 1)))
+      regions.append(region)
+      affines.append(roi_sampler.affine)
+    probabilities = sparse.hstack(columns, format='csc') if columns else sparse.csc_matrix((len(sample_table), 0), dtype=np.float32)
+    return cls(regions, probabilities, sample_table.donor_names, sample_table.donor, sample_table.well, np.array(affines).reshape(-1, 4, 4), source=source, created=datetime.datetime.utcnow().isoformat())
+
+  @classmethod
+  def load(cls, path):
+    with np.load(path, allow_pickle=False) as f:
+      probabilities = sparse.csc_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+      return cls(f['regions'], probabilities, f['donor_names'], f['donor'], f['well'], f['affines'], version=f['version'], source=f['source'], created=f['created'])
+
+  def save(self, path):
+    np.savez_compressed(path, regions=np.array(self.regions), data=self.probabilities.data, indices=self.probabilities.indices, indptr=self.probabilities.indptr, shape=np.array(self.probabilities.shape), donor_names=np.array(self.donor_names), donor=self.donor, well=self.well, affines=self.affines, version=self.version, source=self.source, created=self.created)
+
+  def __contains__(self, region):
+    return region in self._columns
+
+  def __len__(self):
+    return len(self.regions)
+
+  def rows(self, specimen_name, wells):
+    """
+    Args:
+    specimen_name (str): name of the donor, e.g. H0351.1015
+    wells (list): well ids of samples of the donor
+    Returns:
+    numpy.ndarray: row of every sample in the index, -1 for samples which are not in the index
+    """
+    if specimen_name not in self.donor_names or len(self._sorted_sample_keys) == 0:
+      return np.full(len(wells), -1, dtype=np.int64)
+    keys = self.donor_names.index(specimen_name) * (np.int64(1) << 32) + np.asarray(wells, dtype=np.int64)
+    positions = np.minimum(np.searchsorted(self._sorted_sample_keys, keys), len(self._sorted_sample_keys) - 1)
+    return np.where(self._sorted_sample_keys[positions] == keys, self._sample_order[positions], -1)
+
+  def column(self, region):
+    """
+    Returns:
+    tuple: rows of the samples with a nonzero probability in region, and these probabilities
+    """
+    if region not in self._columns:
+      raise ValueMissingError('region {} is not in the region index'.format(region))
+    column = self._columns[region]
+    start, stop = self.probabilities.indptr[column], self.probabilities.indptr[column + 1]
+    return self.probabilities.indices[start:stop], self.probabilities.data[start:stop]
+
+  def region(self, region):
+    """
+    Returns:
+    IndexedRegion: region of interest which is resolved with this index, e.g. for PyjugexAnalysis.roi1
+    """
+    if region not in self._columns:
+      raise ValueMissingError('region {} is not in the region index'.format(region))
+    return IndexedRegion(self, region)
+
+class IndexedRegion:
+  """
+  Region of interest of a RegionIndex. Can be used in place of the probability map of the region.
+  """
+  def __init__(self, region_index, name):
+    self.region_index = region_index
+    self.name = name
+    self.affine = region_index.affines[region_index._columns[name]]
+    self.inverse_affine = np.linalg.inv(self.affine)
+
+  def probabilities(self, specimen_name, wells):
+    """
+    Returns:
+    numpy.ndarray: probability of the region at every sample, 0 for samples which are not in the index
+    """
+    rows = self.region_index.rows(specimen_name, wells)
+    column_rows, values = self.region_index.column(self.name)
+    if len(column_rows) == 0:
+      return np.zeros(len(rows), dtype=np.float32)
+    positions = np.minimum(np.searchsorted(column_rows, rows), len(column_rows) - 1)
+    return np.where((rows >= 0) & (column_rows[positions] == rows), values[positions], 0)
+
+  def probabilities_at(self, voxel_coords, specimen_name=None, wells=None, sample_table=None, rows=None):
+    """
+    Same interface as RoiSampler.probabilities_at. The samples are looked up by specimen_name and wells, voxel_coords are only rounded.
+    Returns:
+    tuple: n x 3 rounded voxel coordinates, and the probability at every sample
+    """
+    if specimen_name is None or wells is None:
+      raise ValueMissingError('specimen_name and wells are required to look samples up in the region index')
+    return np.rint(voxel_coords).astype(int).reshape(-1, 3), self.probabilities(specimen_name, wells)
+
+  def sample(self, specimen_name, wells, filter_threshold=0.2):
+    """
+    Returns:
+    numpy.ndarray: mask of the samples which are in the region
+    """
+    probabilities = self.probabilities(specimen_name, wells)
+    return (probabilities > filter_threshold) & (probabilities != 0)
+
+def atlas_probability_maps(atlas):
+  """
+  Args:
+  atlas (list): region tree in the format of webjugex/files/filteredJuBrainJson.json
+  Returns:
+  dict: PMapURL of every region which has one
+  """
+  pmap_urls = {}
+  def walk(node):
+    if node.get('PMapURL'):
+      pmap_urls[node['name']] = node['PMapURL']
+    for child in node.get('children') or []:
+      walk(child)
+  for node in (atlas if isinstance(atlas, list) else [atlas]):
+    walk(node)
+  return pmap_urls
+
+def main(argv=None):
+  from . import util
+
+  parser = argparse.ArgumentParser(description='Sample every probability map of an atlas at all Allen Brain samples and save the sparse samples x regions index')
+  parser.add_argument('atlas', help='region tree with PMapURL, e.g. webjugex/files/filteredJuBrainJson.json')
+  parser.add_argument('-o', '--output', required=True)
+  parser.add_argument('--pmap-dir', help='read the maps from this directory, by the file name of their PMapURL, instead of downloading them')
+  parser.add_argument('--store', help='take the samples from this MicroarrayStore instead of Allen Brain API')
+  args = parser.parse_args(argv)
+
+  if args.store:
+    util.set_store(util.MicroarrayStore(args.store))
+  sample_table = util.get_all_samples_table()
+
+  with open(args.atlas, 'r') as f:
+    pmap_urls = atlas_probability_maps(json.load(f))
+
+  def load(url):
+    if args.pmap_dir:
+      return lambda: util.nib.load(os.path.join(args.pmap_dir, url.rsplit('/', 1)[-1]))
+    return lambda: util.read_byte_via_nib(util.get_pmap(url).content, gzip=util.is_gzipped(url))
+
+  index = RegionIndex.build(sample_table, [(region, load(url)) for region, url in pmap_urls.items()], source=os.path.basename(args.atlas))
+  index.save(args.output)
+  print('{} regions, {} samples, {} nonzero probabilities written to {}'.format(len(index), index.probabilities.shape[0], index.probabilities.nnz, args.output))
+
+if __name__ == '__main__':
+  main()
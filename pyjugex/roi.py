@@ -0,0 +1,122 @@
+# Copyright 2020 Forschungszentrum Jülich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+
+class RoiSampler:
+  """
+  Probabilities of a region of interest at sample locations, loaded once per analysis.
+
+  If the data of the image is memory mapped (uncompressed .nii without scaling, loaded by nibabel with mmap), it is read in place and only the voxels hit by samples are touched. Otherwise the map is decompressed once and only its nonzero voxels are kept, as sorted flat indices and values in the dtype of the image. Probability maps are mostly zero, so this is a small fraction of the full volume, and samples at zero probability are never in the region, whatever the threshold.
+
+  Usage:
+
+  sampler = RoiSampler(nib.load('roi.nii.gz'))
+  voxels, mask = sampler.sample(voxel_coords, filter_threshold=0.2)
+  """
+  def __init__(self, roi_nii):
+    self.affine = np.array(roi_nii.affine, dtype=np.float64)
+    self.inverse_affine = np.linalg.inv(self.affine)
+    self.shape = tuple(int(length) for length in roi_nii.shape[:3])
+
+    img_arr = np.asanyarray(roi_nii.dataobj)
+    if isinstance(img_arr, np.memmap):
+      self.img_arr = img_arr
+      self.flat_indices = self.values = None
+    else:
+      flat = img_arr.reshape(-1, order='C') if img_arr.ndim == 3 else img_arr[..., 0].reshape(-1, order='C')
+      self.img_arr = None
+      self.flat_indices = np.flatnonzero(flat)
+      self.values = flat[self.flat_indices]
+
+  @classmethod
+  def from_sparse(cls, affine, shape, flat_indices, values):
+    """
+    Sampler of a map given by its nonzero voxels, e.g. as kept in a cache
+    Args:
+    affine (numpy.ndarray): 4x4 affine of the map
+    shape (tuple): shape of the volume
+    flat_indices (numpy.ndarray): sorted flat indices of the nonzero voxels, in C order
+    values (numpy.ndarray): probability of these voxels
+    Returns:
+    RoiSampler: sampler which does not need the image
+    """
+    roi_sampler = cls.__new__(cls)
+    roi_sampler.affine = np.array(affine, dtype=np.float64)
+    roi_sampler.inverse_affine = np.linalg.inv(roi_sampler.affine)
+    roi_sampler.shape = tuple(int(length) for length in shape[:3])
+    roi_sampler.img_arr = None
+    roi_sampler.flat_indices = np.asarray(flat_indices, dtype=np.int64)
+    roi_sampler.values = np.asarray(values)
+    return roi_sampler
+
+  @classmethod
+  def of(cls, roi):
+    """
+    Returns:
+    RoiSampler: roi itself if it samples probabilities already (RoiSampler, IndexedRegion, GeometricRoi), otherwise a RoiSampler of the image roi
+    """
+    return roi if hasattr(roi, 'probabilities_at') else cls(roi)
+
+  @property
+  def nbytes(self):
+    if self.img_arr is not None:
+      return 0
+    return self.flat_indices.nbytes + self.values.nbytes
+
+  def probabilities(self, voxels):
+    """
+    Args:
+    voxels (numpy.ndarray): n x 3 integer voxel coordinates, inside the volume
+    Returns:
+    numpy.ndarray: probability at every voxel
+    """
+    if self.img_arr is not None:
+      if self.img_arr.ndim == 3:
+        return np.asarray(self.img_arr[tuple(voxels.T)])
+      return np.asarray(self.img_arr[tuple(voxels.T) + (0,)])
+    flat_indices = np.ravel_multi_index(tuple(voxels.T), self.shape)
+    if len(self.flat_indices) == 0:
+      return np.zeros(len(flat_indices), dtype=self.values.dtype)
+    positions = np.minimum(np.searchsorted(self.flat_indices, flat_indices), len(self.flat_indices) - 1)
+    return np.where(self.flat_indices[positions] == flat_indices, self.values[positions], 0)
+
+  def probabilities_at(self, voxel_coords, specimen_name=None, wells=None, sample_table=None, rows=None):
+    """
+    Probabilities of the region at samples. Regions of interest which are not voxel maps (IndexedRegion, GeometricRoi) have the same method, and identify the samples by the other arguments, which a RoiSampler ignores.
+    Args:
+    voxel_coords (numpy.ndarray): n x 3 voxel coordinates of the samples, not rounded
+    specimen_name (str): optional, name of the donor of the samples
+    wells (numpy.ndarray): optional, well ids of the samples
+    sample_table (SampleTable): optional, table which contains the samples, at rows
+    rows (slice): optional, rows of the samples in sample_table
+    Returns:
+    tuple: n x 3 rounded voxel coordinates, and the probability at every sample, 0 outside the volume
+    """
+    voxels = np.rint(voxel_coords).astype(int).reshape(-1, 3)
+    in_bounds = np.all((voxels >= 0) & (voxels < np.array(self.shape)), axis=1)
+    probabilities = np.zeros(len(voxels), dtype=np.float64)
+    probabilities[in_bounds] = self.probabilities(voxels[in_bounds])
+    return voxels, probabilities
+
+  def sample(self, voxel_coords, filter_threshold=0.2):
+    """
+    Args:
+    voxel_coords (numpy.ndarray): n x 3 voxel coordinates of the samples, not rounded
+    filter_threshold (float): samples with a probability above filter_threshold are in the region
+    Returns:
+    tuple: n x 3 rounded voxel coordinates, and boolean mask of the samples which are inside the volume and in the region
+    """
+    voxels, probabilities = self.probabilities_at(voxel_coords)
+    return voxels, (probabilities > filter_threshold) & (probabilities != 0)
@@ -0,0 +1,120 @@
+# Copyright 2020 Forschungszentrum Jülich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+def mri_to_mni(mri, alignment3d):
+  """
+  Args:
+  mri (numpy.ndarray): n x 3 mri voxel coordinates
+  alignment3d (numpy.ndarray): 4x4 transformation of the donor from mri to MNI152 space
+  Returns:
+  numpy.ndarray: n x 3 coordinates in MNI152 space
+  """
+  alignment3d = np.asarray(alignment3d, dtype=np.float64)
+  return np.asarray(mri, dtype=np.float64) @ alignment3d[0:3, 0:3].T + alignment3d[0:3, 3]
+
+class SampleTable:
+  """
+  The samples of all donors as contiguous columns, donor after donor.
+
+  Columns (one row per sample):
+  mri - n x 3 mri voxel coordinates
+  mni - n x 3 coordinates in MNI152 space, computed once with the alignment3d of the donor
+  well, polygon, structure_id - ids of the sample
+  donor - index into donor_names
+
+  The samples of donor i are rows offsets[i] to offsets[i+1], in the order of the microarray responses, so that they line up with the rows of the zscore matrices.
+
+  Usage:
+
+  table = SampleTable.from_api([samples_and_zscores['samples'] for ...], specimen_info)
+  table.mni[table.donor_rows(0)]
+  """
+  def __init__(self, donor_names, mri, mni, well, polygon, structure_id, offsets):
+    self.donor_names = list(donor_names)
+    self.mri = np.ascontiguousarray(mri, dtype=np.int32).reshape(-1, 3)
+    self.mni = np.ascontiguousarray(mni, dtype=np.float64).reshape(-1, 3)
+    self.well = np.ascontiguousarray(well, dtype=np.int64)
+    self.polygon = np.ascontiguousarray(polygon, dtype=np.int64)
+    self.structure_id = np.ascontiguousarray(structure_id, dtype=np.int64)
+    self.offsets = np.asarray(offsets, dtype=np.int64)
+    self.donor = np.repeat(np.arange(len(self.donor_names), dtype=np.int16), np.diff(self.offsets))
+    for column in (self.mri, self.mni, self.well, self.polygon, self.structure_id, self.donor):
+      column.setflags(write=False)
+    self._kdtree = None
+
+  @classmethod
+  def from_api(cls, samples_per_donor, specimen_info):
+    """
+    Args:
+    samples_per_donor (list): samples of each donor, as in the microarray responses of Allen Brain API
+    specimen_info (list): name and alignment3d of each donor, see util.get_specimen_data
+    Returns:
+    SampleTable: table of all samples
+    """
+    mri = [np.array([sample['sample']['mri'] for sample in samples], dtype=np.int32).reshape(-1, 3) for samples in samples_per_donor]
+    return cls(
+      donor_names=[specimen['name'] for specimen in specimen_info],
+      mri=np.concatenate(mri),
+      mni=np.concatenate([mri_to_mni(donor_mri, specimen['alignment3d']) for donor_mri, specimen in zip(mri, specimen_info)]),
+      well=[sample['sample']['well'] for samples in samples_per_donor for sample in samples],
+      polygon=[sample['sample']['polygon'] for samples in samples_per_donor for sample in samples],
+      structure_id=[sample.get('structure', {}).get('id', -1) for samples in samples_per_donor for sample in samples],
+      offsets=np.concatenate([[0], np.cumsum([len(samples) for samples in samples_per_donor])])
+    )
+
+  @classmethod
+  def from_store(cls, store, donor_ids):
+    """
+    Args:
+    store (MicroarrayStore): local microarray store
+    donor_ids (list): donors to include, in this order
+    Returns:
+    SampleTable: table of all samples of the donors
+    """
+    samples = [store.samples(donor_id) for donor_id in donor_ids]
+    specimens = [store.specimen(donor_id) for donor_id in donor_ids]
+    return cls(
+      donor_names=[specimen['name'] for specimen in specimens],
+      mri=np.concatenate([donor_samples['mri'] for donor_samples in samples]),
+      mni=np.concatenate([mri_to_mni(donor_samples['mri'], specimen['alignment3d']) for donor_samples, specimen in zip(samples, specimens)]),
+      well=np.concatenate([donor_samples['well'] for donor_samples in samples]),
+      polygon=np.concatenate([donor_samples['polygon'] for donor_samples in samples]),
+      structure_id=np.concatenate([donor_samples['structure_id'] for donor_samples in samples]),
+      offsets=np.concatenate([[0], np.cumsum([len(donor_samples['well']) for donor_samples in samples])])
+    )
+
+  def __len__(self):
+    return len(self.well)
+
+  def kdtree(self):
+    """
+    Returns:
+    scipy.spatial.cKDTree: k-d tree over the MNI152 coordinates of all samples, built on first use
+    """
+    if self._kdtree is None:
+      self._kdtree = cKDTree(self.mni)
+    return self._kdtree
+
+  def donor_rows(self, donor):
+    """
+    Args:
+    donor (int or str): index or specimen name of the donor
+    Returns:
+    slice: rows of the samples of the donor
+    """
+    index = self.donor_names.index(donor) if isinstance(donor, str) else donor
+    return slice(int(self.offsets[index]), int(self.offsets[index + 1]))
@@ -0,0 +1,389 @@
+# Copyright 2020 Forschungszentrum Jülich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+import logging
+import os
+import re
+import numpy as np
+
+try:
+  import pandas as pd
+except ImportError:
+  # optional, only needed to ingest the csv files of the Allen Human Brain Atlas download, see ingest
+  pd = None
+
+from .error import ValueMissingError
+
+STORE_FORMAT_VERSION = 1
+
+# donor id -> specimen name of the six donors of the Allen Human Brain Atlas
+ALLEN_DONORS = {
+  '15496': 'H0351.1015',
+  '14380': 'H0351.1012',
+  '15697': 'H0351.1016',
+  '9861': 'H0351.2001',
+  '12876': 'H0351.1009',
+  '10021': 'H0351.2002'
+}
+
+class MicroarrayStore:
+  """
+  Local copy of the Allen Human Brain Atlas microarray data, which can be used instead of Allen Brain API.
+
+  Layout of the store directory:
+
+  store.json - format version, donors with specimen name, number of samples and alignment matrix, specimen factors
+  probes.npz - probe metadata (id, name, gene_symbol, gene_id, entrez_id), in the column order of the zscore matrices
+  donor_<id>/zscores.npy - samples x probes float32 zscores, stored column by column (fortran order) so that the columns of a probe are contiguous
+  donor_<id>/samples.npz - sample table (mri, mni, well, polygon, structure_id, structure_acronym, structure_name)
+  genes.npy, donor_<id>/gene_zscores.npy - optional, samples x genes float32 winsorized mean zscore of every gene (as computed by util.get_mean_zscores), fortran order, see build_gene_matrix
+
+  The zscore matrices are memory mapped, reading a few probes only touches their columns.
+
+  Usage:
+
+  store = MicroarrayStore('/data/pyjugex_store')
+  probes, zscores = store.read('15496', store.probe_ids_of_gene('MAOA'))
+  """
+  def __init__(self, root):
+    self.root = os.path.abspath(os.path.expanduser(root))
+    metadata_path = os.path.join(self.root, 'store.json')
+    if not os.path.exists(metadata_path):
+      raise ValueMissingError('{} is not a microarray store, build it with python -m pyjugex.store'.format(self.root))
+    with open(metadata_path, 'r') as f:
+      self.metadata = json.load(f)
+    if self.metadata['version'] != STORE_FORMAT_VERSION:
+      raise ValueError('microarray store format {} is not supported, expected {}'.format(self.metadata['version'], STORE_FORMAT_VERSION))
+
+    with np.load(os.path.join(self.root, 'probes.npz'), allow_pickle=False) as f:
+      self.probes = {key: f[key] for key in f.files}
+    self._probe_order = np.argsort(self.probes['id'], kind='stable')
+    self._sorted_probe_ids = self.probes['id'][self._probe_order]
+    self._zscores = {}
+    self._gene_zscores = {}
+    self._samples = {}
+    self._genes = None
+
+  @property
+  def donor_ids(self):
+    return list(self.metadata['donors'].keys())
+
+  def zscores(self, donor_id):
+    """
+    Returns:
+    numpy.memmap: read only samples x probes zscores of the donor
+    """
+    donor_id = str(donor_id)
+    if donor_id not in self._zscores:
+      self._zscores[donor_id] = np.load(os.path.join(self._donor_dir(donor_id), 'zscores.npy'), mmap_mode='r')
+    return self._zscores[donor_id]
+
+  def has_gene_matrix(self):
+    return bool(self.metadata.get('gene_matrix'))
+
+  @property
+  def genes(self):
+    """
+    Returns:
+    numpy.ndarray: sorted gene symbols, the columns of the gene matrices
+    """
+    if self._genes is None:
+      if not self.has_gene_matrix():
+        raise ValueMissingError('the microarray store {} has no gene matrix, build it with build_gene_matrix'.format(self.root))
+      self._genes = np.load(os.path.join(self.root, 'genes.npy'), allow_pickle=False)
+    return self._genes
+
+  def gene_zscores(self, donor_id):
+    """
+    Returns:
+    numpy.memmap: read only samples x genes winsorized mean zscores of the donor
+    """
+    donor_id = str(donor_id)
+    if donor_id not in self._gene_zscores:
+      if not self.has_gene_matrix():
+        raise ValueMissingError('the microarray store {} has no gene matrix, build it with build_gene_matrix'.format(self.root))
+      self._gene_zscores[donor_id] = np.load(os.path.join(self._donor_dir(donor_id), 'gene_zscores.npy'), mmap_mode='r')
+    return self._gene_zscores[donor_id]
+
+  def read_genes(self, donor_id, genes, rows=None):
+    """
+    Read the winsorized mean zscores of the given genes from the gene matrix
+    Args:
+    donor_id (str): donor
+    genes (list): gene symbols
+    rows (numpy.ndarray): optional, samples to read, all by default
+    Returns:
+    numpy.ndarray: samples x genes
+    """
+    genes = np.asarray(genes, dtype=str)
+    columns = np.minimum(np.searchsorted(self.genes, genes), len(self.genes) - 1)
+    missing = genes[self.genes[columns] != genes]
+    if len(missing) > 0:
+      raise ValueError('Please check the spelling of {}. No such gene exists in the microarray store.'.format(', '.join(missing)))
+    gene_zscores = self.gene_zscores(donor_id)[:, columns]
+    if rows is not None:
+      gene_zscores = gene_zscores[rows]
+    return np.asarray(gene_zscores, dtype=np.float64)
+
+  def samples(self, donor_id):
+    """
+    Returns:
+    dict: sample table of the donor, one array per column
+    """
+    donor_id = str(donor_id)
+    if donor_id not in self._samples:
+      with np.load(os.path.join(self._donor_dir(donor_id), 'samples.npz'), allow_pickle=False) as f:
+        self._samples[donor_id] = {key: f[key] for key in f.files}
+    return self._samples[donor_id]
+
+  def probe_columns(self, probe_ids):
+    """
+    Args:
+    probe_ids (list): probe ids
+    Returns:
+    numpy.ndarray: column of every probe in the zscore matrices, -1 for probes which are not in the store
+    """
+    probe_ids = np.asarray([int(probe_id) for probe_id in probe_ids], dtype=np.int64)
+    positions = np.minimum(np.searchsorted(self._sorted_probe_ids, probe_ids), len(self._sorted_probe_ids) - 1)
+    found = self._sorted_probe_ids[positions] == probe_ids
+    return np.where(found, self._probe_order[positions], -1)
+
+  def probe_ids_of_gene(self, gene):
+    """
+    Returns:
+    list: ids of the probes of gene, as strings, empty if the gene is not in the store
+    """
+    return [str(probe_id) for probe_id in self.probes['id'][self.probes['gene_symbol'] == gene]]
+
+  def read(self, donor_id, probe_ids):
+    """
+    Read the zscores of the given probes for all samples of a donor. Probes which are not in the store are skipped, as Allen Brain API does.
+    Returns:
+    tuple: (list of probe metadata dicts, samples x probes numpy.ndarray of zscores)
+    """
+    columns = self.probe_columns(probe_ids)
+    missing = [probe_id for probe_id, column in zip(probe_ids, columns) if column < 0]
+    if len(missing) > 0:
+      logging.getLogger(__name__).warning('probes {} are not in the microarray store'.format(missing))
+    columns = columns[columns >= 0]
+    probes = [{
+      'id': int(self.probes['id'][column]),
+      'name': str(self.probes['name'][column]),
+      'gene-symbol': str(self.probes['gene_symbol'][column])
+    } for column in columns]
+    return probes, np.asarray(self.zscores(donor_id)[:, columns], dtype=np.float64)
+
+  def api_samples(self, donor_id):
+    """
+    Samples of a donor in the format of the samples of Allen Brain API microarray queries
+    Returns:
+    list: one dict per sample
+    """
+    samples = self.samples(donor_id)
+    return [{
+      'sample': {'mri': samples['mri'][i].tolist(), 'well': int(samples['well'][i]), 'polygon': int(samples['polygon'][i])},
+      'structure': {'id': int(samples['structure_id'][i]), 'acronym': str(samples['structure_acronym'][i]), 'name': str(samples['structure_name'][i])}
+    } for i in range(len(samples['well']))]
+
+  def specimen(self, donor_id):
+    """
+    Returns:
+    dict: name and alignment3d of the specimen of the donor, in the format of util.get_specimen_data
+    """
+    donor = self.metadata['donors'][str(donor_id)]
+    return {'name': donor['name'], 'alignment3d': np.array(donor['alignment3d'])}
+
+  def specimen_factors(self):
+    """
+    Returns:
+    dict: specimen factors as returned by util.from_brainmap_retrieve_specimen_factors, None if they were not stored
+    """
+    return self.metadata.get('specimen_factors')
+
+  def _donor_dir(self, donor_id):
+    if str(donor_id) not in self.metadata['donors']:
+      raise ValueMissingError('donor {} is not in the microarray store {}'.format(donor_id, self.root))
+    return os.path.join(self.root, 'donor_{}'.format(donor_id))
+
+def fit_alignment(mri, mni):
+  """
+  Least squares affine transformation from the mri voxel coordinates of the samples to their mni coordinates. Only an approximation of the alignment3d of Allen Brain API, which is used if that is not available.
+  Returns:
+  numpy.ndarray: 4x4 matrix
+  """
+  mri = np.hstack([np.asarray(mri, dtype=np.float64), np.ones((len(mri), 1))])
+  solution = np.linalg.lstsq(mri, np.asarray(mni, dtype=np.float64), rcond=None)[0]
+  return np.vstack([solution.T, [0, 0, 0, 1]])
+
+def _read_probes(donor_dir):
+  probes = pd.read_csv(os.path.join(donor_dir, 'Probes.csv'))
+  return {
+    'id': probes['probe_id'].to_numpy(dtype=np.int64),
+    'name': probes['probe_name'].astype(str).to_numpy(dtype=np.str_),
+    'gene_symbol': probes['gene_symbol'].astype(str).to_numpy(dtype=np.str_),
+    'gene_id': probes['gene_id'].to_numpy(dtype=np.int64),
+    'entrez_id': probes['entrez_id'].fillna(-1).to_numpy(dtype=np.int64)
+  }
+
+def _read_samples(donor_dir):
+  samples = pd.read_csv(os.path.join(donor_dir, 'SampleAnnot.csv'))
+  return {
+    'mri': samples[['mri_voxel_x', 'mri_voxel_y', 'mri_voxel_z']].to_numpy(dtype=np.int32),
+    'mni': samples[['mni_x', 'mni_y', 'mni_z']].to_numpy(dtype=np.float64),
+    'well': samples['well_id'].to_numpy(dtype=np.int64),
+    'polygon': samples['polygon_id'].to_numpy(dtype=np.int64),
+    'structure_id': samples['structure_id'].to_numpy(dtype=np.int64),
+    'structure_acronym': samples['structure_acronym'].astype(str).to_numpy(dtype=np.str_),
+    'structure_name': samples['structure_name'].astype(str).to_numpy(dtype=np.str_)
+  }
+
+def _ingest_donor(donor_dir, out_dir, probe_ids, n_samples, chunk_size):
+  """
+  z-score MicroarrayExpression.csv probe by probe, across the samples of the donor, and write it chunk by chunk into a fortran ordered memory map
+  """
+  zscores = np.lib.format.open_memmap(os.path.join(out_dir, 'zscores.npy'), mode='w+', dtype=np.float32, shape=(n_samples, len(probe_ids)), fortran_order=True)
+  start = 0
+  for chunk in pd.read_csv(os.path.join(donor_dir, 'MicroarrayExpression.csv'), header=None, chunksize=chunk_size):
+    stop = start + len(chunk)
+    if not np.array_equal(chunk.iloc[:, 0].to_numpy(dtype=np.int64), probe_ids[start:stop]):
+      raise ValueError('rows of MicroarrayExpression.csv and Probes.csv in {} do not match'.format(donor_dir))
+    expression = chunk.iloc[:, 1:].to_numpy(dtype=np.float64)
+    if expression.shape[1] != n_samples:
+      raise ValueError('MicroarrayExpression.csv and SampleAnnot.csv in {} do not have the same number of samples'.format(donor_dir))
+    std = expression.std(axis=1, keepdims=True)
+    std[std == 0] = 1
+    zscores[:, start:stop] = ((expression - expression.mean(axis=1, keepdims=True)) / std).T
+    start = stop
+  if start != len(probe_ids):
+    raise ValueError('MicroarrayExpression.csv in {} has {} probes, Probes.csv {}'.format(donor_dir, start, len(probe_ids)))
+  zscores.flush()
+  del zscores
+
+def ingest(root, donor_dirs, specimen_info=None, specimen_factors=None, chunk_size=2048, gene_matrix=True):
+  """
+  Build a MicroarrayStore from the normalized microarray csv files of the Allen Human Brain Atlas bulk download (one directory per donor, e.g. normalized_microarray_donor9861, with MicroarrayExpression.csv, SampleAnnot.csv and Probes.csv).
+
+  The expression values are z-scored per probe, across all samples of the donor.
+  Args:
+  root (str): store directory
+  donor_dirs (dict): download directory per donor id
+  specimen_info (dict): optional, util.get_specimen_data per donor id. The alignment matrices are fitted to the mni coordinates of the sample table if missing.
+  specimen_factors (dict): optional, output of util.from_brainmap_retrieve_specimen_factors
+  gene_matrix (bool): also precompute the winsorized mean zscores of all genes, see build_gene_matrix
+  Returns:
+  MicroarrayStore: the new store
+  """
+  if pd is None:
+    raise ImportError('ingesting a MicroarrayStore requires pandas, install it with pip install pyjugex[store]')
+  os.makedirs(root, exist_ok=True)
+  specimen_info = specimen_info or {}
+  probes = None
+  donors = {}
+  for donor_id, donor_dir in donor_dirs.items():
+    donor_id = str(donor_id)
+    donor_probes = _read_probes(donor_dir)
+    if probes is None:
+      probes = donor_probes
+      np.savez(os.path.join(root, 'probes.npz'), **probes)
+    elif not np.array_equal(probes['id'], donor_probes['id']):
+      raise ValueError('the probes of donor {} differ from the other donors'.format(donor_id))
+
+    samples = _read_samples(donor_dir)
+    out_dir = os.path.join(root, 'donor_{}'.format(donor_id))
+    os.makedirs(out_dir, exist_ok=True)
+    np.savez(os.path.join(out_dir, 'samples.npz'), **samples)
+    _ingest_donor(donor_dir, out_dir, probes['id'], len(samples['well']), chunk_size)
+
+    specimen = specimen_info.get(donor_id)
+    if specimen is None:
+      logging.getLogger(__name__).warning('no alignment of donor {}, it is fitted to the mni coordinates of the samples'.format(donor_id))
+      alignment3d = fit_alignment(samples['mri'], samples['mni'])
+    else:
+      alignment3d = np.asarray(specimen['alignment3d'], dtype=np.float64)
+    donors[donor_id] = {
+      'name': specimen['name'] if specimen is not None else ALLEN_DONORS.get(donor_id, donor_id),
+      'n_samples': len(samples['well']),
+      'alignment3d': alignment3d.tolist()
+    }
+
+  # written last, a store without store.json is incomplete
+  _write_metadata(root, {'version': STORE_FORMAT_VERSION, 'donors': donors, 'specimen_factors': specimen_factors, 'gene_matrix': False})
+  store = MicroarrayStore(root)
+  if gene_matrix:
+    store = build_gene_matrix(store)
+  return store
+
+def _write_metadata(root, metadata):
+  tmp_path = os.path.join(root, 'store.json.tmp')
+  with open(tmp_path, 'w') as f:
+    json.dump(metadata, f)
+  os.replace(tmp_path, os.path.join(root, 'store.json'))
+
+def build_gene_matrix(store, chunk_size=1024):
+  """
+  Precompute the winsorized mean zscore of every gene for every sample, with util.get_mean_zscores, and add it to the store. The genes are aggregated chunk_size at a time, reading only their probe columns.
+  Args:
+  store (MicroarrayStore): store with probe zscores
+  Returns:
+  MicroarrayStore: the store, reopened
+  """
+  from .util import get_mean_zscores
+
+  genes, codes = np.unique(store.probes['gene_symbol'], return_inverse=True)
+  np.save(os.path.join(store.root, 'genes.npy'), genes)
+  probe_columns = np.argsort(codes, kind='stable')
+  first_column = np.searchsorted(codes[probe_columns], np.arange(len(genes) + 1))
+
+  for donor_id in store.donor_ids:
+    zscores = store.zscores(donor_id)
+    gene_zscores = np.lib.format.open_memmap(os.path.join(store._donor_dir(donor_id), 'gene_zscores.npy'), mode='w+', dtype=np.float32, shape=(zscores.shape[0], len(genes)), fortran_order=True)
+    for start in range(0, len(genes), chunk_size):
+      stop = min(start + chunk_size, len(genes))
+      columns = np.sort(probe_columns[first_column[start]:first_column[stop]])
+      gene_zscores[:, start:stop] = get_mean_zscores(store.probes['gene_symbol'][columns], np.asarray(zscores[:, columns], dtype=np.float64))['combined_zscores']
+    gene_zscores.flush()
+    del gene_zscores
+
+  metadata = dict(store.metadata, gene_matrix=True)
+  _write_metadata(store.root, metadata)
+  return MicroarrayStore(store.root)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Build a local microarray store from the Allen Human Brain Atlas bulk download')
+  parser.add_argument('root', help='store directory')
+  parser.add_argument('donor_dirs', nargs='+', help='normalized_microarray_donor<id> directories')
+  parser.add_argument('--fetch-specimens', action='store_true', help='retrieve the alignment matrices and specimen factors from Allen Brain API')
+  parser.add_argument('--no-gene-matrix', action='store_true', help='do not precompute the winsorized mean zscores of all genes')
+  args = parser.parse_args(argv)
+
+  donor_dirs = {}
+  for donor_dir in args.donor_dirs:
+    match = re.search(r'donor(\d+)', os.path.basename(os.path.normpath(donor_dir)))
+    if match is None:
+      raise ValueError('cannot determine the donor id of {}'.format(donor_dir))
+    donor_dirs[match.group(1)] = donor_dir
+
+  specimen_info, specimen_factors = None, None
+  if args.fetch_specimens:
+    from . import util
+    specimen_info = {donor_id: util.get_specimen_data(util.from_brainmap_retrieve_specimen(ALLEN_DONORS[donor_id])['msg'][0]) for donor_id in donor_dirs}
+    specimen_factors = util.from_brainmap_retrieve_specimen_factors()
+
+  store = ingest(args.root, donor_dirs, specimen_info=specimen_info, specimen_factors=specimen_factors, gene_matrix=not args.no_gene_matrix)
+  print('{} donors, {} probes written to {}'.format(len(store.donor_ids), len(store.probes['id']), store.root))
+
+if __name__ == '__main__':
+  main()
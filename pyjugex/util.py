@@ -13,18 +13,182 @@
 # limitations under the License.
 
 import requests
-import tempfile
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from gzip import GzipFile
 import nibabel as nib
 import os
 import re
 import logging
 import xmltodict
 import numpy as np
-import scipy as sp
 
-from .cache import MemoryCache
+try:
+  import ijson
+except ImportError:
+  # optional, microarray responses are then parsed as a whole
+  ijson = None
+
+from .cache import MemoryCache, DiskCache
+from .probe_index import get_probe_index
+from .store import MicroarrayStore, ALLEN_DONORS
+from .samples import SampleTable, mri_to_mni
+from .roi import RoiSampler
+from .region_index import RegionIndex
+from .error import OfflineError, ValueMissingError
+
+def set_cache(backend):
+  """
+  Replace the cache used for the responses of Allen Brain API, e.g. by a DiskCache
+  Args:
+  backend (CacheBackend): new cache
+  """
+  global cache
+  cache = backend
+
+def cache_from_environment():
+  """
+  DiskCache in PYJUGEX_CACHE_DIR if that is set, with the optional limits PYJUGEX_CACHE_MAX_BYTES and PYJUGEX_CACHE_TTL (seconds). MemoryCache otherwise.
+  """
+  cache_dir = os.getenv('PYJUGEX_CACHE_DIR')
+  if not cache_dir:
+    return MemoryCache()
+  max_bytes = os.getenv('PYJUGEX_CACHE_MAX_BYTES')
+  ttl = os.getenv('PYJUGEX_CACHE_TTL')
+  return DiskCache(cache_dir, max_bytes=int(max_bytes) if max_bytes else None, ttl=float(ttl) if ttl else None)
+
+cache = cache_from_environment()
+
+# base url of Allen Brain API, can be pointed to a mirror or a local test server
+ALLEN_API_URL = 'http://api.brain-map.org'
+# number of concurrent requests to Allen Brain API
+MAX_CONNECTIONS = 8
+# probes per microarray query, keeps the probes$in[...] url well below common url length limits
+MAX_PROBES_PER_REQUEST = 400
+REQUEST_TIMEOUT = 60
+# parse microarray responses incrementally with ijson, if it is installed
+STREAM_JSON = True
+
+def set_store(microarray_store, offline=None):
+  """
+  Read microarray data from a local MicroarrayStore instead of Allen Brain API
+  Args:
+  microarray_store (MicroarrayStore): store to use, None to use Allen Brain API again
+  offline (bool): optional, if True no request is sent to Allen Brain API at all
+  """
+  global store, OFFLINE
+  store = microarray_store
+  _sample_tables.clear()
+  if offline is not None:
+    OFFLINE = offline
+
+# MicroarrayStore in PYJUGEX_STORE if that is set. With PYJUGEX_OFFLINE=1, requests to Allen Brain API raise OfflineError.
+store = MicroarrayStore(os.getenv('PYJUGEX_STORE')) if os.getenv('PYJUGEX_STORE') else None
+OFFLINE = os.getenv('PYJUGEX_OFFLINE', '').lower() in ('1', 'true', 'yes')
+
+def set_region_index(index):
+  """
+  Resolve regions of interest given by name with a RegionIndex, see get_region
+  Args:
+  index (RegionIndex): index to use, None to disable
+  """
+  global region_index
+  region_index = index
+
+# RegionIndex in PYJUGEX_REGION_INDEX if that is set
+region_index = RegionIndex.load(os.getenv('PYJUGEX_REGION_INDEX')) if os.getenv('PYJUGEX_REGION_INDEX') else None
+
+def get_region(name):
+  """
+  Args:
+  name (str): name of a region of the RegionIndex, e.g. 'Area Fp1 (FPole)'
+  Returns:
+  IndexedRegion: region which can be used instead of its probability map
+  """
+  if region_index is None:
+    raise ValueMissingError('regions can only be given by name with a region index, see set_region_index')
+  return region_index.region(name)
 
-cache = MemoryCache()
+# SampleTable per set of donors, shared by all analyses
+_sample_tables = {}
+
+def get_sample_table(specimen_info, samples_per_donor):
+  """
+  SampleTable of the samples of the donors, built on first use and shared afterwards
+  Args:
+  specimen_info (list): name and alignment3d of each donor
+  samples_per_donor (list): samples of each donor, as in the microarray responses of Allen Brain API
+  Returns:
+  SampleTable: table of all samples of the donors
+  """
+  key = tuple((specimen['name'], len(samples)) for specimen, samples in zip(specimen_info, samples_per_donor))
+  if key not in _sample_tables:
+    _sample_tables[key] = SampleTable.from_api(samples_per_donor, specimen_info)
+  return _sample_tables[key]
+
+def _get_store_sample_table(store_donor_ids):
+  key = (store.root,) + tuple(store_donor_ids)
+  if key not in _sample_tables:
+    _sample_tables[key] = SampleTable.from_store(store, store_donor_ids)
+  return _sample_tables[key]
+
+def get_all_samples_table():
+  """
+  SampleTable of all samples of all donors, e.g. to build a RegionIndex. The samples are read from the sample tables of the MicroarrayStore if one is set, otherwise see from_brainmap_retrieve_samples.
+  """
+  donor_ids = list(ALLEN_DONORS.keys())
+  if store is not None:
+    return _get_store_sample_table([donor_id for donor_id in donor_ids if donor_id in store.donor_ids])
+  specimen_info = [get_specimen_data(text['msg'][0]) for text in map_concurrently(from_brainmap_retrieve_specimen, list(ALLEN_DONORS.values()))]
+  return get_sample_table(specimen_info, map_concurrently(from_brainmap_retrieve_samples, donor_ids))
+
+def _add_sample_table(samples_zscores_and_specimen_dict, store_donor_ids=None):
+  """
+  Reference the shared SampleTable and the rows of the donor from every entry of samples_and_zscores. With store_donor_ids, the table is built from the sample tables of the store.
+  """
+  entries = samples_zscores_and_specimen_dict['samples_and_zscores']
+  if store_donor_ids is not None:
+    table = _get_store_sample_table(store_donor_ids)
+  else:
+    table = get_sample_table(samples_zscores_and_specimen_dict['specimen_info'], [entry['samples'] for entry in entries])
+  for index, entry in enumerate(entries):
+    entry['sample_table'] = table
+    entry['rows'] = table.donor_rows(index)
+  return samples_zscores_and_specimen_dict
+
+_sessions = {}
+
+def get_session():
+  """
+  Keep alive session shared by all requests to Allen Brain API from this process. At most MAX_CONNECTIONS connections are open at the same time, failed requests and 429 / 5xx responses are retried with exponential backoff.
+  Returns:
+  requests.Session: session of this process
+  """
+  if OFFLINE:
+    raise OfflineError('pyjugex is offline, data which is not in the local store cannot be retrieved from Allen Brain API')
+  pid = os.getpid()
+  if pid not in _sessions:
+    retry = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONNECTIONS, pool_block=True, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    _sessions[pid] = session
+  return _sessions[pid]
+
+def map_concurrently(func, items):
+  """
+  Call func for every item in up to MAX_CONNECTIONS threads
+  Returns:
+  list: results in the order of items
+  """
+  items = list(items)
+  if len(items) <= 1:
+    return [func(item) for item in items]
+  with ThreadPoolExecutor(max_workers=min(MAX_CONNECTIONS, len(items))) as executor:
+    return list(executor.map(func, items))
 
 def get_filename_from_resp(resp):
   # determine the type of the file. look at the disposition header, use PMapURL as a fallback
@@ -45,19 +209,34 @@ def get_pmap(url, json=None):
   resp.raise_for_status()
   return resp
 
-# input is byte
-# save to cache, then generate a random hashed file name
-# specify gzip to append .gz
-
 def read_byte_via_nib(content, gzip=False):
-  fp, fp_name = tempfile.mkstemp(suffix='.nii.gz' if gzip else '.nii')
-  os.write(fp, content)
-  img_array = nib.load(fp_name)
-  os.close(fp)
-  return img_array
-
-def is_gzipped(filename):
-  return re.search(r"\.gz$", filename) is not None
+  """
+  Decode a NIfTI image from bytes in memory, without writing it to a file
+  Args:
+  content (bytes): e.g. the content of the response of get_pmap
+  gzip (bool): content is gzip compressed, it is decompressed while the image is read
+  Returns:
+  nib.nifti1.Nifti1Image: image with its data already read, as float32
+  """
+  fileobj = GzipFile(fileobj=BytesIO(content)) if gzip else BytesIO(content)
+  file_holder = nib.FileHolder(fileobj=fileobj)
+  img = nib.Nifti1Image.from_file_map({'header': file_holder, 'image': file_holder})
+  # read the data now, the buffer is not kept
+  data = img.get_fdata(dtype=np.float32)
+  header = img.header.copy()
+  header.set_data_dtype(np.float32)
+  header.set_slope_inter(1, 0)
+  return nib.Nifti1Image(data, img.affine, header)
+
+def is_gzipped(filename, content=None):
+  """
+  Args:
+  filename (str): e.g. get_filename_from_resp(resp)
+  content (bytes): optional, the data itself, gzip compressed if it starts with the gzip magic number whatever its filename
+  Returns:
+  bool: True if the data is gzip compressed
+  """
+  return re.search(r"\.gz$", filename) is not None or (content is not None and content[:2] == b'\x1f\x8b')
 
 def from_brainmap_retrieve_gene(gene, verbose=False):
 
@@ -67,10 +246,11 @@ def from_brainmap_retrieve_gene(gene, verbose=False):
   """
 
   _key = f'from_brainmap_retrieve_gene__{gene}'
-  if cache.get_from_key(_key) is not None:
-    return cache.get_from_key(_key)
+  cached = cache.get_from_key(_key)
+  if cached is not None:
+    return cached
 
-  base_retrieve_probe_ids = "http://api.brain-map.org/api/v2/data/query.xml?criteria=model::Probe,rma::criteria,[probe_type$eq'DNA'],products[abbreviation$eq'HumanMA'],gene[acronym$eq"
+  base_retrieve_probe_ids = ALLEN_API_URL + "/api/v2/data/query.xml?criteria=model::Probe,rma::criteria,[probe_type$eq'DNA'],products[abbreviation$eq'HumanMA'],gene[acronym$eq"
   end_retrieve_probe_ids = "],rma::options[only$eq'probes.id']"
 
   url = '{}{}{}'.format(base_retrieve_probe_ids, gene, end_retrieve_probe_ids)
@@ -78,13 +258,42 @@ def from_brainmap_retrieve_gene(gene, verbose=False):
   if verbose:
     logging.getLogger(__name__).info('url: {}'.format(url))
 
-  resp = requests.get(url)
+  resp = get_session().get(url, timeout=REQUEST_TIMEOUT)
   resp.raise_for_status()
 
   resp_dict = xmltodict.parse(resp.text)
   cache.store_key_value(_key, resp_dict)
   return resp_dict
 
+def get_probe_ids(gene, verbose=False):
+  """
+  Probe ids of a gene. They are looked up in the gene to probe index, if one has been built (see probe_index.ProbeIndex). Genes which are not in the index, and all genes without an index, are retrieved from Allen Brain API, and the response is cached.
+  Args:
+  gene (str): gene symbol, e.g. MAOA
+  Returns:
+  list: probe ids of the gene
+  """
+  if store is not None:
+    probe_ids = store.probe_ids_of_gene(gene)
+    if len(probe_ids) == 0:
+      raise ValueError('Please check the spelling of {}. No such gene exists in the microarray store.'.format(gene))
+    return probe_ids
+
+  index = get_probe_index()
+  if index is not None:
+    probe_ids = index.get_probe_ids(gene)
+    if probe_ids is not None:
+      return probe_ids
+
+  data = from_brainmap_retrieve_gene(gene=gene, verbose=verbose)
+  if int(data['Response']['@num_rows']) <= 0:
+    raise ValueError('Please check the spelling of {}. No such gene exists in Allen Brain API.'.format(gene))
+  probes = data['Response']['probes']['probe']
+  # xmltodict returns a single probe as dict
+  if isinstance(probes, dict):
+    probes = [probes]
+  return [probe['id'] for probe in probes]
+
 def from_brainmap_retrieve_specimen(specimen_id, verbose=False):
 
   """
@@ -93,42 +302,155 @@ def from_brainmap_retrieve_specimen(specimen_id, verbose=False):
   """
 
   _key=f'from_brainmap_retrieve_specimen__{specimen_id}'
-  if cache.get_from_key(_key) is not None:
-    return cache.get_from_key(_key)
+  cached = cache.get_from_key(_key)
+  if cached is not None:
+    return cached
 
-  base_url_download_specimens = "http://api.brain-map.org/api/v2/data/Specimen/query.json?criteria=[name$eq"+"'"
+  base_url_download_specimens = ALLEN_API_URL + "/api/v2/data/Specimen/query.json?criteria=[name$eq"+"'"
   end_url_download_specimens = "']&include=alignment3d"
 
   url = '{}{}{}'.format(base_url_download_specimens, specimen_id, end_url_download_specimens)
-  resp = requests.get(url)
+  resp = get_session().get(url, timeout=REQUEST_TIMEOUT)
   resp.raise_for_status()
 
   resp_json = resp.json()
   cache.store_key_value(_key, resp_json)
   return resp_json
 
-def from_brainmap_retrieve_microarray_filterby_donorids_probeids(donor_id, probe_ids, verbose=False):
+def _microarray_probe_key(donor_id, probe_id):
+  return f'from_brainmap_retrieve_microarray__{donor_id}__probe__{probe_id}'
+
+def _microarray_samples_key(donor_id):
+  return f'from_brainmap_retrieve_microarray__{donor_id}__samples'
 
+def decode_zscores(probes, n_samples, dtype=np.float64):
   """
-  Query Allen Brain Api for given set of genes for the donor given by donor_id
+  Convert the z-score lists of the probes of a microarray response into a samples x probes matrix, one probe at a time
   Args:
-  donor_id (int): Id of a donor which is used to query Allen Brain API.
+  probes (list): probes of the response, each with a 'z-score' list of strings or numbers
+  n_samples (int): number of samples of the response
+  dtype (numpy.dtype): dtype of the matrix
   Returns:
-  dict: A dictionary representing the just downloaded samples, probes and zscores for the given donor_id and the probes given by self.probe_ids.
+  numpy.ndarray: n_samples x len(probes) zscores
   """
-  _key = f'from_brainmap_retrieve_microarray_filterby_donorids_probeids__{donor_id}__{"_".join(probe_ids)}'
-  if cache.get_from_key(_key) is not None:
-    return cache.get_from_key(_key)
+  zscores = np.empty((n_samples, len(probes)), dtype=dtype)
+  for column, probe in enumerate(probes):
+    zscores[:, column] = np.asarray(probe['z-score'], dtype=np.float64)
+  return zscores
 
-  base_query_api = "http://api.brain-map.org/api/v2/data/query.json?criteria=service::human_microarray_expression[probes$in"
-  probes = ','.join(probe_ids)
+def _parse_microarray_stream(raw):
+  """
+  Parse a microarray response incrementally. The z-score list of every probe is converted to a numpy array as soon as the probe is parsed, so the response is never completely in memory as text or python objects.
+  Returns:
+  dict: msg of the response
+  """
+  msg = {'samples': None, 'probes': []}
+  builder = None
+  for prefix, event, value in ijson.parse(raw):
+    if builder is None:
+      if prefix == 'msg' and event in ('string', 'null'):
+        raise ValueError('Allen Brain API returned an error: {}'.format(value))
+      if (prefix, event) in (('msg.samples', 'start_array'), ('msg.probes.item', 'start_map')):
+        builder = ijson.ObjectBuilder()
+      else:
+        continue
+    builder.event(event, value)
+    if (prefix, event) == ('msg.samples', 'end_array'):
+      msg['samples'] = builder.value
+      builder = None
+    elif (prefix, event) == ('msg.probes.item', 'end_map'):
+      probe = builder.value
+      probe['z-score'] = np.asarray(probe['z-score'], dtype=np.float64)
+      msg['probes'].append(probe)
+      builder = None
+  if msg['samples'] is None:
+    raise ValueError('microarray response without samples')
+  return msg
+
+def _query_microarray(donor_id, probe_ids):
+  """
+  Single microarray query of Allen Brain API. The z-score lists of the probes are returned as numpy arrays.
+  Returns:
+  dict: msg of the response, with the samples of the donor and the given probes
+  """
+  base_query_api = ALLEN_API_URL + "/api/v2/data/query.json?criteria=service::human_microarray_expression[probes$in"
   end_query_api = "][donors$eq{}]".format(donor_id)
-  url = '{}{}{}'.format(base_query_api, probes, end_query_api)
+  url = '{}{}{}'.format(base_query_api, ','.join(probe_ids), end_query_api)
 
-  resp = requests.get(url)
+  stream = STREAM_JSON and ijson is not None
+  resp = get_session().get(url, timeout=REQUEST_TIMEOUT, stream=stream)
 
   resp.raise_for_status()
-  return resp.json()
+  if stream:
+    with resp:
+      resp.raw.decode_content = True
+      return _parse_microarray_stream(resp.raw)
+
+  resp_json = resp.json()
+  if not resp_json.get('success', True) or not isinstance(resp_json.get('msg'), dict):
+    raise ValueError('Allen Brain API returned an error for donor {}: {}'.format(donor_id, resp_json.get('msg')))
+  for probe in resp_json['msg']['probes']:
+    probe['z-score'] = np.asarray(probe['z-score'], dtype=np.float64)
+  return resp_json['msg']
+
+# first probe of MAOA. Any HumanMA probe would do, microarray responses list every sample of the donor whatever the probes
+SAMPLES_PROBE_ID = '1054343'
+
+def from_brainmap_retrieve_samples(donor_id):
+  """
+  Samples of a donor, in the format of the microarray responses of Allen Brain API. They are cached by every microarray query of the donor, so a query for a single probe is only made if no zscores of the donor were retrieved before.
+  Args:
+  donor_id (str): Id of a donor
+  Returns:
+  list: samples of the donor
+  """
+  samples = cache.get_from_key(_microarray_samples_key(donor_id))
+  if samples is None:
+    samples = _query_microarray(donor_id, [SAMPLES_PROBE_ID])['samples']
+    cache.store_key_value(_microarray_samples_key(donor_id), samples)
+  return samples
+
+def from_brainmap_retrieve_microarray_filterby_donorids_probeids(donor_id, probe_ids, verbose=False):
+
+  """
+  Query Allen Brain Api for given set of genes for the donor given by donor_id. The zscores are cached per donor and probe, so only probes which have not been retrieved before are downloaded.
+  Args:
+  donor_id (int): Id of a donor which is used to query Allen Brain API.
+  probe_ids (list): Ids of the probes to retrieve
+  Returns:
+  dict: A dictionary representing the samples, probes and zscores for the given donor_id and probe_ids, in the format of the Allen Brain API response. There is one probe per entry of probe_ids, in the same order and including repeated probes, so that the zscore columns line up with the gene symbols of the probe ids. Raises ValueMissingError if Allen Brain API does not return every probe.
+  """
+  requested_probe_ids = [str(probe_id) for probe_id in probe_ids]
+  # every probe is retrieved once
+  probe_ids = list(dict.fromkeys(requested_probe_ids))
+  samples = cache.get_from_key(_microarray_samples_key(donor_id))
+  probes = {probe_id: cache.get_from_key(_microarray_probe_key(donor_id, probe_id)) for probe_id in probe_ids}
+  missing_probe_ids = [probe_id for probe_id, probe in probes.items() if probe is None]
+  if samples is None and len(missing_probe_ids) == 0:
+    missing_probe_ids = probe_ids[:1]
+
+  if len(missing_probe_ids) > 0:
+    if verbose:
+      logging.getLogger(__name__).info('retrieving {} of {} probes for donor {}'.format(len(missing_probe_ids), len(probe_ids), donor_id))
+    chunks = [missing_probe_ids[start:start + MAX_PROBES_PER_REQUEST] for start in range(0, len(missing_probe_ids), MAX_PROBES_PER_REQUEST)]
+    for msg in map_concurrently(lambda chunk: _query_microarray(donor_id, chunk), chunks):
+      samples = msg['samples']
+      for probe in msg['probes']:
+        probes[str(probe['id'])] = probe
+        cache.store_key_value(_microarray_probe_key(donor_id, probe['id']), probe)
+    cache.store_key_value(_microarray_samples_key(donor_id), samples)
+
+  not_returned = [probe_id for probe_id in probe_ids if probes.get(probe_id) is None]
+  if len(not_returned) > 0:
+    raise ValueMissingError('Allen Brain API returned no zscores of probes {} for donor {}'.format(', '.join(not_returned), donor_id))
+
+  return {
+    'success': True,
+    'msg': {
+      'samples': samples,
+      'probes': [probes[probe_id] for probe_id in requested_probe_ids]
+    }
+  }
 
 # TODO cleanup
 # TODO need tests
@@ -144,24 +466,17 @@ def transform_samples_MRI_to_MNI152(samples, transformation_mat):
             well - list of well id for the sample the respective coordinate belongs to
             polygon -  list of polygon id for the sample the respective coordinate belongs to
     """
-    np_T = np.array(transformation_mat[0:3, 0:4])
-    mri = np.vstack(s['sample']['mri'] for s in samples)
-    add = np.ones((len(mri), 1), dtype=np.int)
-    mri = np.append(mri, add, axis=1)
-    mri = np.transpose(mri)
-    coords = np.matmul(np_T, mri)
-    coords = coords.transpose()
+    mri = np.array([s['sample']['mri'] for s in samples], dtype=np.float64).reshape(-1, 3)
+    coords = mri_to_mni(mri, transformation_mat)
     well = [s['sample']['well'] for s in samples]
     polygon = [s['sample']['polygon'] for s in samples]
     return {'mnicoords' : coords, 'well' : well, 'polygon' : polygon}
-    #return coords
 
-# TODO write test
 def filter_coordinates_and_zscores(roi_nii, index_to_samples_zscores_and_specimen_dict, specimen, index, roi_name='Unnamed ROI', filter_threshold=0.2):
   """
   Populate self.filtered_coords_and_zscores with zscores and coords for samples which belong to a particular specimen and spatially represented in the given roi.
   Args:
-    roi (nib.nifti1.Nifti1Image): probability map of a region of interest.
+    roi_nii (nib.nifti1.Nifti1Image, RoiSampler, IndexedRegion or GeometricRoi): probability map of a region of interest. Pass a RoiSampler to load the map only once for all donors, an IndexedRegion to look the samples up in a RegionIndex, or a GeometricRoi (sphere, box or coordinates in MNI152 space).
     index_to_samples_zscores_and_specimen_dict (dict): Index into samples_zscores_and_specimen_dict
     specimen (dict): dictionary representing a specimen with its name and transformation matrix as keys
     index (int): 0 or 1, representing which region of interest it is.
@@ -173,42 +488,48 @@ def filter_coordinates_and_zscores(roi_nii, index_to_samples_zscores_and_specime
       d) coord_polygon - Lists of polygon id for all the samples which are spatially represented in region of interest given by roi parameter.
       e) specimen - same as specimen['name'].
       f) name - 'img1' representing first region of interest, 'img2' representing second region of interest.
+      g) probabilities - numpy array of the probability of the region of interest at these samples.
   """
   revised_samples_zscores_and_specimen_dict = dict.fromkeys(['zscores', 'coords', 'coord_well', 'coord_polygon', 'specimen', 'name'])
   revised_samples_zscores_and_specimen_dict['realname'] = roi_name
   revised_samples_zscores_and_specimen_dict['name'] = 'img{}'.format(str(index+1))
-  img_arr = roi_nii.get_data()
-  invroiMni = np.linalg.inv(roi_nii.affine)
-  T = np.dot(invroiMni, specimen['alignment3d'])
-  '''
-  coords = transform_samples_MRI_to_MNI152(index_to_samples_zscores_and_specimen_dict['samples'], T)
-  coords = (np.rint(coords)).astype(int)
-  coords = [np.array([-1, -1, -1]) if (coord > 0).sum() != 3 or img_arr[coord[0],coord[1],coord[2]] <= self.filter_threshold or img_arr[coord[0],coord[1],coord[2]] == 0 else coord for coord in coords]
-  revised_samples_zscores_and_specimen_dict['coords'] = [coord for coord in coords if (coord > 0).sum() == 3]
-  '''
-  coords_dict = transform_samples_MRI_to_MNI152(index_to_samples_zscores_and_specimen_dict['samples'], T)
-  coords = (np.rint(coords_dict['mnicoords'])).astype(int)
-  coords = [np.array([-1, -1, -1]) if (coord > 0).sum() != 3 or img_arr[coord[0],coord[1],coord[2]] <= filter_threshold or img_arr[coord[0],coord[1],coord[2]] == 0 else coord for coord in coords]
-  revised_samples_zscores_and_specimen_dict['coords'] = [coord for coord in coords if (coord > 0).sum() == 3]
-  revised_samples_zscores_and_specimen_dict['coord_well'] = [well for (coord, well) in zip(coords, coords_dict['well']) if (coord > 0).sum() == 3]
-  revised_samples_zscores_and_specimen_dict['coord_polygon'] = [polygon for (coord, polygon) in zip(coords, coords_dict['polygon']) if (coord > 0).sum() == 3]
-  revised_samples_zscores_and_specimen_dict['zscores'] = [zscore for (coord, zscore) in zip(coords, index_to_samples_zscores_and_specimen_dict['zscores']) if (coord > 0).sum() == 3]
+  roi_sampler = RoiSampler.of(roi_nii)
+  invroiMni = roi_sampler.inverse_affine
+  entry = index_to_samples_zscores_and_specimen_dict
+  if 'sample_table' in entry:
+    # MNI152 coordinates of the samples are precomputed in the shared SampleTable
+    table = entry['sample_table']
+    voxel_coords = mri_to_mni(table.mni[entry['rows']], invroiMni)
+    well, polygon = table.well[entry['rows']], table.polygon[entry['rows']]
+  else:
+    coords_dict = transform_samples_MRI_to_MNI152(entry['samples'], np.dot(invroiMni, specimen['alignment3d']))
+    voxel_coords, well, polygon = coords_dict['mnicoords'], np.asarray(coords_dict['well']), np.asarray(coords_dict['polygon'])
+  coords, probabilities = roi_sampler.probabilities_at(voxel_coords, specimen_name=specimen['name'], wells=well, sample_table=entry.get('sample_table'), rows=entry.get('rows'))
+  mask = (probabilities > filter_threshold) & (probabilities != 0)
+  revised_samples_zscores_and_specimen_dict['coords'] = list(coords[mask])
+  revised_samples_zscores_and_specimen_dict['coord_well'] = well[mask].tolist()
+  revised_samples_zscores_and_specimen_dict['coord_polygon'] = polygon[mask].tolist()
+  revised_samples_zscores_and_specimen_dict['zscores'] = list(np.asarray(entry['zscores'])[mask])
+  revised_samples_zscores_and_specimen_dict['probabilities'] = probabilities[mask]
   revised_samples_zscores_and_specimen_dict['specimen'] = specimen['name']
   return revised_samples_zscores_and_specimen_dict
 
-# TODO write test
 def from_brainmap_retrieve_specimen_factors():
   """
   Download various factors such as age, name, race, gender of the six specimens from Allen Brain Api, save them at cache/specimenFactors.txt and create a dict.
 
   """
+  if store is not None and store.specimen_factors() is not None:
+    return store.specimen_factors()
+
   _key='from_brainmap_retrieve_specimen_factors'
-  if cache.get_from_key(_key) is not None:
-    return cache.get_from_key(_key)
+  cached = cache.get_from_key(_key)
+  if cached is not None:
+    return cached
 
-  url_build_specimen_factors = "http://api.brain-map.org/api/v2/data/query.json?criteria=model::Donor,rma::criteria,products[id$eq2],rma::include,age,rma::options[only$eq%27donors.id,donors.name,donors.race_only,donors.sex%27]"
+  url_build_specimen_factors = ALLEN_API_URL + "/api/v2/data/query.json?criteria=model::Donor,rma::criteria,products[id$eq2],rma::include,age,rma::options[only$eq%27donors.id,donors.name,donors.race_only,donors.sex%27]"
 
-  resp = requests.get(url_build_specimen_factors)
+  resp = get_session().get(url_build_specimen_factors, timeout=REQUEST_TIMEOUT)
 
   resp.raise_for_status()
   resp_json = resp.json()
@@ -224,17 +545,22 @@ def from_brainmap_retrieve_specimen_factors():
   cache.store_key_value(_key, specimen_factors)
   return specimen_factors
 
-def from_brainmap_on_genes_retrieve_data(genes=[]):
+def gene_matrix_available():
   """
-  Based on selected genes, return data from Allen Institute
+  Returns:
+  bool: True if a MicroarrayStore with precomputed winsorized mean zscores of all genes is set
   """
+  return store is not None and store.has_gene_matrix()
 
-  _key=f'from_brainmap_on_genes_retrieve_data__{"_".join(genes)}'
-  if cache.get_from_key(_key) is not None:
-    return cache.get_from_key(_key)
+def from_brainmap_on_genes_retrieve_data(genes=[], gene_level=False):
+  """
+  Based on selected genes, return data from Allen Institute. Nothing is cached at the level of gene lists, the zscores are cached per donor and probe by from_brainmap_retrieve_microarray_filterby_donorids_probeids, so that overlapping gene lists share downloaded data.
+  If a MicroarrayStore is set (see set_store), the data is read from the store instead, without any request to Allen Brain API.
+  With gene_level=True, zscores are the precomputed winsorized mean zscores of the store's gene matrix, samples x genes in the order of the sorted unique genes (key 'genes'), instead of samples x probes.
+  """
 
-  donor_ids = ['15496', '14380', '15697', '9861', '12876', '10021'] #HARDCODING donor_ids
-  specimens  = ['H0351.1015', 'H0351.1012', 'H0351.1016', 'H0351.2001', 'H0351.1009', 'H0351.2002']
+  donor_ids = list(ALLEN_DONORS.keys())
+  specimens  = list(ALLEN_DONORS.values())
 
   samples_zscores_and_specimen_dict = {
     "specimen_info":[],
@@ -244,24 +570,48 @@ def from_brainmap_on_genes_retrieve_data(genes=[]):
   if not len(genes) > 0:
     raise ValueMissingError('genes are required')
 
-  probe_ids = []
-  for gene in genes:
-    data=from_brainmap_retrieve_gene(gene=gene)
-
-    if int(data['Response']['@num_rows']) <= 0:
-      raise ValueError('Please check the spelling of {}. No such gene exists in Allen Brain API.'.format(gene))
-    probe_ids = probe_ids + [ donor['id'] for donor in data['Response']['probes']['probe'] ]
-
-  for specimen in specimens:
-    text = from_brainmap_retrieve_specimen(specimen)
-    samples_zscores_and_specimen_dict['specimen_info'] = samples_zscores_and_specimen_dict['specimen_info'] + [get_specimen_data(text['msg'][0])]
-
-  for donor_id in donor_ids:
-    text = from_brainmap_retrieve_microarray_filterby_donorids_probeids(probe_ids=probe_ids, donor_id=donor_id)
+  if gene_level:
+    if not gene_matrix_available():
+      raise ValueMissingError('gene level data requires a microarray store with a gene matrix')
+    unique_genes = list(np.unique(genes))
+    store_donor_ids = [donor_id for donor_id in donor_ids if donor_id in store.donor_ids]
+    for donor_id in store_donor_ids:
+      samples_zscores_and_specimen_dict['specimen_info'].append(store.specimen(donor_id))
+      samples_zscores_and_specimen_dict['samples_and_zscores'].append({
+        'samples' : store.api_samples(donor_id),
+        'genes' : unique_genes,
+        'zscores' : store.read_genes(donor_id, unique_genes)
+        })
+    return _add_sample_table(samples_zscores_and_specimen_dict, store_donor_ids)
+
+  if store is not None:
+    probe_ids = [probe_id for gene in genes for probe_id in get_probe_ids(gene)]
+    store_donor_ids = [donor_id for donor_id in donor_ids if donor_id in store.donor_ids]
+    for donor_id in store_donor_ids:
+      probes, zscores = store.read(donor_id, probe_ids)
+      samples_zscores_and_specimen_dict['specimen_info'].append(store.specimen(donor_id))
+      samples_zscores_and_specimen_dict['samples_and_zscores'].append({
+        'samples' : store.api_samples(donor_id),
+        'probes' : probes,
+        'zscores' : zscores
+        })
+    return _add_sample_table(samples_zscores_and_specimen_dict, store_donor_ids)
+
+  # the requests are independent of each other, except that the microarray queries need the probe ids
+  with ThreadPoolExecutor(max_workers=1) as executor:
+    specimen_texts = executor.submit(map_concurrently, from_brainmap_retrieve_specimen, specimens)
+
+    probe_ids = [probe_id for gene_probe_ids in map_concurrently(get_probe_ids, genes) for probe_id in gene_probe_ids]
+
+    texts = map_concurrently(lambda donor_id: from_brainmap_retrieve_microarray_filterby_donorids_probeids(probe_ids=probe_ids, donor_id=donor_id), donor_ids)
+
+    for text in specimen_texts.result():
+      samples_zscores_and_specimen_dict['specimen_info'] = samples_zscores_and_specimen_dict['specimen_info'] + [get_specimen_data(text['msg'][0])]
+
+  for text in texts:
     data = text['msg']
 
-    # @TODO clean this
-    zscores = np.array([[float(data['probes'][i]['z-score'][j]) for i in range(len(data['probes']))] for j in range(len(data['samples']))])
+    zscores = decode_zscores(data['probes'], len(data['samples']))
 
     samples_zscores_and_specimen_dict['samples_and_zscores'].append({
       'samples' : data['samples'],
@@ -269,10 +619,24 @@ def from_brainmap_on_genes_retrieve_data(genes=[]):
       'zscores' : zscores
       })
 
-  cache.store_key_value(_key, samples_zscores_and_specimen_dict)
-  return samples_zscores_and_specimen_dict
+  return _add_sample_table(samples_zscores_and_specimen_dict)
+
+def winsorized_mean(values, limits=0.1):
+  """
+  Mean along the last axis after winsorizing, i.e. np.mean(scipy.stats.mstats.winsorize(v, limits=limits)) for every 1-D slice v, computed for all slices at once.
+  Args:
+  values (numpy.ndarray): ... x k array
+  limits (float): fraction of values replaced at each end
+  Returns:
+  numpy.ndarray: array with the last axis removed
+  """
+  values = np.sort(values, axis=-1)
+  k = values.shape[-1]
+  # same indices as scipy.stats.mstats.winsorize
+  low = int(limits * k)
+  up = k - int(k * limits)
+  return np.clip(values, values[..., low:low+1], values[..., up-1:up]).mean(axis=-1)
 
-# TODO write test
 def get_mean_zscores(gene_symbols=None, combined_zscores=None):
   """
   Compute Winsorzed mean of zscores over all probes associated with a given gene. combined_zscores have zscores for all the probes and all the valid coordinates.
@@ -286,24 +650,25 @@ def get_mean_zscores(gene_symbols=None, combined_zscores=None):
   if combined_zscores is None:
     raise ValueMissingError('combined_zscores is required')
 
-  unique_gene_symbols = np.unique(gene_symbols)
+  unique_gene_symbols, codes = np.unique(gene_symbols, return_inverse=True)
+  codes = codes.reshape(-1)
+  combined_zscores = np.asarray(combined_zscores, dtype=np.float64).reshape(-1, len(codes))
 
   '''
-  A = [a,a,a,b,b,b,c,c]
+  A = [a,a,a,b,c,c,b,b]
   B = [a,b,c]
-  Following line of code will give  indices = [[0,1,2],[3,4,5],[6,7]]
-  '''
-  indices = [np.where(np.in1d(gene_symbols, genesymbol))[0] for genesymbol in unique_gene_symbols]
-
-  # this is more legible
-  '''
-  for i in range (len(unique_gene_symbols)):
-    for j in range(len(combined_zscores)):
-      for k in range(len(indices[i])):
-        tmp[j] = combined_zscores[j][indices[i][k]][:]
-    winsorzed_mean_zscores[j][i] = np.mean(sp.stats.mstats.winsorize(tmp[j], limits=0.1))
+  Following lines of code will give probe_columns = [0,1,2,3,6,7,4,5] and first_column = [0,3,6]
   '''
-  winsorzed_mean_zscores =  np.array([[np.mean(sp.stats.mstats.winsorize([combined_zscores[j][indices[i][k]] for k in range(0, len(indices[i]))], limits=0.1)) for i in range (len(unique_gene_symbols))] for j in range(len(combined_zscores))])
+  probe_columns = np.argsort(codes, kind='stable')
+  n_probes = np.bincount(codes, minlength=len(unique_gene_symbols))
+  first_column = np.concatenate([[0], np.cumsum(n_probes)[:-1]])
+
+  # genes with the same number of probes are winsorized together, as one samples x genes x probes block
+  winsorzed_mean_zscores = np.empty((len(combined_zscores), len(unique_gene_symbols)))
+  for k in np.unique(n_probes):
+    genes = np.flatnonzero(n_probes == k)
+    columns = probe_columns[first_column[genes, np.newaxis] + np.arange(k)]
+    winsorzed_mean_zscores[:, genes] = winsorized_mean(combined_zscores[:, columns], limits=0.1)
   return {
     "uniqueId": unique_gene_symbols,
     "combined_zscores": winsorzed_mean_zscores
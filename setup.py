@@ -16,6 +16,7 @@ from setuptools import setup
 setup(name='pyjugex',
       version='1.0.1alpha',
       packages=['pyjugex'],
+      package_data={'pyjugex': ['data/*.json', 'data/*.npz']},
       license='apache-2.0',
       description='Perform web based differential gene expression on two chosen brain regions',
       url='https://github.com/HumanBrainProject/PyJuGEx',
@@ -28,4 +29,8 @@ setup(name='pyjugex',
             'requests',
             'nibabel',
             'xmltodict'
-      ])
+      ],
+      extras_require={
+            'stream': ['ijson'],
+            'store': ['pandas']
+      })
@@ -0,0 +1,49 @@
+# Copyright 2020 Forschungszentrum Jülich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+sys.path.append("..")
+
+from pyjugex import store as pyjugex_store
+import numpy as np
+import os
+import pytest
+
+probes = [(1058685, 'A_23_P20713', 'MAOA'), (1058684, 'CUST_15185_PI416261804', 'MAOA'), (1029154, 'A_24_P232500', 'TAC1'), (1010655, 'A_23_P2920', 'SST')]
+
+def write_donor(directory, donor_id, n_samples, seed):
+  rng = np.random.RandomState(seed)
+  donor_dir = os.path.join(str(directory), 'normalized_microarray_donor{}'.format(donor_id))
+  os.makedirs(donor_dir)
+  with open(os.path.join(donor_dir, 'Probes.csv'), 'w') as f:
+    f.write('"probe_id","probe_name","gene_id","gene_symbol","gene_name","entrez_id","chromosome"\n')
+    for index, (probe_id, name, gene) in enumerate(probes):
+      f.write('{},"{}",{},"{}","{} gene",{},"X"\n'.format(probe_id, name, index + 1, gene, gene, '' if index == 3 else index + 100))
+  expression = rng.normal(5, 2, size=(len(probes), n_samples))
+  with open(os.path.join(donor_dir, 'MicroarrayExpression.csv'), 'w') as f:
+    for (probe_id, _, _), row in zip(probes, expression):
+      f.write('{},{}\n'.format(probe_id, ','.join(str(value) for value in row)))
+  mri = rng.randint(0, 200, size=(n_samples, 3))
+  with open(os.path.join(donor_dir, 'SampleAnnot.csv'), 'w') as f:
+    f.write('"structure_id","slab_num","well_id","slab_type","structure_acronym","structure_name","polygon_id","mri_voxel_x","mri_voxel_y","mri_voxel_z","mni_x","mni_y","mni_z"\n')
+    for i in range(n_samples):
+      mni = mri[i] * 0.5 - 50
+      f.write('4077,22,{},"CX","SFG-m","superior frontal gyrus, left, medial bank of gyrus",{},{},{},{},{},{},{}\n'.format(500 + i, 9000 + i, *mri[i], *mni))
+  return donor_dir, expression
+
+@pytest.fixture
+def microarray_store(tmpdir):
+  donors = {'15496': write_donor(tmpdir, '15496', 7, 0), '9861': write_donor(tmpdir, '9861', 5, 1)}
+  store = pyjugex_store.ingest(str(tmpdir.join('store')), {donor_id: donor_dir for donor_id, (donor_dir, _) in donors.items()}, chunk_size=3)
+  return store, {donor_id: expression for donor_id, (_, expression) in donors.items()}
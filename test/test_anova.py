@@ -0,0 +1,268 @@
+# Copyright 2020 Forschungszentrum Jülich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+sys.path.append("..")
+
+from pyjugex import PyjugexAnova
+from pyjugex.design import AnovaDesign
+from pyjugex.permutation import PermutationPlan, count_distinct_labelings
+from pyjugex.pool import WorkerPool, shared_memory
+from pyjugex.fwe import MaxFAccumulator, sequential_decision, gpd_tail_p
+from pyjugex.error import ValueMissingError
+import itertools
+import numpy as np
+import pytest
+
+specimen_names = ['H0351.1015', 'H0351.1012', 'H0351.1016', 'H0351.2001', 'H0351.1009', 'H0351.2002']
+specimen_age = [24.0, 31.0, 39.0, 49.0, 55.0, 57.0]
+specimen_race = ['White', 'White', 'Black', 'Hispanic', 'White', 'White']
+
+def get_factors(n_samples=23, n_probes=5, seed=0):
+  rng = np.random.RandomState(seed)
+  specimen_index = rng.randint(0, len(specimen_names), n_samples)
+  return {
+    'area': list(rng.choice(['img1', 'img2'], n_samples)),
+    'specimen': [specimen_names[i] for i in specimen_index],
+    'age': [specimen_age[i] for i in specimen_index],
+    'race': [specimen_race[i] for i in specimen_index],
+    'combined_zscores': rng.normal(size=(n_samples, n_probes)).tolist(),
+    'gene_symbols': ['MAOA', 'MAOA', 'TAC1', 'TAC1', 'TAC1'][:n_probes]
+  }
+
+def test_numpy_engine_matches_statsmodels():
+  factors = get_factors()
+  reference = PyjugexAnova(engine='statsmodels', **factors)
+  reference._first_iteration()
+  anova = PyjugexAnova(engine='numpy', **factors)
+  anova._first_iteration()
+  assert np.allclose(anova.F_vec_ref_anovan, reference.F_vec_ref_anovan)
+
+def test_area_f_with_permutation():
+  factors = get_factors()
+  design = AnovaDesign(area=factors['area'], specimen=factors['specimen'], age=factors['age'], race=factors['race'])
+  y = np.array(factors['combined_zscores'])[:, 0]
+  permutation = np.random.RandomState(1).permutation(design.n_samples)
+  permuted = AnovaDesign(area=np.array(factors['area'])[permutation], specimen=factors['specimen'], age=factors['age'], race=factors['race'])
+  assert np.isclose(design.area_f(y, permutation=permutation), permuted.area_f(y))
+
+def test_design_with_an_empty_roi():
+  factors = get_factors()
+  with pytest.raises(ValueMissingError, match='no samples in img2'):
+    AnovaDesign(area=['img1'] * len(factors['area']), specimen=factors['specimen'], age=factors['age'], race=factors['race'])
+
+def test_unknown_engine():
+  with pytest.raises(ValueError):
+    PyjugexAnova(engine='foo', **get_factors())
+
+def test_area_f_all_genes_at_once():
+  factors = get_factors(n_probes=5)
+  design = AnovaDesign(area=factors['area'], specimen=factors['specimen'], age=factors['age'], race=factors['race'])
+  zscores = np.array(factors['combined_zscores'])
+  permutation = np.random.RandomState(2).permutation(design.n_samples)
+  f = design.area_f_projected(design.project(zscores), permutation=permutation)
+  assert f.shape == (5,)
+  assert np.allclose(f, [design.area_f(zscores[:, i], permutation=permutation) for i in range(5)])
+
+def test_area_f_block():
+  factors = get_factors(n_probes=5)
+  design = AnovaDesign(area=factors['area'], specimen=factors['specimen'], age=factors['age'], race=factors['race'])
+  projected = design.project(np.array(factors['combined_zscores']))
+  rng = np.random.RandomState(3)
+  permutations = np.array([rng.permutation(design.n_samples) for _ in range(7)])
+  f = design.area_f_block(projected, permutations)
+  assert f.shape == (7, 5)
+  for permutation, f_perm in zip(permutations, f):
+    assert np.allclose(f_perm, design.area_f_projected(projected, permutation=permutation))
+
+def test_fwe_correction_in_blocks():
+  anova = PyjugexAnova(n_rep=50, block_size=16, keep_f_matrix=True, **get_factors())
+  anova.run()
+  assert anova.F_mat_perm_anovan.shape == (50, 2)
+  assert np.array_equal(anova.F_mat_perm_anovan[0], anova.F_vec_ref_anovan)
+  assert sorted(anova.result.keys()) == ['MAOA', 'TAC1']
+  assert all(0 < p <= 1 for p in anova.result.values())
+
+def test_permutation_plan():
+  plan = PermutationPlan(n_samples=23, n_perm=3000, seed=42)
+  assert plan.permutations.shape == (3000, 23)
+  assert plan.permutations.dtype == np.uint16
+  assert np.array_equal(np.sort(plan.block(0, 10), axis=1), np.tile(np.arange(23), (10, 1)))
+  assert np.array_equal(plan.permutations, PermutationPlan(n_samples=23, n_perm=3000, seed=plan.seed).permutations)
+  assert not np.array_equal(plan.permutations, PermutationPlan(n_samples=23, n_perm=3000, seed=43).permutations)
+
+def test_seeded_fwe_correction_is_reproducible():
+  f_mats = []
+  for engine, block_size in [('numpy', 7), ('numpy', 256), ('statsmodels', 256)]:
+    anova = PyjugexAnova(n_rep=20, engine=engine, block_size=block_size, seed=42, keep_f_matrix=True, **get_factors())
+    anova.run()
+    f_mats.append(anova.F_mat_perm_anovan)
+  assert np.allclose(f_mats[0], f_mats[1], rtol=1e-12)
+  assert np.allclose(f_mats[0], f_mats[2])
+
+@pytest.mark.skipif(shared_memory is None, reason='requires multiprocessing.shared_memory')
+def test_worker_pool_matches_single_process():
+  reference = PyjugexAnova(n_rep=40, seed=42, keep_f_matrix=True, **get_factors())
+  reference.run()
+  with WorkerPool(n_workers=2) as pool:
+    for engine in ['numpy', 'numpy', 'statsmodels']:
+      anova = PyjugexAnova(n_rep=40, seed=42, block_size=8, engine=engine, worker_pool=pool, keep_f_matrix=True, **get_factors())
+      anova.run()
+      assert np.allclose(anova.F_mat_perm_anovan, reference.F_mat_perm_anovan)
+      assert anova.result == reference.result
+      assert anova.uncorrected_p == reference.uncorrected_p
+
+@pytest.mark.skipif(shared_memory is None, reason='requires multiprocessing.shared_memory')
+def test_worker_pool_shares_once_per_analysis(monkeypatch):
+  reference = PyjugexAnova(n_rep=400, seed=42, keep_f_matrix=True, **get_factors())
+  reference.run()
+  calls = {'share': 0, 'accumulate': 0}
+  share, accumulate = WorkerPool.share, WorkerPool.accumulate
+  monkeypatch.setattr(WorkerPool, 'share', lambda pool, *args: calls.update(share=calls['share'] + 1) or share(pool, *args))
+  monkeypatch.setattr(WorkerPool, 'accumulate', lambda pool, *args, **kwargs: calls.update(accumulate=calls['accumulate'] + 1) or accumulate(pool, *args, **kwargs))
+  with WorkerPool(n_workers=2) as pool:
+    anova = PyjugexAnova(n_rep=400, seed=42, block_size=8, alpha=0.85, worker_pool=pool, keep_f_matrix=True, **get_factors())
+    anova.run()
+  assert calls['share'] == 1 and calls['accumulate'] > 1
+  assert np.allclose(anova.F_mat_perm_anovan, reference.F_mat_perm_anovan[:len(anova.F_mat_perm_anovan)])
+
+def test_max_F_accumulator():
+  rng = np.random.RandomState(4)
+  F_ref = rng.chisquare(1, 6)
+  F_mat = rng.chisquare(1, (99, 6))
+  accumulator = MaxFAccumulator(F_ref, n_perm=99)
+  for start in [40, 0, 80]:
+    accumulator.add(start, F_mat[start:start+40])
+  full = np.vstack([F_ref, F_mat])
+  assert accumulator.F_mat is None
+  assert np.array_equal(accumulator.fwe_corrected_p(), np.count_nonzero(full.max(1)[:, np.newaxis] >= F_ref, axis=0) / 100)
+  assert np.array_equal(accumulator.uncorrected_p(), np.count_nonzero(full >= F_ref, axis=0) / 100)
+
+def test_max_F_accumulator_tolerates_rounding():
+  F_ref = np.array([2.0, 5.0])
+  accumulator = MaxFAccumulator(F_ref, n_perm=2)
+  # the first permutation reproduces F_ref up to rounding
+  accumulator.add(0, [[2.0 * (1 - 1e-14), 1.0], [1.0, 4.0]])
+  assert list(accumulator.uncorrected_p()) == [2 / 3, 1 / 3]
+  assert list(accumulator.fwe_counts()) == [3, 1]
+
+def test_sequential_decision():
+  assert list(sequential_decision([0, 50, 400, 3], 1000, alpha=0.05)) == [1, 0, -1, 1]
+  assert list(sequential_decision([0, 1], 10, alpha=0.05)) == [0, 0]
+
+def test_sequential_decision_error_over_looks():
+  # at p == alpha every decision is wrong. With 20 looks the error needs to be spent over the looks
+  def wrong_decisions(look_error, n_looks=20, round_size=100, n_genes=4000):
+    rng = np.random.RandomState(0)
+    counts = np.ones(n_genes)
+    decision = np.zeros(n_genes, dtype=int)
+    for look in range(n_looks):
+      counts += rng.binomial(round_size, 0.05, n_genes)
+      new_decision = sequential_decision(counts, 1 + (look + 1) * round_size, alpha=0.05, error=look_error)
+      decision[decision == 0] = new_decision[decision == 0]
+    return np.mean(decision != 0)
+  assert wrong_decisions(0.05) > 0.05
+  assert wrong_decisions(0.05 / 20) <= 0.05
+
+def test_sequential_fwe_correction_stops_early():
+  factors = get_factors(n_samples=40)
+  anova = PyjugexAnova(n_rep=5000, block_size=50, alpha=0.05, seed=42, **factors)
+  anova.run()
+  assert anova.max_F_accumulator.n_done + 1 < 5000
+  assert all(decision['significant'] is False for decision in anova.decisions.values())
+  assert all(decision['n_perm'] <= anova.max_F_accumulator.n_done + 1 for decision in anova.decisions.values())
+  assert all(p > 0.05 for p in anova.result.values())
+
+def test_gpd_tail_p():
+  null = np.random.RandomState(5).exponential(size=2000)
+  p, diagnostics = gpd_tail_p(null, [0.5, 12.0])
+  assert diagnostics['fitted']
+  assert list(diagnostics['method']) == ['empirical', 'gpd']
+  assert p[0] == (np.count_nonzero(null >= 0.5) + 1) / 2001
+  # exact tail probability is exp(-12), about 6e-6
+  assert 1e-7 < p[1] < 1e-4
+
+def test_gpd_tail_p_bounded_null():
+  # the fitted tail of a uniform null has a finite endpoint near 1
+  null = np.random.RandomState(0).uniform(size=2000)
+  p, diagnostics = gpd_tail_p(null, [0.999, 1.5, 3.0, 0.5])
+  assert diagnostics['fitted'] and diagnostics['shape'] < 0
+  assert np.all(p > 0)
+  assert list(diagnostics['beyond_endpoint']) == [False, True, True, False]
+  assert list(diagnostics['method']) == ['gpd', 'empirical', 'empirical', 'empirical']
+  assert p[1] == p[2] == 1 / 2001
+
+def test_gpd_tail_p_is_clamped_to_min_p():
+  null = np.random.RandomState(5).exponential(size=2000)
+  p, diagnostics = gpd_tail_p(null, [12.0, 25.0], min_p=1e-7)
+  assert list(diagnostics['method']) == ['gpd', 'gpd']
+  assert list(diagnostics['clamped']) == [False, True]
+  assert p[1] == 1e-7 and p[0] > 1e-7
+
+def test_gpd_tail_p_falls_back_to_empirical():
+  null = np.repeat([1.0, 2.0], 1000)
+  p, diagnostics = gpd_tail_p(null, [3.0])
+  assert not diagnostics['fitted']
+  assert p[0] == 1 / 2001
+
+def test_collate_result_with_tail_approximation():
+  anova = PyjugexAnova(n_rep=400, seed=42, tail_approximation=True, **get_factors())
+  anova.run()
+  assert anova.tail_diagnostics is not None
+  assert all(0 < p <= 1 for p in anova.result.values())
+  permutation_p = anova.max_F_accumulator.fwe_corrected_p()
+  for gene, p, method in zip(anova.genesymbol_and_mean_zscores['uniqueId'], permutation_p, anova.tail_diagnostics['method']):
+    if method == 'empirical':
+      assert anova.result[gene] == p
+
+def test_exhaustive_permutation_plan():
+  labels = ['img1', 'img2', 'img1', 'img3', 'img2', 'img1']
+  plan = PermutationPlan.exhaustive(labels)
+  assert count_distinct_labelings(labels) == 60
+  assert len(plan) == 59
+  relabelled = {tuple(np.array(labels)[permutation]) for permutation in plan.permutations}
+  assert len(relabelled) == 59
+  assert tuple(labels) not in relabelled
+
+def test_exact_fwe_correction():
+  factors = get_factors(n_samples=9)
+  anova = PyjugexAnova(n_rep=1000, **factors)
+  anova.run()
+  assert anova.exact
+  n_labelings = count_distinct_labelings(factors['area'])
+  assert anova.max_F_accumulator.n_done + 1 == n_labelings
+
+  design = AnovaDesign(area=factors['area'], specimen=factors['specimen'], age=factors['age'], race=factors['race'])
+  mean_zscores = anova.genesymbol_and_mean_zscores['combined_zscores']
+  F_ref = design.area_f_projected(design.project(mean_zscores))
+  labelings = {tuple(np.array(factors['area'])[list(permutation)]) for permutation in itertools.permutations(range(9))}
+  assert len(labelings) == n_labelings
+  max_F = [AnovaDesign(area=list(labeling), specimen=factors['specimen'], age=factors['age'], race=factors['race']).area_f_projected(design.project(mean_zscores)).max() for labeling in labelings]
+  expected = np.count_nonzero(np.array(max_F)[:, np.newaxis] >= F_ref * (1 - 1e-10), axis=0) / n_labelings
+  assert np.allclose([anova.result['MAOA'], anova.result['TAC1']], expected)
+
+  monte_carlo = PyjugexAnova(n_rep=50, max_exact=0, **factors)
+  monte_carlo.run()
+  assert not monte_carlo.exact
+
+def test_precomputed_mean_zscores():
+  factors = get_factors()
+  reference = PyjugexAnova(n_rep=20, seed=42, **factors)
+  reference.run()
+  mean_zscores = reference.genesymbol_and_mean_zscores['combined_zscores']
+  factors.pop('combined_zscores')
+  factors['gene_symbols'] = ['MAOA', 'TAC1']
+  anova = PyjugexAnova(n_rep=20, seed=42, mean_zscores=mean_zscores, **factors)
+  anova.run()
+  assert anova.result == reference.result
@@ -0,0 +1,107 @@
+# Copyright 2020 Forschungszentrum Jülich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+sys.path.append("..")
+
+from pyjugex import cache as pyjugex_cache
+from pyjugex.cache import MemoryCache, DiskCache
+from pyjugex import ValueMissingError
+import numpy as np
+import os
+import threading
+import pytest
+
+def test_memory_cache():
+  cache = MemoryCache()
+  assert cache.get_from_key('foo') is None
+  cache.store_key_value('foo', {'bar': 1})
+  assert cache.get_from_key('foo') == {'bar': 1}
+  assert cache.stats() == {'hits': 1, 'misses': 1}
+  with pytest.raises(ValueMissingError):
+    cache.get_from_key()
+
+def test_disk_cache_persists(tmpdir):
+  value = {'zscores': np.arange(6.).reshape(2, 3), 'probes': ['1023146']}
+  DiskCache(str(tmpdir)).store_key_value('foo', value)
+
+  cache = DiskCache(str(tmpdir))
+  cached = cache.get_from_key('foo')
+  assert np.array_equal(cached['zscores'], value['zscores'])
+  assert cached['probes'] == value['probes']
+  assert cache.get_from_key('bar') is None
+  assert cache.stats() == {'hits': 1, 'misses': 1}
+  assert not [name for _, _, names in os.walk(str(tmpdir)) for name in names if name.endswith('.tmp')]
+
+def test_disk_cache_ttl(tmpdir, monkeypatch):
+  cache = DiskCache(str(tmpdir), ttl=60)
+  cache.store_key_value('foo', 'bar')
+  assert cache.get_from_key('foo') == 'bar'
+  now = pyjugex_cache.time.time()
+  monkeypatch.setattr(pyjugex_cache.time, 'time', lambda: now + 61)
+  assert cache.get_from_key('foo') is None
+  assert not os.path.exists(cache.key_path('foo'))
+
+def test_disk_cache_evicts_least_recently_used(tmpdir):
+  cache = DiskCache(str(tmpdir))
+  for index, key in enumerate(['a', 'b', 'c']):
+    cache.store_key_value(key, bytes(1000))
+    os.utime(cache.key_path(key), (index, index))
+  # reading 'a' makes 'b' the least recently used
+  assert cache.get_from_key('a') is not None
+
+  cache.max_bytes = 2 * os.path.getsize(cache.key_path('a'))
+  cache.evict()
+  assert cache.get_from_key('b') is None
+  assert cache.get_from_key('a') is not None
+  assert cache.get_from_key('c') is not None
+
+def test_disk_cache_scans_only_when_full(tmpdir, monkeypatch):
+  cache = DiskCache(str(tmpdir), max_bytes=10 ** 6)
+  scans = []
+  entries = cache.entries
+  monkeypatch.setattr(cache, 'entries', lambda: scans.append(1) or entries())
+  for index in range(50):
+    cache.store_key_value(str(index), bytes(1000))
+  assert len(scans) == 1
+  assert cache._size == cache.size_bytes()
+
+  cache.max_bytes = 20 * os.path.getsize(cache.key_path('0'))
+  scans.clear()
+  cache.store_key_value('full', bytes(1000))
+  assert len(scans) == 1
+  assert cache.size_bytes() <= cache.low_water * cache.max_bytes
+  assert cache.get_from_key('full') is not None
+
+def test_disk_cache_from_threads(tmpdir):
+  cache = DiskCache(str(tmpdir), max_bytes=10 ** 6)
+  def worker(thread_index):
+    for index in range(50):
+      key = str(index % 20)
+      if cache.get_from_key(key) is None:
+        cache.store_key_value(key, bytes(1000 + thread_index))
+  threads = [threading.Thread(target=worker, args=(thread_index,)) for thread_index in range(8)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert cache.hits + cache.misses == 8 * 50
+  assert cache._size == cache.size_bytes()
+
+def test_disk_cache_ignores_corrupt_files(tmpdir):
+  cache = DiskCache(str(tmpdir))
+  cache.store_key_value('foo', 'bar')
+  with open(cache.key_path('foo'), 'wb') as f:
+    f.write(b'not a pickle')
+  assert cache.get_from_key('foo') is None
@@ -0,0 +1,56 @@
+# Copyright 2020 Forschungszentrum Jülich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+sys.path.append("..")
+
+from pyjugex import util
+from pyjugex.geometry import GeometricRoi, SphereRoi, BoxRoi, CoordinateRoi, geometric_roi
+from pyjugex.samples import SampleTable
+import numpy as np
+import pytest
+
+def random_entries(rng, n_samples=(300, 200)):
+  specimen_info = [{'name': 'H0351.1015', 'alignment3d': np.eye(4)}, {'name': 'H0351.2001', 'alignment3d': np.array([[1., 0, 0, 2], [0, 1, 0, -3], [0, 0, 1, 0], [0, 0, 0, 1]])}]
+  entries = [{
+    'samples': [{'sample': {'mri': rng.randint(-40, 40, size=3).tolist(), 'well': i, 'polygon': i}} for i in range(n)],
+    'zscores': rng.normal(size=(n, 2))
+  } for n in n_samples]
+  table = SampleTable.from_api([entry['samples'] for entry in entries], specimen_info)
+  return specimen_info, entries, table
+
+@pytest.mark.parametrize('roi', [SphereRoi([5, -3, 10], 12), BoxRoi([-10, -20, 0], [15, 5, 8]), CoordinateRoi([[0, 0, 0], [20, 20, -20], [21, 19, -18]], 8), CoordinateRoi([], 8)])
+def test_geometric_roi(roi):
+  specimen_info, entries, table = random_entries(np.random.RandomState(0))
+  assert np.array_equal(roi.rows(table), np.flatnonzero(roi.contains(table.mni)))
+
+  for index, (specimen, entry) in enumerate(zip(specimen_info, entries)):
+    # with and without the SampleTable
+    tabled = dict(entry, sample_table=table, rows=table.donor_rows(index))
+    expected = util.filter_coordinates_and_zscores(roi, entry, specimen, 0)
+    result = util.filter_coordinates_and_zscores(roi, tabled, specimen, 0)
+    assert result['coord_well'] == expected['coord_well']
+    assert np.array_equal(np.array(result['coords']).reshape(-1, 3), np.array(expected['coords']).reshape(-1, 3))
+    assert np.array_equal(np.array(result['zscores']).reshape(-1, 2), np.array(expected['zscores']).reshape(-1, 2))
+    if len(roi.rows(table)) > 0 and index == 0:
+      assert len(result['coord_well']) > 0
+
+def test_geometric_roi_from_dict():
+  assert isinstance(geometric_roi({'center': [0, 0, 0], 'radius': 5}), SphereRoi)
+  assert isinstance(geometric_roi({'lower': [0, 0, 0], 'upper': [1, 1, 1]}), BoxRoi)
+  assert isinstance(geometric_roi({'coordinates': [[0, 0, 0]], 'radius': 5}), CoordinateRoi)
+  with pytest.raises(ValueError):
+    geometric_roi({'radius': 5})
+  with pytest.raises(TypeError):
+    GeometricRoi()
@@ -0,0 +1,111 @@
+# Copyright 2020 Forschungszentrum Jülich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+sys.path.append("..")
+
+from webjugex.pmap_cache import PMapCache
+import gzip
+import http.server
+import threading
+import time
+import nibabel as nib
+import numpy as np
+import pytest
+
+class PMapService(http.server.BaseHTTPRequestHandler):
+  """
+  Serves a gzipped map per path, with an ETag
+  """
+  requests = []
+  delay = 0
+
+  def do_GET(self):
+    PMapService.requests.append(('GET', self.path))
+    if self.headers.get('If-None-Match') == '"v1"':
+      self.send_response(304)
+      self.end_headers()
+      return
+    self.reply()
+
+  def do_POST(self):
+    self.rfile.read(int(self.headers['Content-Length']))
+    PMapService.requests.append(('POST', self.path))
+    self.reply()
+
+  def reply(self):
+    time.sleep(PMapService.delay)
+    img_arr = np.zeros((10, 10, 10), dtype=np.float32)
+    img_arr[:int(self.path.strip('/').split('.')[0]), 0, 0] = 0.5
+    body = gzip.compress(nib.Nifti1Image(img_arr, np.eye(4)).to_bytes())
+    self.send_response(200)
+    self.send_header('ETag', '"v1"')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+@pytest.fixture
+def pmap_service():
+  server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), PMapService)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  PMapService.requests = []
+  PMapService.delay = 0
+  yield 'http://127.0.0.1:{}'.format(server.server_address[1])
+  server.shutdown()
+
+def test_pmap_cache(pmap_service):
+  pmap_cache = PMapCache()
+  roi_sampler = pmap_cache.get(pmap_service + '/3.nii.gz', name='Area a')
+  assert roi_sampler.flat_indices.tolist() == [0, 100, 200] and np.allclose(roi_sampler.values, 0.5)
+  assert pmap_cache.get(pmap_service + '/3.nii.gz') is roi_sampler
+  # the body is part of the key
+  pmap_cache.get(pmap_service + '/3.nii.gz', body={'areas': [{'name': 'Area a'}]})
+  pmap_cache.get(pmap_service + '/3.nii.gz', body={'areas': [{'name': 'Area a'}]})
+  assert PMapService.requests == [('GET', '/3.nii.gz'), ('POST', '/3.nii.gz')]
+  assert (pmap_cache.hits, pmap_cache.misses, len(pmap_cache)) == (2, 2, 2)
+
+  # revalidated with the ETag once max_age has passed
+  pmap_cache.max_age = 0
+  assert pmap_cache.get(pmap_service + '/3.nii.gz') is roi_sampler
+  assert PMapService.requests[-1] == ('GET', '/3.nii.gz') and pmap_cache.hits == 3
+
+def test_pmap_cache_evicts_least_recently_used(pmap_service):
+  pmap_cache = PMapCache(max_bytes=50)
+  for name in ['1', '2', '1', '3']:
+    pmap_cache.get(pmap_service + '/{}.nii.gz'.format(name), name=name)
+  # 12 bytes per voxel, the map of 2 was used least recently
+  assert PMapCache.key(pmap_service + '/2.nii.gz') not in pmap_cache
+  assert PMapCache.key(pmap_service + '/1.nii.gz') in pmap_cache and pmap_cache.nbytes == 12 + 36
+
+def test_pmap_cache_prewarm(pmap_service):
+  pmap_cache = PMapCache()
+  pmap_cache.popularity.update({'Area c': 5, 'Area a': 2, 'Area b': 1, 'Area x': 9})
+  pmap_cache.prewarm({name: pmap_service + '/{}.nii.gz'.format(index + 1) for index, name in enumerate(['Area a', 'Area b', 'Area c'])}, limit=2)
+  assert PMapService.requests == [('GET', '/3.nii.gz'), ('GET', '/1.nii.gz')]
+
+def test_pmap_cache_downloads_concurrent_misses_once(pmap_service):
+  PMapService.delay = 0.3
+  pmap_cache = PMapCache()
+  roi_samplers = []
+  threads = [threading.Thread(target=lambda: roi_samplers.append(pmap_cache.get(pmap_service + '/2.nii.gz'))) for _ in range(8)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert PMapService.requests == [('GET', '/2.nii.gz')]
+  assert len(roi_samplers) == 8 and all(roi_sampler is roi_samplers[0] for roi_sampler in roi_samplers)
+  assert (pmap_cache.hits, pmap_cache.misses) == (7, 1)
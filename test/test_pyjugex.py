@@ -15,11 +15,69 @@
 import sys
 sys.path.append("..")
 
-from pyjugex import PyjugexAnalysis, ValueMissingError
-
+from pyjugex import PyjugexAnalysis, ValueMissingError, util, pyjugex as pyjugex_module
+from pyjugex.geometry import BoxRoi
+import nibabel as nib
+import numpy as np
 import pytest
 
 def test_PyjugexAnalysis():
   analysis=PyjugexAnalysis()
   with pytest.raises(ValueMissingError):
     analysis.differential_analysis()
+
+def test_threshold_sweep(microarray_store, monkeypatch):
+  store, _ = microarray_store
+  monkeypatch.setattr(util, 'store', store)
+  monkeypatch.setattr(pyjugex_module, 'from_brainmap_retrieve_specimen_factors', lambda: {'name': ['H0351.1015', 'H0351.2001'], 'age': [24, 57], 'race': ['Hispanic', 'White or Caucasian']})
+  # samples are at mni -50 ... 50, roi1 covers x < 0 and roi2 x >= 0, with random probabilities
+  rng = np.random.RandomState(0)
+  affine = np.array([[4., 0, 0, -60], [0, 4, 0, -60], [0, 0, 4, -60], [0, 0, 0, 1]])
+  maps = [rng.rand(31, 31, 31).astype(np.float32) for _ in range(2)]
+  maps[0][15:] = 0
+  maps[1][:15] = 0
+  roi1, roi2 = [nib.Nifti1Image(img_arr, affine) for img_arr in maps]
+
+  analysis = PyjugexAnalysis(n_rep=50, filter_threshold=[0.1, 0.4], roi1=roi1, roi2=roi2, gene_list=['MAOA', 'TAC1'], seed=7)
+  result = analysis.differential_analysis()
+  assert list(result) == [0.1, 0.4] and analysis.anova is analysis.anovas[0.1]
+  assert sum(result[0.4]['n_samples'].values()) < sum(result[0.1]['n_samples'].values())
+
+  # the same as separate analyses with the same seed
+  for threshold in [0.1, 0.4]:
+    single = PyjugexAnalysis(n_rep=50, filter_threshold=threshold, roi1=roi1, roi2=roi2, gene_list=['MAOA', 'TAC1'], seed=7)
+    single.differential_analysis()
+    assert single.anova.result == result[threshold]['result']
+    assert single.result[threshold]['n_samples'] == result[threshold]['n_samples']
+
+def test_geometric_rois(microarray_store, monkeypatch):
+  store, _ = microarray_store
+  monkeypatch.setattr(util, 'store', store)
+  monkeypatch.setattr(pyjugex_module, 'from_brainmap_retrieve_specimen_factors', lambda: {'name': ['H0351.1015', 'H0351.2001'], 'age': [24, 57], 'race': ['Hispanic', 'White or Caucasian']})
+  analysis = PyjugexAnalysis(n_rep=20, roi1={'lower': [-60, -60, -60], 'upper': [-0.25, 60, 60]}, roi2={'lower': [-0.24, -60, -60], 'upper': [60, 60, 60]}, gene_list=['MAOA', 'TAC1'], seed=1)
+  # resolved once, the rows found in the sample table are kept by the region
+  assert isinstance(analysis.roi1, BoxRoi) and analysis._roi_sampler(analysis.roi1) is analysis.roi1
+  result = analysis.differential_analysis()
+  # every sample is in one of the two halves
+  assert sum(result[0.2]['n_samples'].values()) == 12
+  assert set(analysis.anova.result) == {'MAOA', 'TAC1'}
+  assert len(analysis.roi1._rows) == 1
+
+def test_threshold_sweep_reuses_and_skips(microarray_store, monkeypatch):
+  store, _ = microarray_store
+  monkeypatch.setattr(util, 'store', store)
+  monkeypatch.setattr(pyjugex_module, 'from_brainmap_retrieve_specimen_factors', lambda: {'name': ['H0351.1015', 'H0351.2001'], 'age': [24, 57], 'race': ['Hispanic', 'White or Caucasian']})
+  runs = []
+  run = pyjugex_module.PyjugexAnova.run
+  monkeypatch.setattr(pyjugex_module.PyjugexAnova, 'run', lambda anova: runs.append(anova) or run(anova))
+  # samples inside a geometric region have probability 1, so 0.2 and 0.5 select the same samples and 1 none
+  analysis = PyjugexAnalysis(n_rep=20, filter_threshold=[0.2, 0.5, 1], roi1={'lower': [-60, -60, -60], 'upper': [-0.25, 60, 60]}, roi2={'lower': [-0.24, -60, -60], 'upper': [60, 60, 60]}, gene_list=['MAOA', 'TAC1'], seed=1)
+  result = analysis.differential_analysis()
+  assert len(runs) == 1
+  assert analysis.anovas[0.5] is analysis.anovas[0.2] and result[0.5]['result'] == result[0.2]['result']
+  assert analysis.anovas[1.0] is None and result[1.0]['n_samples'] == {'img1': 0, 'img2': 0}
+  assert all(np.isnan(p) for p in result[1.0]['result'].values())
+
+  # a scalar threshold is a float key as well
+  analysis.filter_threshold = 1
+  assert list(analysis.differential_analysis()) == [1.0] and isinstance(list(analysis.result)[0], float)
@@ -0,0 +1,59 @@
+# Copyright 2020 Forschungszentrum Jülich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+sys.path.append("..")
+
+from pyjugex import util, ValueMissingError
+from pyjugex.region_index import RegionIndex, atlas_probability_maps
+from pyjugex.samples import SampleTable
+import nibabel as nib
+import numpy as np
+import pytest
+
+def random_donors(rng, n_samples=(40, 30)):
+  specimen_info = [{'name': 'H0351.1015', 'alignment3d': np.eye(4)}, {'name': 'H0351.2001', 'alignment3d': np.array([[1., 0, 0, 1], [0, 1, 0, -1], [0, 0, 1, 0], [0, 0, 0, 1]])}]
+  entries = []
+  for donor_index, n in enumerate(n_samples):
+    samples = [{'sample': {'mri': rng.randint(-2, 22, size=3).tolist(), 'well': int(well), 'polygon': 1}} for well in rng.permutation(1000)[:n] + 1000 * donor_index]
+    entries.append({'samples': samples, 'zscores': rng.normal(size=(n, 2))})
+  return specimen_info, entries
+
+def test_region_index(tmpdir):
+  rng = np.random.RandomState(0)
+  specimen_info, entries = random_donors(rng)
+  maps = {name: nib.Nifti1Image(np.where(rng.rand(20, 20, 20) > 0.5, rng.rand(20, 20, 20), 0).astype(np.float32), np.eye(4)) for name in ['Area a', 'Area b']}
+
+  index = RegionIndex.build(SampleTable.from_api([entry['samples'] for entry in entries], specimen_info), maps)
+  index.save(str(tmpdir.join('regions.npz')))
+  index = RegionIndex.load(str(tmpdir.join('regions.npz')))
+  assert len(index) == 2 and 'Area b' in index and index.probabilities.shape == (70, 2)
+
+  for name, roi in maps.items():
+    for filter_threshold in [0.2, 0.7]:
+      for specimen, entry in zip(specimen_info, entries):
+        # samples in a different order than when the index was built
+        entry = {'samples': entry['samples'][::-1], 'zscores': entry['zscores'][::-1]}
+        expected = util.filter_coordinates_and_zscores(roi, entry, specimen, 0, filter_threshold=filter_threshold)
+        result = util.filter_coordinates_and_zscores(index.region(name), entry, specimen, 0, filter_threshold=filter_threshold)
+        assert result['coord_well'] == expected['coord_well'] and len(result['coord_well']) > 0
+        assert np.array_equal(np.array(result['coords']), np.array(expected['coords']))
+        assert np.array_equal(np.array(result['zscores']), np.array(expected['zscores']))
+
+  with pytest.raises(ValueMissingError):
+    index.region('Area c')
+
+def test_atlas_probability_maps():
+  atlas = [{'name': 'root', 'PMapURL': None, 'children': [{'name': 'Area a', 'PMapURL': 'http://pmaps/a.nii.gz', 'children': []}, {'name': 'lobe', 'PMapURL': None, 'children': [{'name': 'Area b', 'PMapURL': 'http://pmaps/b.nii.gz', 'children': []}]}]}]
+  assert atlas_probability_maps(atlas) == {'Area a': 'http://pmaps/a.nii.gz', 'Area b': 'http://pmaps/b.nii.gz'}
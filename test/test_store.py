@@ -0,0 +1,82 @@
+# Copyright 2020 Forschungszentrum Jülich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+sys.path.append("..")
+
+from pyjugex import util, OfflineError
+from pyjugex.store import MicroarrayStore
+import numpy as np
+import pytest
+
+def test_ingest_and_read(microarray_store):
+  store, expressions = microarray_store
+  store = MicroarrayStore(store.root)
+  assert sorted(store.donor_ids) == ['15496', '9861']
+  assert store.zscores('15496').shape == (7, 4)
+  assert store.zscores('15496').flags['F_CONTIGUOUS']
+
+  read_probes, zscores = store.read('9861', ['1029154', '1058685', '42'])
+  assert [probe['id'] for probe in read_probes] == [1029154, 1058685]
+  expression = expressions['9861'][[2, 0]]
+  expected = (expression - expression.mean(axis=1, keepdims=True)) / expression.std(axis=1, keepdims=True)
+  assert np.allclose(zscores, expected.T, atol=1e-6)
+
+  assert store.probe_ids_of_gene('MAOA') == ['1058685', '1058684']
+  samples = store.api_samples('15496')
+  assert len(samples) == 7 and samples[0]['sample']['well'] == 500
+  # the fitted alignment reproduces the mni coordinates of the sample table
+  assert np.allclose(store.specimen('15496')['alignment3d'], [[0.5, 0, 0, -50], [0, 0.5, 0, -50], [0, 0, 0.5, -50], [0, 0, 0, 1]])
+
+def test_offline_retrieval_from_store(microarray_store, monkeypatch):
+  store, _ = microarray_store
+  monkeypatch.setattr(util, 'store', store)
+  monkeypatch.setattr(util, 'OFFLINE', True)
+  data = util.from_brainmap_on_genes_retrieve_data(genes=['TAC1', 'MAOA'])
+  assert [specimen['name'] for specimen in data['specimen_info']] == ['H0351.1015', 'H0351.2001']
+  assert [samples_and_zscores['zscores'].shape for samples_and_zscores in data['samples_and_zscores']] == [(7, 3), (5, 3)]
+  with pytest.raises(ValueError):
+    util.get_probe_ids('MAOAX')
+  with pytest.raises(OfflineError):
+    util.from_brainmap_retrieve_specimen('H0351.1015')
+
+def test_gene_matrix(microarray_store):
+  store, _ = microarray_store
+  assert store.has_gene_matrix()
+  assert list(store.genes) == ['MAOA', 'SST', 'TAC1']
+  for donor_id in store.donor_ids:
+    probes, zscores = store.read(donor_id, [probe_id for probe_id, _, _ in probes_of_store(store)])
+    expected = util.get_mean_zscores([probe['gene-symbol'] for probe in probes], zscores)
+    assert np.allclose(store.read_genes(donor_id, ['TAC1', 'MAOA']), expected['combined_zscores'][:, [2, 0]], atol=1e-6)
+    assert np.allclose(store.read_genes(donor_id, ['SST'], rows=[1, 3]), expected['combined_zscores'][[1, 3]][:, [1]], atol=1e-6)
+  with pytest.raises(ValueError):
+    store.read_genes(store.donor_ids[0], ['MAOAX'])
+
+def probes_of_store(store):
+  return zip(store.probes['id'], store.probes['name'], store.probes['gene_symbol'])
+
+def test_sample_table(microarray_store, monkeypatch):
+  store, _ = microarray_store
+  monkeypatch.setattr(util, 'store', store)
+  data = util.from_brainmap_on_genes_retrieve_data(genes=['TAC1'])
+  table = data['samples_and_zscores'][0]['sample_table']
+  assert table is data['samples_and_zscores'][1]['sample_table']
+  assert table.donor_names == ['H0351.1015', 'H0351.2001'] and len(table) == 12
+  assert table.donor.tolist() == [0] * 7 + [1] * 5
+  for entry, specimen in zip(data['samples_and_zscores'], data['specimen_info']):
+    samples = [sample['sample'] for sample in entry['samples']]
+    assert table.well[entry['rows']].tolist() == [sample['well'] for sample in samples]
+    assert np.allclose(table.mni[entry['rows']], util.transform_samples_MRI_to_MNI152(entry['samples'], specimen['alignment3d'])['mnicoords'])
+  # shared by later analyses
+  assert util.from_brainmap_on_genes_retrieve_data(genes=['MAOA'])['samples_and_zscores'][0]['sample_table'] is table
@@ -15,10 +15,19 @@
 import sys
 sys.path.append("..")
 
-from pyjugex import util
+from pyjugex import util, probe_index
+from pyjugex.roi import RoiSampler
 import pytest
 from requests.exceptions import HTTPError
 import re
+import numpy as np
+import http.server
+import json
+import threading
+from urllib.parse import unquote
+from scipy.stats import mstats
+import nibabel as nib
+import gzip
 
 test_nii_url = 'https://neuroglancer.humanbrainproject.eu/precomputed/JuBrain/17/icbm152casym/pmaps/OFC_Fo1_l_N10_nlin2MNI152ASYM2009C_3.4_publicP_b76752e4ec43a64644f4a66658fed730.nii.gz'
 test_pmap_service = 'http://pmap-pmap-service.apps-dev.hbp.eu'
@@ -92,6 +101,8 @@ def test_is_gzipped():
   assert util.is_gzipped(not_gzipped_1) == False
   assert util.is_gzipped(is_gzipped)
   assert util.is_gzipped(is_gzipped_1)
+  assert util.is_gzipped(not_gzipped, gzip.compress(b'nifti'))
+  assert util.is_gzipped(not_gzipped, b'nifti') == False
 
 def test_from_brainmap_retrieve_gene():
   resp_dist = util.from_brainmap_retrieve_gene('MAOA')
@@ -110,3 +121,200 @@ def test_from_brainmap_retrieve_microarray_filterby_donorids_probeids():
   donor_id = '15496'
   resp = util.from_brainmap_retrieve_microarray_filterby_donorids_probeids(donor_id=donor_id, probe_ids=probe_ids)
   assert resp['success']
+
+def test_get_mean_zscores_matches_scipy_winsorize():
+  rng = np.random.RandomState(0)
+  gene_symbols = list(rng.choice(['MAOA', 'TAC1', 'GAPDH', 'APOE', 'SST'], 40)) + ['ZIC1']
+  combined_zscores = rng.normal(size=(7, len(gene_symbols)))
+  result = util.get_mean_zscores(gene_symbols, combined_zscores.tolist())
+  assert list(result['uniqueId']) == sorted(set(gene_symbols))
+  expected = [[np.mean(mstats.winsorize(row[np.array(gene_symbols) == gene], limits=0.1)) for gene in result['uniqueId']] for row in combined_zscores]
+  assert np.allclose(result['combined_zscores'], expected)
+
+class AllenApiStandIn(http.server.BaseHTTPRequestHandler):
+  """
+  Answers the queries of pyjugex.util like Allen Brain API, for genes MAOA (probes 1, 2) and TAC1 (probes 3, 4, 5)
+  """
+  gene_probes = {'MAOA': ['1', '2'], 'TAC1': ['3', '4', '5']}
+  requested_probes = []
+  requested_genes = []
+  fail_next = False
+  # probes which are left out of microarray responses
+  unknown_probes = set()
+  samples = [{'sample': {'well': 1, 'polygon': 11, 'mri': [10, 20, 30]}}, {'sample': {'well': 2, 'polygon': 12, 'mri': [11, 21, 31]}}]
+
+  def do_GET(self):
+    path = unquote(self.path)
+    if AllenApiStandIn.fail_next:
+      AllenApiStandIn.fail_next = False
+      self.send_response(503)
+      self.end_headers()
+      return
+    if 'query.xml' in path:
+      gene = re.search(r"acronym\$eq(.*?)\]", path).group(1)
+      AllenApiStandIn.requested_genes.append(gene)
+      probe_ids = self.gene_probes.get(gene, [])
+      probes = ''.join('<probe><id>{}</id></probe>'.format(probe_id) for probe_id in probe_ids)
+      self.reply('<Response success="true" num_rows="{}"><probes>{}</probes></Response>'.format(len(probe_ids), probes), 'text/xml')
+    elif 'Specimen' in path:
+      name = re.search(r"name\$eq'(.*?)'", path).group(1)
+      alignment3d = {'tvr_{:02d}'.format(i): float(i in (0, 4, 8)) for i in range(12)}
+      self.reply(json.dumps({'success': True, 'msg': [{'name': name, 'alignment3d': alignment3d}]}))
+    else:
+      probe_ids = re.search(r'probes\$in(.*?)\]', path).group(1).split(',')
+      AllenApiStandIn.requested_probes.append(probe_ids)
+      self.reply(json.dumps({
+        'success': True,
+        'msg': {
+          'samples': AllenApiStandIn.samples,
+          'probes': [{'id': int(probe_id), 'z-score': [probe_id, probe_id]} for probe_id in reversed(probe_ids) if probe_id not in AllenApiStandIn.unknown_probes]
+        }
+      }))
+
+  def reply(self, body, content_type='application/json'):
+    body = body.encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+@pytest.fixture
+def allen_api(monkeypatch):
+  server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), AllenApiStandIn)
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  AllenApiStandIn.requested_probes = []
+  AllenApiStandIn.requested_genes = []
+  AllenApiStandIn.unknown_probes = set()
+  monkeypatch.setattr(util, 'ALLEN_API_URL', 'http://127.0.0.1:{}'.format(server.server_address[1]))
+  monkeypatch.setattr(util, 'cache', util.MemoryCache())
+  # probes of MAOA and TAC1 are only known to the stand in
+  monkeypatch.setattr(probe_index, '_probe_index', probe_index.ProbeIndex.from_mapping({}))
+  yield AllenApiStandIn
+  server.shutdown()
+  server.server_close()
+
+def test_microarray_is_cached_per_probe(allen_api):
+  resp = util.from_brainmap_retrieve_microarray_filterby_donorids_probeids(donor_id='15496', probe_ids=['1', '2'])
+  assert [probe['id'] for probe in resp['msg']['probes']] == [1, 2]
+  resp = util.from_brainmap_retrieve_microarray_filterby_donorids_probeids(donor_id='15496', probe_ids=['3', '2', '1'])
+  assert [probe['id'] for probe in resp['msg']['probes']] == [3, 2, 1]
+  assert len(resp['msg']['samples']) == 2
+  util.from_brainmap_retrieve_microarray_filterby_donorids_probeids(donor_id='15496', probe_ids=['2', '3'])
+  assert allen_api.requested_probes == [['1', '2'], ['3']]
+
+def test_microarray_probes_line_up_with_requested_probes(allen_api):
+  resp = util.from_brainmap_retrieve_microarray_filterby_donorids_probeids(donor_id='15496', probe_ids=['1', '2', '1'])
+  assert [probe['id'] for probe in resp['msg']['probes']] == [1, 2, 1]
+  assert allen_api.requested_probes == [['1', '2']]
+  allen_api.unknown_probes = {'7'}
+  with pytest.raises(util.ValueMissingError):
+    util.from_brainmap_retrieve_microarray_filterby_donorids_probeids(donor_id='15496', probe_ids=['3', '7'])
+
+def test_long_probe_lists_are_split(allen_api, monkeypatch):
+  monkeypatch.setattr(util, 'MAX_PROBES_PER_REQUEST', 2)
+  resp = util.from_brainmap_retrieve_microarray_filterby_donorids_probeids(donor_id='15496', probe_ids=['1', '2', '3', '4', '5'])
+  assert [probe['id'] for probe in resp['msg']['probes']] == [1, 2, 3, 4, 5]
+  assert sorted(allen_api.requested_probes) == [['1', '2'], ['3', '4'], ['5']]
+
+def test_from_brainmap_on_genes_retrieve_data_concurrently(allen_api):
+  allen_api.fail_next = True
+  data = util.from_brainmap_on_genes_retrieve_data(genes=['MAOA', 'TAC1'])
+  assert [specimen['name'] for specimen in data['specimen_info']] == ['H0351.1015', 'H0351.1012', 'H0351.1016', 'H0351.2001', 'H0351.1009', 'H0351.2002']
+  assert len(data['samples_and_zscores']) == 6
+  for samples_and_zscores in data['samples_and_zscores']:
+    assert samples_and_zscores['zscores'].tolist() == [[1., 2., 3., 4., 5.], [1., 2., 3., 4., 5.]]
+
+def test_get_probe_ids_falls_back_to_api(allen_api, monkeypatch):
+  monkeypatch.setattr(probe_index, '_probe_index', probe_index.ProbeIndex.from_mapping({'MAOA': ['1', '2']}))
+  assert util.get_probe_ids('MAOA') == ['1', '2']
+  assert allen_api.requested_genes == []
+  # TAC1 is not in the index
+  assert util.get_probe_ids('TAC1') == ['3', '4', '5']
+  with pytest.raises(ValueError):
+    util.get_probe_ids('MAOAX')
+
+def test_probe_index_roundtrip(tmpdir):
+  probes = tmpdir.join('Probes.csv')
+  probes.write('"probe_id","probe_name","gene_id","gene_symbol"\n3,"A_23_P1",2,"TAC1"\n1,"A_23_P2",1,"MAOA"\n2,"CUST_1",1,"MAOA"\n')
+  output = str(tmpdir.join('index.npz'))
+  probe_index.main([str(probes), '-o', output])
+  index = probe_index.ProbeIndex.load(output)
+  assert index.get_probe_ids('MAOA') == ['1', '2']
+  assert index.get_probe_ids('TAC1') == ['3']
+  assert 'SST' not in index and index.get_probe_ids('SST') is None
+
+def test_decode_zscores():
+  probes = [{'id': 1, 'z-score': ['0.5', '-1.25', '2']}, {'id': 2, 'z-score': [1, 2, 3]}]
+  zscores = util.decode_zscores(probes, 3, dtype=np.float32)
+  assert zscores.dtype == np.float32
+  assert zscores.tolist() == [[0.5, 1], [-1.25, 2], [2, 3]]
+
+@pytest.mark.skipif(util.ijson is None, reason='requires ijson')
+def test_microarray_response_is_parsed_incrementally(allen_api, monkeypatch):
+  for stream in [True, False]:
+    monkeypatch.setattr(util, 'STREAM_JSON', stream)
+    monkeypatch.setattr(util, 'cache', util.MemoryCache())
+    resp = util.from_brainmap_retrieve_microarray_filterby_donorids_probeids(donor_id='15496', probe_ids=['4', '3'])
+    assert [probe['id'] for probe in resp['msg']['probes']] == [4, 3]
+    assert isinstance(resp['msg']['probes'][0]['z-score'], np.ndarray)
+    assert resp['msg']['samples'] == AllenApiStandIn.samples
+
+def test_filter_coordinates_and_zscores():
+  img_arr = np.zeros((4, 5, 6), dtype=np.float32)
+  img_arr[0, 0, 0] = 0.9
+  img_arr[1, 2, 3] = 0.5
+  img_arr[3, 4, 5] = 0.1
+  roi = nib.Nifti1Image(img_arr, np.diag([2., 2., 2., 1.]))
+  # the identity alignment puts sample i at mni mri, i.e. at voxel mri / 2
+  mri = [[0, 0, 0], [2.4, 4.2, 6], [6, 8, 10], [-2, 0, 0], [8, 0, 0], [2, 4, 6]]
+  entry = {
+    'samples': [{'sample': {'mri': coord, 'well': i, 'polygon': 10 + i}} for i, coord in enumerate(mri)],
+    'zscores': np.arange(len(mri) * 2, dtype=np.float64).reshape(-1, 2)
+  }
+  result = util.filter_coordinates_and_zscores(roi, entry, {'name': 'H0351.1015', 'alignment3d': np.eye(4)}, 0, filter_threshold=0.2)
+  assert [coord.tolist() for coord in result['coords']] == [[0, 0, 0], [1, 2, 3], [1, 2, 3]]
+  assert result['coord_well'] == [0, 1, 5] and result['coord_polygon'] == [10, 11, 15]
+  assert np.array_equal(np.array(result['zscores']), entry['zscores'][[0, 1, 5]])
+  assert result['name'] == 'img1' and result['specimen'] == 'H0351.1015'
+
+def test_roi_sampler_reads_only_sampled_voxels(tmpdir):
+  rng = np.random.RandomState(0)
+  img_arr = np.where(rng.rand(10, 11, 12) > 0.8, rng.rand(10, 11, 12), 0).astype(np.float32)
+  voxel_coords = rng.uniform(-2, 13, size=(200, 3))
+  results = []
+  for filename in ['roi.nii', 'roi.nii.gz']:
+    nib.save(nib.Nifti1Image(img_arr, np.eye(4)), str(tmpdir.join(filename)))
+    sampler = RoiSampler(nib.load(str(tmpdir.join(filename))))
+    # uncompressed maps are memory mapped, compressed ones only keep their nonzero voxels
+    assert (sampler.img_arr is not None) == (filename == 'roi.nii')
+    results.append(sampler.sample(voxel_coords, 0.3))
+  voxels = np.rint(voxel_coords).astype(int)
+  in_bounds = np.all((voxels >= 0) & (voxels < img_arr.shape), axis=1)
+  expected = np.array([in_bound and img_arr[tuple(voxel)] > 0.3 for voxel, in_bound in zip(voxels, in_bounds)])
+  for sampled_voxels, mask in results:
+    assert np.array_equal(sampled_voxels, voxels) and np.array_equal(mask, expected)
+
+def test_read_byte_via_nib_in_memory():
+  img_arr = (np.arange(60).reshape(3, 4, 5) % 7).astype(np.uint8)
+  img = nib.Nifti1Image(img_arr, np.diag([2., 2., 2., 1.]))
+  img.header.set_slope_inter(0.5, 0)
+  content = img.to_bytes()
+  for data, is_gzipped in [(content, False), (gzip.compress(content), True)]:
+    roi = util.read_byte_via_nib(data, gzip=is_gzipped)
+    assert roi.get_data_dtype() == np.float32 and isinstance(roi.dataobj, np.ndarray)
+    assert np.allclose(np.asanyarray(roi.dataobj), img_arr * 0.5)
+    assert np.array_equal(roi.affine, img.affine)
+
+def test_get_all_samples_table(allen_api):
+  table = util.get_all_samples_table()
+  assert table.donor_names == ['H0351.1015', 'H0351.1012', 'H0351.1016', 'H0351.2001', 'H0351.1009', 'H0351.2002']
+  assert len(table) == 12 and table.well.tolist() == [1, 2] * 6
+  assert allen_api.requested_probes == [[util.SAMPLES_PROBE_ID]] * 6
+  # the samples of the donors are cached
+  util.from_brainmap_retrieve_samples('15496')
+  assert len(allen_api.requested_probes) == 6
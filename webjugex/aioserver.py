@@ -18,13 +18,16 @@ import json
 import nibabel as nib
 import hbp_human_atlas as atlas
 import webjugex
+import pyjugex.util
 import os
 import requests
 import socket
 import re
+import threading
 
 import HBPLogger
 from default import default_param
+from pmap_cache import PMapCache, prewarm_from_atlas
 
 _fluent_host = os.getenv('FLUENT_HOST', None)
 _fluent_protocol = os.getenv('FLUENT_PROTOCOL', None)
@@ -44,11 +47,21 @@ if os.getenv('GENE_CACHE_DIR') is not None:
 else:
     gene_cache_dir = '.pyjugex'
 
-def get_roi_img_array(obj):
-    pmap_resp = webjugex.util.get_pmap(obj['PMapURL'], obj.get('body', None))
+# decoded PMaps, shared by all requests
+pmap_cache = PMapCache(
+    max_bytes=int(os.getenv('PMAP_CACHE_MAX_BYTES', 512 * 1024 ** 2)),
+    max_age=float(os.getenv('PMAP_CACHE_MAX_AGE', 3600)),
+    timeout=float(os.getenv('PMAP_REQUEST_TIMEOUT', 60)))
+# number of most requested regions of files/filteredJuBrainJson.json to download at startup
+_pmap_prewarm = int(os.getenv('PMAP_PREWARM', 0))
+_pmap_popularity_file = os.getenv('PMAP_POPULARITY_FILE', None)
 
-    filename = webjugex.util.get_filename_from_resp(pmap_resp)
-    return webjugex.util.read_byte_via_nib(pmap_resp.content, gzip=webjugex.util.is_gzipped(filename))
+def get_roi_img_array(obj):
+    # regions of the region index are looked up by name, without downloading their PMap
+    region_index = pyjugex.util.region_index
+    if region_index is not None and obj.get('body', None) is None and obj['name'] in region_index:
+        return region_index.region(obj['name'])
+    return pmap_cache.get(obj['PMapURL'], obj.get('body', None), name=obj['name'])
 
 def run_pyjugex_analysis(jsonobj):
     roi1 = {}
@@ -69,6 +82,8 @@ def run_pyjugex_analysis(jsonobj):
     jugex = webjugex.Analysis(gene_cache_dir=gene_cache_dir, filter_threshold=filter_threshold, single_probe_mode = single_probe_mode, verbose=True, n_rep=n_rep)
 
     result = jugex.DifferentialAnalysis(jsonobj['selectedGenes'], roi1, roi2)
+    if _pmap_popularity_file is not None:
+        pmap_cache.save_popularity(_pmap_popularity_file)
     return result
 
 async def handle_post(request):
@@ -121,6 +136,10 @@ def main():
     cors.add(app.router.add_post("/jugex_v2", handle_post2), {"*": aiohttp_cors.ResourceOptions(expose_headers="*", allow_headers="*")})
     cors.add(app.router.add_get("/",return_auto_complete), {"*": aiohttp_cors.ResourceOptions(expose_headers="*", allow_headers="*")})
     cors.add(app.router.add_static('/public/',path=str('./public/')))
+    if _pmap_prewarm > 0:
+        if _pmap_popularity_file is not None:
+            pmap_cache.load_popularity(_pmap_popularity_file)
+        threading.Thread(target=prewarm_from_atlas, args=(pmap_cache, 'files/filteredJuBrainJson.json', _pmap_prewarm), daemon=True).start()
     logger.log('info', {"message": "webjugex backend started"})
     web.run_app(app,host="0.0.0.0",port=8003)
 
@@ -0,0 +1,188 @@
+# Copyright 2020 Forschungszentrum Jülich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import Counter, OrderedDict
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import requests
+
+from pyjugex.roi import RoiSampler
+from pyjugex.region_index import atlas_probability_maps
+from pyjugex.util import read_byte_via_nib, get_filename_from_resp, is_gzipped, REQUEST_TIMEOUT
+
+class PMapCache:
+    """
+    Cache of decoded PMaps, keyed by the PMapURL and a hash of the request body (e.g. of the pmap multimerge service).
+
+    Only the nonzero voxels of a map are kept, as the sparse voxel set of a pyjugex RoiSampler, so that a cached whole brain map costs a few MB instead of hundreds, and requests with any filter_threshold are answered exactly from the cache. The least recently used maps are evicted when the cached maps exceed max_bytes.
+
+    Maps are revalidated after max_age seconds with a conditional request (If-None-Match / If-Modified-Since), a 304 response keeps the cached map. Concurrent requests for the same map wait for a single download. Downloads time out after timeout seconds.
+
+    Usage:
+
+    pmap_cache = PMapCache(max_bytes=512 * 1024 ** 2)
+    roi_sampler = pmap_cache.get(obj['PMapURL'], obj.get('body'), name=obj['name'])
+    pmap_cache.prewarm(atlas_probability_maps(atlas), limit=30) # most requested regions first
+    """
+
+    def __init__(self, max_bytes=256 * 1024 ** 2, max_age=3600, timeout=REQUEST_TIMEOUT):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.timeout = timeout
+        self.popularity = Counter()
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # threading.Event per key which is being downloaded
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(url, body=None):
+        """
+        Returns:
+        str: cache key of the map at url, requested with body
+        """
+        body_hash = hashlib.sha256(json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest() if body is not None else ''
+        return '{} {}'.format(url, body_hash)
+
+    @property
+    def nbytes(self):
+        with self._lock:
+            return sum(entry['nbytes'] for entry in self._entries.values())
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, url, body=None, name=None):
+        """
+        Args:
+        url (str): PMapURL
+        body (dict): optional, json body to post to url
+        name (str): optional, region name, counted for prewarm
+        Returns:
+        RoiSampler: sampler of the map
+        """
+        if name is not None:
+            with self._lock:
+                self.popularity[name] += 1
+
+        key = self.key(url, body)
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    if time.time() - entry['validated'] < self.max_age:
+                        self.hits += 1
+                        return entry['roi_sampler']
+                in_flight = self._in_flight.get(key)
+                if in_flight is None:
+                    in_flight = self._in_flight[key] = threading.Event()
+                    break
+            # another request is downloading the map, use its result (or download it if that failed)
+            in_flight.wait()
+
+        try:
+            return self._fetch(key, url, body, entry)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            in_flight.set()
+
+    def _fetch(self, key, url, body, entry):
+        headers = {}
+        if entry is not None and entry['etag'] is not None:
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry['last_modified'] is not None:
+            headers['If-Modified-Since'] = entry['last_modified']
+        if body is None:
+            resp = requests.get(url, headers=headers, timeout=self.timeout)
+        else:
+            resp = requests.post(url, json=body, headers=headers, timeout=self.timeout)
+        resp.raise_for_status()
+
+        if entry is not None and resp.status_code == 304:
+            with self._lock:
+                self.hits += 1
+                entry['validated'] = time.time()
+            return entry['roi_sampler']
+
+        with self._lock:
+            self.misses += 1
+        roi_sampler = self._decode(resp)
+        self._store(key, {
+            'roi_sampler': roi_sampler,
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+            'validated': time.time(),
+            'nbytes': roi_sampler.nbytes
+        })
+        return roi_sampler
+
+    def _decode(self, resp):
+        return RoiSampler(read_byte_via_nib(resp.content, gzip=is_gzipped(get_filename_from_resp(resp), resp.content)))
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            total = sum(cached['nbytes'] for cached in self._entries.values())
+            # never evict the map which was just stored
+            while total > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                total -= evicted['nbytes']
+
+    def prewarm(self, pmap_urls, limit=None):
+        """
+        Download and decode the most requested regions, e.g. at startup
+        Args:
+        pmap_urls (dict): PMapURL per region name, see pyjugex.region_index.atlas_probability_maps
+        limit (int): optional, maximum number of regions. Regions which were never requested are only included if no popularity is known.
+        """
+        names = [name for name, _ in self.popularity.most_common() if name in pmap_urls] if self.popularity else list(pmap_urls)
+        for name in names[:limit]:
+            try:
+                self.get(pmap_urls[name])
+            except Exception as e:
+                logging.getLogger(__name__).warning('prewarm of {} failed: {}'.format(name, e))
+
+    def load_popularity(self, path):
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.popularity.update(json.load(f))
+
+    def save_popularity(self, path):
+        with self._lock:
+            popularity = dict(self.popularity)
+        fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(popularity, f)
+        os.replace(tmp_name, path)
+
+def prewarm_from_atlas(pmap_cache, atlas_path, limit=None):
+    """
+    Prewarm pmap_cache with the regions of the atlas tree at atlas_path, e.g. files/filteredJuBrainJson.json
+    """
+    with open(atlas_path, 'r') as f:
+        pmap_cache.prewarm(atlas_probability_maps(json.load(f)), limit=limit)
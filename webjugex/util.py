@@ -13,7 +13,6 @@
 # limitations under the License.
 
 import requests
-import tempfile
 import nibabel as nib
 import os
 import re
@@ -21,6 +20,11 @@ import logging
 import xmltodict
 import numpy as np
 
+from pyjugex.samples import mri_to_mni
+from pyjugex.roi import RoiSampler
+# decodes PMaps in memory, without temporary files
+from pyjugex.util import read_byte_via_nib
+
 def get_filename_from_resp(resp):
   # determine the type of the file. look at the disposition header, use PMapURL as a fallback
   content_disposition_header = resp.headers.get('content-disposition')
@@ -40,17 +44,6 @@ def get_pmap(url, json=None):
   resp.raise_for_status()
   return resp
 
-# input is byte
-# save to cache, then generate a random hashed file name
-# specify gzip to append .gz
-
-def read_byte_via_nib(content, gzip=False):
-  fp, fp_name = tempfile.mkstemp(suffix='.nii.gz' if gzip else '.nii')
-  os.write(fp, content)
-  img_array = nib.load(fp_name)
-  os.close(fp)
-  return img_array
-
 def is_gzipped(filename):
   return re.search(r"\.gz$", filename) is not None
 
@@ -125,24 +118,18 @@ def transform_samples_MRI_to_MNI152(samples, transformation_mat):
             well - list of well id for the sample the respective coordinate belongs to
             polygon -  list of polygon id for the sample the respective coordinate belongs to
     """
-    np_T = np.array(transformation_mat[0:3, 0:4])
-    mri = np.vstack(s['sample']['mri'] for s in samples)
-    add = np.ones((len(mri), 1), dtype=np.int)
-    mri = np.append(mri, add, axis=1)
-    mri = np.transpose(mri)
-    coords = np.matmul(np_T, mri)
-    coords = coords.transpose()
+    mri = np.array([s['sample']['mri'] for s in samples], dtype=np.float64).reshape(-1, 3)
+    coords = mri_to_mni(mri, transformation_mat)
     well = [s['sample']['well'] for s in samples]
     polygon = [s['sample']['polygon'] for s in samples]
     return {'mnicoords' : coords, 'well' : well, 'polygon' : polygon}
-    #return coords
 
 # TODO write test
 def filter_coordinates_and_zscores(roi_nii, index_to_samples_zscores_and_specimen_dict, specimen, index, roi_name='Unnamed ROI', filter_threshold=0.2):
   """
   Populate self.filtered_coords_and_zscores with zscores and coords for samples which belong to a particular specimen and spatially represented in the given roi.
   Args:
-    roi (nib.nifti1.Nifti1Image): probability map of a region of interest.
+    roi_nii (nib.nifti1.Nifti1Image, RoiSampler or IndexedRegion): probability map of a region of interest, or anything else with RoiSampler.probabilities_at.
     index_to_samples_zscores_and_specimen_dict (dict): Index into samples_zscores_and_specimen_dict
     specimen (dict): dictionary representing a specimen with its name and transformation matrix as keys
     index (int): 0 or 1, representing which region of interest it is.
@@ -158,21 +145,14 @@ def filter_coordinates_and_zscores(roi_nii, index_to_samples_zscores_and_specime
   revised_samples_zscores_and_specimen_dict = dict.fromkeys(['zscores', 'coords', 'coord_well', 'coord_polygon', 'specimen', 'name'])
   revised_samples_zscores_and_specimen_dict['realname'] = roi_name
   revised_samples_zscores_and_specimen_dict['name'] = 'img{}'.format(str(index+1))
-  img_arr = roi_nii.get_data()
-  invroiMni = np.linalg.inv(roi_nii.affine)
-  T = np.dot(invroiMni, specimen['alignment3d'])
-  '''
-  coords = transform_samples_MRI_to_MNI152(index_to_samples_zscores_and_specimen_dict['samples'], T)
-  coords = (np.rint(coords)).astype(int)
-  coords = [np.array([-1, -1, -1]) if (coord > 0).sum() != 3 or img_arr[coord[0],coord[1],coord[2]] <= self.filter_threshold or img_arr[coord[0],coord[1],coord[2]] == 0 else coord for coord in coords]
-  revised_samples_zscores_and_specimen_dict['coords'] = [coord for coord in coords if (coord > 0).sum() == 3]
-  '''
+  roi_sampler = RoiSampler.of(roi_nii)
+  T = np.dot(roi_sampler.inverse_affine, specimen['alignment3d'])
   coords_dict = transform_samples_MRI_to_MNI152(index_to_samples_zscores_and_specimen_dict['samples'], T)
-  coords = (np.rint(coords_dict['mnicoords'])).astype(int)
-  coords = [np.array([-1, -1, -1]) if (coord > 0).sum() != 3 or img_arr[coord[0],coord[1],coord[2]] <= filter_threshold or img_arr[coord[0],coord[1],coord[2]] == 0 else coord for coord in coords]
-  revised_samples_zscores_and_specimen_dict['coords'] = [coord for coord in coords if (coord > 0).sum() == 3]
-  revised_samples_zscores_and_specimen_dict['coord_well'] = [well for (coord, well) in zip(coords, coords_dict['well']) if (coord > 0).sum() == 3]
-  revised_samples_zscores_and_specimen_dict['coord_polygon'] = [polygon for (coord, polygon) in zip(coords, coords_dict['polygon']) if (coord > 0).sum() == 3]
-  revised_samples_zscores_and_specimen_dict['zscores'] = [zscore for (coord, zscore) in zip(coords, index_to_samples_zscores_and_specimen_dict['zscores']) if (coord > 0).sum() == 3]
+  coords, probabilities = roi_sampler.probabilities_at(coords_dict['mnicoords'], specimen_name=specimen['name'], wells=coords_dict['well'])
+  mask = (probabilities > filter_threshold) & (probabilities != 0)
+  revised_samples_zscores_and_specimen_dict['coords'] = list(coords[mask])
+  revised_samples_zscores_and_specimen_dict['coord_well'] = np.asarray(coords_dict['well'])[mask].tolist()
+  revised_samples_zscores_and_specimen_dict['coord_polygon'] = np.asarray(coords_dict['polygon'])[mask].tolist()
+  revised_samples_zscores_and_specimen_dict['zscores'] = list(np.asarray(index_to_samples_zscores_and_specimen_dict['zscores'])[mask])
   revised_samples_zscores_and_specimen_dict['specimen'] = specimen['name']
   return revised_samples_zscores_and_specimen_dict
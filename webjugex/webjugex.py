@@ -24,10 +24,15 @@ import statsmodels.api as sm
 from statsmodels.formula.api import ols
 import requests, requests.exceptions
 import shutil
-import multiprocessing
 import nibabel as nib
 import logging
 import util
+from pyjugex.pool import get_worker_pool, shared_memory
+from pyjugex.design import AnovaDesign
+from pyjugex.permutation import PermutationPlan
+from pyjugex.fwe import MaxFAccumulator
+from pyjugex.roi import RoiSampler
+from pyjugex.util import get_mean_zscores, get_probe_ids, decode_zscores
 
 """
 Find a set of differentially expressed genes between two user defined volumes of interest based on JuBrain maps. The tool downloads expression values of user specified sets of genes from Allen Brain API. Then, it uses zscores to find which genes are expressed differentially between the user specified regions of interests. This tool is available as a Python package.
@@ -55,18 +60,6 @@ def get_specimen_data(specimen_metadata):
     [0, 0, 0, 1]])
     return specimen
 
-def unwrap_self_do_anova_with_permutation_rep(*args, **kwargs):
-    """
-    Helper function to enable usage of the multiprocessing module inside a class.
-    Args:
-          *args: Variable length argument list.
-          **kwargs: Arbitrary keyword arguments.
-    Returns:
-              do_anova_with_permutation_rep()
-    """
-    return Analysis.do_anova_with_permutation_rep(*args, **kwargs)
-
-
 class Analysis:
 
     def __init__(self, gene_cache_dir, filter_threshold=0.2, single_probe_mode=False, verbose=False, n_rep=1000):
@@ -141,14 +134,14 @@ class Analysis:
         Driver routine
         Args:
               gene_list (list): list of gene symbols to perform differential analysis with, provided by the user.
-              roi1 (nibabel.nifti1.Nifti1Image): Nifti1Image representing the probability map of the first region of interest, chosen by the user.
-              roi2 (nibabel.nifti1.Nifti1Image): Nifti1Image representing the probability map of the second region of interest, chosen by the user.
+              roi1 (dict): name and data of the first region of interest, chosen by the user. data is the Nifti1Image of its probability map, a RoiSampler (e.g. from the PMapCache), or an IndexedRegion of a pyjugex RegionIndex.
+              roi2 (dict): name and data of the second region of interest, chosen by the user.
         Returns:
              dict: A dictionary representing the gene symbols and their corresponding p values
         """
         if not gene_list:
             raise ValueError('Atleast one gene is needed for the analysis')
-        if not (isinstance(roi1['data'], nib.nifti1.Nifti1Image) and isinstance(roi2['data'], nib.nifti1.Nifti1Image)):
+        if not all(isinstance(roi['data'], nib.nifti1.Nifti1Image) or hasattr(roi['data'], 'probabilities_at') for roi in [roi1, roi2]):
             raise ValueError('Atleast two valid regions of interest are needed')
         self.set_candidate_genes(gene_list)
         self.set_roi_MNI152(roi1, 0)
@@ -180,13 +173,11 @@ class Analysis:
 
         for gene in self.gene_list:
 
-            data = util.from_brainmap_retrieve_gene(gene=gene, verbose=self.verbose)
+            probe_ids = get_probe_ids(gene, verbose=self.verbose)
 
-            if int(data['Response']['@num_rows']) <= 0:
-                raise ValueError('Please check the spelling of {}. No such gene exists in Allen Brain API.'.format(gene))
-            self.probe_keys = self.probe_keys + [donor['id'] for donor in data['Response']['probes']['probe']]
-            self.probe_ids = self.probe_ids + [donor['id'] for donor in data['Response']['probes']['probe'] if gene in self.gene_list_to_download]
-            self.gene_symbols = self.gene_symbols + [gene for donor in data['Response']['probes']['probe']]
+            self.probe_keys = self.probe_keys + probe_ids
+            self.probe_ids = self.probe_ids + [probe_id for probe_id in probe_ids if gene in self.gene_list_to_download]
+            self.gene_symbols = self.gene_symbols + [gene for probe_id in probe_ids]
         if self.verbose:
             logging.getLogger(__name__).info('probe_ids: {}'.format(self.probe_ids))
             logging.getLogger(__name__).info('gene_symbols: {}'.format(self.gene_symbols))
@@ -212,7 +203,7 @@ class Analysis:
             with open(os.path.join(donor_path, 'probes.txt'), 'r') as f:
                 probes = json.load(f)
             newprobes = [p for p in probes if p['id'] in probe_keys_dict.keys()]
-            zscores = np.array([[float(p['z-score'][j]) for p in newprobes] for j in range(len(samples))])
+            zscores = decode_zscores(newprobes, len(samples))
             self.samples_zscores_and_specimen_dict['samples_and_zscores'] = self.samples_zscores_and_specimen_dict['samples_and_zscores']  + [{'samples' : samples, 'zscores' : zscores}]
             if self.verbose:
                 logging.getLogger(__name__).info('inside readcachedata {}, {}'.format(len(self.samples_zscores_and_specimen_dict['samples_and_zscores'][-1]['samples']), self.samples_zscores_and_specimen_dict['samples_and_zscores'][-1]['zscores'].shape))
@@ -226,11 +217,13 @@ class Analysis:
         """
         if index < 0 or index > 1:
             raise ValueError('only 0 and 1 are valid choices')
+        # decompressed once for all donors
+        roi_sampler = RoiSampler.of(roi['data'])
         for i in range(len(self.samples_zscores_and_specimen_dict['specimen_info'])):
             self.filtered_coords_and_zscores.append(
                 util.filter_coordinates_and_zscores(
                     roi_name=roi['name'],
-                    roi_nii=roi['data'],
+                    roi_nii=roi_sampler,
                     index_to_samples_zscores_and_specimen_dict=self.samples_zscores_and_specimen_dict['samples_and_zscores'][i],
                     specimen=self.samples_zscores_and_specimen_dict['specimen_info'][i],
                     index=index,
@@ -247,7 +240,7 @@ class Analysis:
         if not os.path.exists(donor_path):
             os.makedirs(donor_path)
 
-        zscores = np.array([[float(data['probes'][i]['z-score'][j]) for i in range(len(data['probes']))] for j in range(len(data['samples']))])
+        zscores = decode_zscores(data['probes'], len(data['samples']))
 
         with open(os.path.join(donor_path, 'zscores.txt'), 'wb') as f:
             np.savetxt(f, zscores, fmt = '%.5f')
@@ -269,7 +262,7 @@ class Analysis:
         if not os.path.exists(donor_path):
             os.makedirs(donor_path)
         probes = data['probes']
-        zscores = np.array([[float(data['probes'][i]['z-score'][j]) for i in range(len(data['probes']))] for j in range(len(data['samples']))])
+        zscores = decode_zscores(data['probes'], len(data['samples']))
         with open(os.path.join(donor_path, 'probes.txt'), 'r') as f:
             probes_cached = json.load(f)
         with open(os.path.join(donor_path, 'zscores.txt'), 'r') as f:
@@ -359,23 +352,9 @@ class Analysis:
         Args:
              combined_zscores (list): lists of zscores corresponding to each region of interest, populated from filtered_coords_and_zscores
         """
-        unique_gene_symbols = np.unique(self.gene_symbols)
-        '''
-        A = [a,a,a,b,b,b,c,c]
-        B = [a,b,c]
-        Following line of code will give  indices = [[0,1,2],[3,4,5],[6,7]]
-        '''
-        indices = [np.where(np.in1d(self.gene_symbols, genesymbol))[0] for genesymbol in unique_gene_symbols]
-        '''
-        for i in range (len(unique_gene_symbols)):
-                for j in range(len(combined_zscores)):
-                    for k in range(len(indices[i])):
-                        tmp[j] = combined_zscores[j][indices[i][k]][:]
-                winsorzed_mean_zscores[j][i] = np.mean(sp.stats.mstats.winsorize(tmp[j], limits=0.1))
-        '''
-        winsorzed_mean_zscores =  np.array([[np.mean(sp.stats.mstats.winsorize([combined_zscores[j][indices[i][k]] for k in range(0, len(indices[i]))], limits=0.1)) for i in range (len(unique_gene_symbols))] for j in range(len(combined_zscores))])
-        self.genesymbol_and_mean_zscores['uniqueId'] = unique_gene_symbols
-        self.genesymbol_and_mean_zscores['combined_zscores'] = winsorzed_mean_zscores
+        genesymbol_and_mean_zscores = get_mean_zscores(self.gene_symbols, combined_zscores)
+        self.genesymbol_and_mean_zscores['uniqueId'] = genesymbol_and_mean_zscores['uniqueId']
+        self.genesymbol_and_mean_zscores['combined_zscores'] = genesymbol_and_mean_zscores['combined_zscores']
 
     def accumulate_roicoords_and_name(self):
         """
@@ -470,17 +449,24 @@ class Analysis:
         """
         return list(map(self.do_anova_with_permutation_gene, range(0,self.n_genes)))
 
-
     def fwe_correction(self):
         """
-        Perform n_rep passes of FWE using gene_id_and_pvalues of first_iteration() as an initial guess
-        """
-        invn_rep = 1/self.n_rep
-        initial_guess_F_vec = self.F_vec_ref_anovan
-        pool = multiprocessing.Pool()
-        #self.F_mat_perm_anovan = np.array(pool.map(unwrap_self_do_anova_with_permutation_rep, zip([self]*self.n_rep, range(1,self.n_rep)) #for parameter
-        self.F_mat_perm_anovan = np.array(pool.map(unwrap_self_do_anova_with_permutation_rep, [self]*(self.n_rep-1)))
-        self.F_mat_perm_anovan = np.insert(self.F_mat_perm_anovan, 0, initial_guess_F_vec, axis=0)
+        Perform n_rep passes of FWE using gene_id_and_pvalues of first_iteration() as an initial guess. The relabelled F values are computed with the closed form least squares of pyjugex.design on the persistent worker pool, shared by all requests of the server. The design, zscores and permutations are placed in shared memory once per analysis.
+        """
+        zscores = self.combined_zscores if self.single_probe_mode else self.genesymbol_and_mean_zscores['combined_zscores']
+        design = AnovaDesign(area=self.anova_factors['Area'], specimen=self.anova_factors['Specimen'], age=self.anova_factors['Age'], race=self.anova_factors['Race'])
+        projected = design.project(zscores)
+        permutation_plan = PermutationPlan(n_samples=len(self.anova_factors['Area']), n_perm=self.n_rep-1)
+        # row 0 of F_mat is F_vec_ref_anovan
+        accumulator = MaxFAccumulator(self.F_vec_ref_anovan, n_perm=len(permutation_plan), keep_f_matrix=True)
+        if shared_memory is None:
+            for start in range(0, len(permutation_plan), 256):
+                accumulator.add(start, design.area_f_block(projected, permutation_plan.block(start, start + 256)))
+        else:
+            pool = get_worker_pool()
+            with pool.share(design, projected, permutation_plan.permutations, accumulator) as shared:
+                pool.accumulate(shared, accumulator)
+        self.F_mat_perm_anovan = accumulator.F_mat
         self.accumulate_gene_id_and_pvalues()
 
     def div_func(self, arr):